@@ -6,6 +6,25 @@ settings = dict(BASE_URL='http://localhost:8881/',
                 DB_SERVER='http://localhost:5984/',
                 DB_DATABASE='charon',
                 LOGIN_EXPIRES_DAYS=30,
+                WORKERS=1,
+                SHUTDOWN_WAIT=5,
+                DB_POOL_SIZE=10,
+                DB_TIMEOUT=30,
+                DB_RETRY_DELAYS=[0],
+                ENTITY_CACHE_SIZE=10000,
+                ENTITY_CACHE_WARM=False,
+                BULK_BATCH_SIZE=500,
+                LOG_WRITE_BEHIND=True,
+                LOG_SPOOL_FILE='log_spool.jsonl',
+                LOG_QUEUE_SIZE=10000,
+                LOG_FLUSH_INTERVAL=1.0,
+                LOG_FLUSH_TIMEOUT=5.0,
+                LOG_DATABASE=None,
+                LOG_PAGE_SIZE=100,
+                PATCH_MAX_FIELDS=5,
+                SAVE_RETRIES=dict(default=3),
+                COALESCE_WRITES=False,
+                COALESCE_WINDOW=0.005,
                 TORNADO_DEBUG=True,
                 LOGGING_DEBUG=True,
                 LOGGING_FORMAT='%(levelname)s [%(asctime)s] %(message)s',
@@ -1,15 +1,22 @@
 " Charon: base API request handlers. "
 
+import os
 import json
 import logging
 
 import tornado.web
+import tornado.gen
 import couchdb
 import requests
 
 from . import constants
 from . import settings
 from . import utils
+from . import saver as sav
+from . import connection
+from . import logwriter
+from . import coalescer
+from . import load_designs
 from .requesthandler import RequestHandler
 from .user import UserSaver
 
@@ -19,34 +26,67 @@ class ApiRequestHandler(RequestHandler):
 
     saver = None
 
+    @tornado.gen.coroutine
     def prepare(self):
         super(ApiRequestHandler, self).prepare()
-        self.check_api_access()
+        yield self.check_api_access()
 
-    
+    @tornado.gen.coroutine
     def check_api_access(self):
-        """Check the API token given in the header.
+        """Check the API token given in the header, without blocking.
         Return HTTP 401 if invalid or missing key."""
-        if self.get_current_user(): return
+        try:
+            yield self.fetch_api_user()
+        except ValueError, msg:
+            self.send_error(401, reason=str(msg))
+
+    @tornado.gen.coroutine
+    def fetch_api_user(self):
+        """Get the user given by the API token in the header, without
+        blocking, or else the logged-in user.
+        Raise ValueError if invalid or missing key, or user not active."""
         try:
             api_token = self.request.headers['X-Charon-API-token']
         except KeyError:
-            self.send_error(401, reason='API token missing')
-        else:
-            rows = list(self.db.view('user/api_token')[api_token])
-            if len(rows) != 1:
-                self.send_error(401, reason='invalid API token')
-            else:
-                try:
-                    user = self.get_user(rows[0].value)
-                except KeyError:
-                    self.send_error(401, reason='invalid user email')
-                else:
-                    if user.get('status') == constants.ACTIVE:
-                        self._user = user
-                        logging.debug("API token user '%s'", user['email'])
-                    else:
-                        self.send_error(401, reason='user not active')
+            user = self.get_current_user()
+            if not user: raise ValueError('API token missing')
+            raise tornado.gen.Return(user)
+        rows = yield self.adb.view('user/api_token', key=api_token)
+        if len(rows) != 1:
+            raise ValueError('invalid API token')
+        try:
+            user = yield self.fetch_user(rows[0].value)
+        except tornado.web.HTTPError:
+            raise ValueError('invalid user email')
+        if user.get('status') != constants.ACTIVE:
+            raise ValueError('user not active')
+        self._user = user
+        logging.debug("API token user '%s'", user['email'])
+        raise tornado.gen.Return(user)
+
+    def get_limit(self):
+        """Return the value of the query argument 'limit', or None if
+        not given. Raise ValueError if it is not a positive integer."""
+        limit = self.get_argument('limit', None)
+        if limit is None: return None
+        limit = int(limit)
+        if limit <= 0: raise ValueError('limit must be positive')
+        return limit
+
+    def set_updated_status(self, saver):
+        """Set HTTP 204 "No Content" for a successful update. If nothing
+        was changed, and thus nothing saved, also set the header
+        'X-Charon-Unchanged'."""
+        if saver.unchanged:
+            self.set_header('X-Charon-Unchanged', 'true')
+        self.set_status(204)
+
+    def set_deleted_status(self, count):
+        """Set HTTP 204 "No Content" for a successful delete, and the
+        header 'X-Charon-Deleted' to the number of documents deleted,
+        including those of dependent entities and log entries."""
+        self.set_header('X-Charon-Deleted', str(count))
+        self.set_status(204)
 
     def add_link(self, doc, rel, name, *args):
         """Add a link to JSON representation of an entity.
@@ -106,20 +146,71 @@ class ApiRequestHandler(RequestHandler):
 class ApiDocument(ApiRequestHandler):
     "Access a database document as is."
 
+    @tornado.gen.coroutine
     def get(self, id):
         "Return a database document as is."
         try:
-            self.write(self.db[id])
+            doc = yield self.adb.get(id)
+            self.write(doc)
         except couchdb.http.ResourceNotFound:
             self.send_error(404, reason='no such item')
 
 
 class ApiLogs(ApiRequestHandler):
-    "Access log event documents for a given document."
+    """Access log event documents for a given document, most recent first.
+    Optional query parameters: 'limit' for the maximum number of log
+    documents to return, and 'cursor' as returned by the previous call,
+    to get the next page."""
 
+    @tornado.gen.coroutine
     def get(self, id):
-        "Return all log event documents for a given document."
-        self.write(dict(logs=self.get_logs(id)))
+        """Return a list of log event documents for a given document,
+        and the cursor for the next page, which is null if there are
+        no more log documents.
+        Return HTTP 400 if the limit or cursor is invalid."""
+        try:
+            limit = self.get_limit()
+            logs, cursor = yield self.fetch_logs_page(
+                id,
+                limit=limit,
+                cursor=self.get_argument('cursor', None))
+        except ValueError, msg:
+            self.send_error(400, reason=str(msg))
+        else:
+            self.write(dict(logs=logs, cursor=cursor))
+
+
+class ApiLogSearch(ApiRequestHandler):
+    """Search the log event documents using an index, most recent first.
+    Optional query parameters: 'doc' for the id of the changed document,
+    'field' for the name of a changed field, 'operator' for the email
+    of the account making the change, 'doctype' for the type of the
+    changed document; at most one of the last three, which may be
+    combined with 'doc' only if 'field'. Also 'since' and 'until' for
+    the timestamp range, 'limit' for the maximum number of log documents
+    to return, and 'cursor' as returned by the previous call, to get
+    the next page."""
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Return a list of log event documents and the cursor for
+        the next page, which is null if there are no more log documents.
+        Return HTTP 400 if the criteria, limit or cursor is invalid."""
+        try:
+            limit = self.get_limit()
+            criteria = dict()
+            for key in ['doc', 'field', 'operator', 'doctype']:
+                criteria[key] = self.get_argument(key, None)
+            logs, cursor = yield self.fetch_search_logs(
+                criteria,
+                since=self.get_argument('since', None),
+                until=self.get_argument('until', None),
+                limit=limit,
+                cursor=self.get_argument('cursor', None))
+        except ValueError, msg:
+            self.send_error(400, reason=str(msg))
+        else:
+            self.write(dict(logs=logs, cursor=cursor))
 
 
 class ApiNotify(ApiRequestHandler):
@@ -127,6 +218,7 @@ class ApiNotify(ApiRequestHandler):
     This web service is free to ignore the event.
     No API token is required for this call."""
 
+    @tornado.gen.coroutine
     def check_api_access(self):
         pass
 
@@ -164,3 +256,54 @@ class ApiNotify(ApiRequestHandler):
                     pass            # Changes already made.
             except Exception, msg:
                 logging.debug("API notify request error: %s", msg)
+
+
+class ApiReady(ApiRequestHandler):
+    """Readiness of this web service: whether all design documents are
+    current, and no index is being built. No API token is required for
+    the readiness; the statistics are given only with a valid one."""
+
+    @tornado.gen.coroutine
+    def check_api_access(self):
+        pass
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Return the readiness and the status of the design documents.
+        With a valid API token, or if logged in, also return statistics
+        for this worker process.
+        Return HTTP 200 if ready, i.e. all design documents are the same
+        as in the design files, and no index of them is being built.
+        Return HTTP 503 if not ready, or if the status is not available."""
+        root = os.path.join(os.path.dirname(__file__), 'designs')
+        try:
+            tasks = load_designs.get_active_tasks(self.db)
+            if not settings.get('LOG_DATABASE'):
+                designs = load_designs.get_status(self.db, tasks, root=root)
+            else:
+                designs = load_designs.get_status(self.db, tasks, root=root,
+                                                  exclude=[constants.LOG])
+                designs.update(load_designs.get_status(
+                        utils.get_log_db(), tasks, root=root,
+                        designs=[constants.LOG]))
+        except Exception, msg:
+            logging.warning("design status error: %s", msg)
+            designs = dict()
+        ready = bool(designs)
+        for status in designs.values():
+            if not status['ready']:
+                ready = False
+        if not ready:
+            self.set_status(503)
+        result = dict(ready=ready, designs=designs)
+        try:
+            yield self.fetch_api_user()
+        except ValueError:
+            pass
+        else:
+            result.update(pool=connection.get_pool_stats(),
+                          conflicts=sav.conflicts,
+                          unchanged=sav.unchanged,
+                          logwriter=logwriter.get_stats(),
+                          coalescer=coalescer.get_stats())
+        self.write(result)
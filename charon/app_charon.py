@@ -1,13 +1,24 @@
 " Charon: Web application root. "
 
+import os
+import sys
+import errno
+import signal
 import logging
 
 import tornado
 import tornado.web
+import tornado.process
+import tornado.ioloop
+import tornado.netutil
+import tornado.httpserver
 import couchdb
 
 from charon import constants
 from charon import utils
+from charon import cache
+from charon import connection
+from charon import logwriter
 from charon import uimodules
 from charon.requesthandler import RequestHandler
 
@@ -17,6 +28,7 @@ from charon.project import *
 from charon.sample import *
 from charon.libprep import *
 from charon.seqrun import *
+from charon.bulk import *
 from charon.api import *
 
 
@@ -67,6 +79,8 @@ handlers = \
      URL(r'/api/v1/project', ApiProjectCreate, name='api_project_create'),
      URL(r'/api/v1/project/(?P<projectid>[^/]+)',
          ApiProject, name='api_project'),
+     URL(r'/api/v1/samplesupdate/(?P<projectid>[^/]+)',
+         ApiProjectSamplesUpdate, name='api_project_samples_update'),
      URL(r'/api/v1/projects', ApiProjects, name='api_projects'),
      URL(r'/api/v1/projectidsfromsampleid/(?P<sampleid>[^/]+)', ApiProjectsFromSampleIds, name='api_projectidsfromsampleid'),
      URL(r'/api/v1/sample/(?P<projectid>[^/]+)',
@@ -96,7 +110,9 @@ handlers = \
      URL(r'/api/v1/version', ApiVersion, name='api_version'),
      URL(r'/api/v1/doc/([a-f0-9]{32})', ApiDocument, name='api_doc'),
      URL(r'/api/v1/logs/([a-f0-9]{32})', ApiLogs, name='api_logs'),
+     URL(r'/api/v1/logsearch', ApiLogSearch, name='api_logsearch'),
      URL(r'/api/v1/notify', ApiNotify, name='api_notify'),
+     URL(r'/api/v1/ready', ApiReady, name='api_ready'),
      URL(r'/api/v1/projectsnotclosed', ApiProjectsNotDone, name='projects_not_done'),
      URL(r'/api/v1/samplesdone', ApiSamplesDone, name='api_samples_done'),
      URL(r'/api/v1/samplesfailed', ApiSamplesFailed, name='api_samples_failed'),
@@ -104,27 +120,170 @@ handlers = \
      URL(r'/api/v1/samplesrunning', ApiSamplesRunning, name='api_samples_running'),
      URL(r'/api/v1/samplesnotdone', ApiSamplesNotDone, name='api_samples_not_done'),
      URL(r'/api/v1/samplesnotdone/(?P<projectid>[^/]+)', ApiSamplesNotDonePerProject, name='api_samples_not_done_per_project'),
+     URL(r'/api/v1/samplesbystatus/(?P<status>[^/]+)', ApiSamplesByStatus, name='api_samples_by_status'),
      URL(r'/api/v1/seqrunsdone', ApiSeqrunsDone, name='api_seqruns_done'),
+     URL(r'/api/v1/seqrunsbystatus/(?P<status>[^/]+)', ApiSeqrunsByStatus, name='api_seqruns_by_status'),
      URL(r'/api/v1/customquery', ApiSamplesCustomQuery, name='api_custom_query'),
+     URL(r'/api/v1/bulk', ApiBulk, name='api_bulk'),
      ]
 
 
+# Exit status of a worker stopped by SIGHUP, to be started afresh.
+RESTART = 3
+
+
+def start_services(settings, worker=None):
+    """Start the per-process services. In multi-process mode this
+    must be done in each worker, after forking; 'worker' is its number."""
+    if settings.get('ENTITY_CACHE_SIZE', 10000) > 0:
+        # The feed holds its connection open; give it a session of its own.
+        session = connection.get_session(pool_size=1, timeout=60)
+        cache.start_follower(connection.connect(session=session))
+        if settings.get('ENTITY_CACHE_WARM'):
+            cache.warm(utils.get_db())
+    if settings.get('LOG_WRITE_BEHIND', True):
+        # One spool file per worker; a restarted worker recovers its entries.
+        spoolpath = settings.get('LOG_SPOOL_FILE', 'log_spool.jsonl')
+        if worker is not None:
+            spoolpath = "{0}.{1}".format(spoolpath, worker)
+        session = connection.get_session(pool_size=1)
+        logwriter.start(connection.connect(session=session,
+                                           name=settings.get('LOG_DATABASE')),
+                        spoolpath)
+
+def shutdown(server, wait):
+    """Stop accepting new connections, and stop the IOLoop
+    after allowing the given number of seconds for requests in progress."""
+    server.stop()
+    ioloop = tornado.ioloop.IOLoop.instance()
+    ioloop.call_later(wait, ioloop.stop)
+
+def fork_workers(num_workers, max_restarts=100):
+    """Start the worker processes, as tornado.process.fork_processes does,
+    and return the number of the worker in each worker process. The master
+    starts a new worker when one exits with an error, or with the status
+    RESTART. The latter is intentional, e.g. by SIGHUP, and is not counted
+    against 'max_restarts'. The master exits when all workers have
+    exited normally. Raise RuntimeError if too many workers failed."""
+    if not num_workers:
+        num_workers = tornado.process.cpu_count()
+    children = dict()
+    def start_child(worker):
+        pid = os.fork()
+        if pid == 0: return worker
+        children[pid] = worker
+        return None
+    for worker in xrange(num_workers):
+        if start_child(worker) is not None: return worker
+    failures = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError, msg:
+            if msg.args[0] == errno.EINTR: continue
+            raise
+        if pid not in children: continue
+        worker = children.pop(pid)
+        if os.WIFSIGNALED(status):
+            logging.warning("worker %d (pid %d) killed by signal %d",
+                            worker, pid, os.WTERMSIG(status))
+        elif os.WEXITSTATUS(status) == 0:
+            logging.info("worker %d (pid %d) exited normally", worker, pid)
+            continue
+        elif os.WEXITSTATUS(status) == RESTART:
+            logging.info("worker %d (pid %d) restarting", worker, pid)
+        else:
+            logging.warning("worker %d (pid %d) exited with status %d",
+                            worker, pid, os.WEXITSTATUS(status))
+        if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != RESTART:
+            failures += 1
+            if failures > max_restarts:
+                raise RuntimeError('too many worker failures; giving up')
+        if start_child(worker) is not None: return worker
+    sys.exit(0)
+
+def is_foreground():
+    "Is this process in the foreground process group of a terminal?"
+    try:
+        return os.tcgetpgrp(sys.stdin.fileno()) == os.getpgrp()
+    except (OSError, AttributeError, ValueError):
+        return False
+
+
 if __name__ == "__main__":
-    import sys
-    import tornado.ioloop
     try:
         settings = utils.load_settings(filepath=sys.argv[1])
     except IndexError:
         settings = utils.load_settings()
+    workers = settings.get('WORKERS', 1)
+    debug = settings.get('TORNADO_DEBUG', False)
+    if workers != 1 and debug:
+        logging.warning('TORNADO_DEBUG disabled in multi-process mode')
+        debug = False
     application = tornado.web.Application(
         handlers=handlers,
-        debug=settings.get('TORNADO_DEBUG', False),
+        debug=debug,
         cookie_secret=settings['COOKIE_SECRET'],
         ui_modules=uimodules,
         template_path=constants.TEMPLATE_PATH,
         static_path=constants.STATIC_PATH,
         static_url_prefix=constants.STATIC_URL,
         login_url=constants.LOGIN_URL)
-    application.listen(settings['PORT'])
+    if settings.get('LOG_WRITE_BEHIND', True):
+        # Recover the spool files of all workers, before any is started,
+        # including those of workers no longer started.
+        session = connection.get_session(pool_size=1)
+        logdb = connection.connect(session=session,
+                                   name=settings.get('LOG_DATABASE'))
+        logwriter.recover(logdb,
+                          settings.get('LOG_SPOOL_FILE', 'log_spool.jsonl'),
+                          batch_size=settings.get('BULK_BATCH_SIZE', 500))
+        connection.close_session(session)
+    # The listening socket is bound before forking, and shared by all workers.
+    sockets = tornado.netutil.bind_sockets(settings['PORT'])
+    if workers != 1:
+        # SIGHUP is for the workers; the master just restarts them.
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        # The master and its workers get a process group of their own,
+        # so that the shell or supervisor that started it is not signalled.
+        # Not when in the foreground of a terminal, where Ctrl-C must reach
+        # them; the shell then has given the job a process group already.
+        # A session leader already leads its own process group.
+        if not is_foreground():
+            try:
+                os.setpgrp()
+            except OSError:
+                pass
+        # SIGTERM to the master is passed on to the workers; the master
+        # exits when all workers have exited normally.
+        def terminate(signum, frame):
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            os.killpg(os.getpgrp(), signal.SIGTERM)
+        signal.signal(signal.SIGTERM, terminate)
+        logging.info("Charon master process %s starting %s workers",
+                     os.getpid(), workers or 'one per CPU')
+        worker = fork_workers(
+            workers, max_restarts=settings.get('WORKERS_MAX_RESTARTS', 100))
+        utils.set_worker_logging(worker)
+    else:
+        worker = None
+    start_services(settings, worker=worker)
+    server = tornado.httpserver.HTTPServer(application, xheaders=True)
+    server.add_sockets(sockets)
+    wait = settings.get('SHUTDOWN_WAIT', 5)
+    ioloop = tornado.ioloop.IOLoop.instance()
+    # SIGTERM: graceful stop. SIGHUP: graceful stop with non-zero
+    # exit status, which makes the master start a fresh worker.
+    restart = []
+    def stop(signum, frame):
+        if signum == signal.SIGHUP:
+            restart.append(True)
+        logging.info("Charon process %s stopping", os.getpid())
+        ioloop.add_callback_from_signal(shutdown, server, wait)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, stop)
     logging.info("Charon web server on port %s", settings['PORT'])
-    tornado.ioloop.IOLoop.instance().start()
+    ioloop.start()
+    logwriter.stop(timeout=wait)
+    if restart:
+        sys.exit(RESTART)
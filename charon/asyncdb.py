@@ -0,0 +1,200 @@
+""" Charon: Non-blocking access to the CouchDB HTTP API.
+Built on Tornado's AsyncHTTPClient, for use in coroutine request handlers,
+so that the IOLoop is not stalled while waiting for the database.
+"""
+
+import os
+import json
+import urllib
+import logging
+
+import tornado.gen
+import tornado.httpclient
+import couchdb
+import couchdb.client
+import couchdb.http
+
+from . import settings
+
+
+class AsyncDatabase(object):
+    "Non-blocking handle for a CouchDB database."
+
+    def __init__(self, url, timeout=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.client = tornado.httpclient.AsyncHTTPClient()
+        self.requests = 0
+
+    @tornado.gen.coroutine
+    def request(self, method, path, params=None, body=None):
+        """Perform the HTTP request and return the decoded JSON response.
+        Raise the couchdb.http exception corresponding to an error status."""
+        response, data = yield self.send(method, path,
+                                         params=params, body=body)
+        raise tornado.gen.Return(data)
+
+    @tornado.gen.coroutine
+    def send(self, method, path, params=None, body=None):
+        """Perform the HTTP request. Return the response and its decoded
+        JSON body. Raise the couchdb.http exception corresponding to
+        an error status."""
+        url = self.url
+        if path:
+            url += '/' + '/'.join([urllib.quote(p, safe='') for p in path])
+        if params:
+            url += '?' + urllib.urlencode(params)
+        if body is not None:
+            body = json.dumps(body)
+        request = tornado.httpclient.HTTPRequest(
+            url,
+            method=method,
+            body=body,
+            headers={'Content-Type': 'application/json',
+                     'Accept': 'application/json'},
+            request_timeout=self.timeout)
+        self.requests += 1
+        response = yield self.client.fetch(request, raise_error=False)
+        if response.code == 599:
+            raise IOError(str(response.error))
+        try:
+            data = json.loads(response.body)
+        except (TypeError, ValueError):
+            data = dict(error='invalid', reason=response.body)
+        if response.code == 404:
+            raise couchdb.http.ResourceNotFound((data.get('error'),
+                                                 data.get('reason')))
+        elif response.code == 409:
+            raise couchdb.http.ResourceConflict((data.get('error'),
+                                                 data.get('reason')))
+        elif response.code >= 400:
+            raise couchdb.http.ServerError((response.code,
+                                            (data.get('error'),
+                                             data.get('reason'))))
+        raise tornado.gen.Return((response, data))
+
+    @tornado.gen.coroutine
+    def get(self, id):
+        """Return the document with the given id.
+        Raise couchdb.http.ResourceNotFound if no such document."""
+        data = yield self.request('GET', [id])
+        raise tornado.gen.Return(couchdb.client.Document(data))
+
+    @tornado.gen.coroutine
+    def view(self, viewname, **options):
+        """Return the list of rows from the view given by 'design/name'.
+        The options are the usual CouchDB view query parameters.
+        If 'keys' is given, the request is a POST with the keys as body."""
+        design, name = viewname.split('/', 1)
+        path = ['_design', design, '_view', name]
+        params = dict()
+        for key, value in options.items():
+            if key == 'keys': continue
+            if key in ('key', 'startkey', 'endkey') or \
+               isinstance(value, bool):
+                value = json.dumps(value)
+            params[key] = value
+        if 'keys' in options:
+            data = yield self.request('POST', path, params=params,
+                                      body=dict(keys=options['keys']))
+        else:
+            data = yield self.request('GET', path, params=params)
+        raise tornado.gen.Return([couchdb.client.Row(r)
+                                  for r in data['rows']])
+
+    @tornado.gen.coroutine
+    def get_docs(self, ids):
+        """Return the list of the latest revisions of the documents with
+        the given ids, in one request; None for a missing or deleted one."""
+        data = yield self.request('POST', ['_all_docs'],
+                                  params=dict(include_docs='true'),
+                                  body=dict(keys=ids))
+        result = []
+        for row in data['rows']:
+            if row.get('doc'):
+                result.append(couchdb.client.Document(row['doc']))
+            else:
+                result.append(None)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def save(self, doc):
+        """Save the document, setting its '_id' and '_rev'.
+        Raise couchdb.http.ResourceConflict if revision conflict."""
+        data = yield self.request('PUT', [doc['_id']], body=doc)
+        doc['_rev'] = data['rev']
+        raise tornado.gen.Return((data['id'], data['rev']))
+
+    @tornado.gen.coroutine
+    def update_doc(self, name, docid, body):
+        """Apply the update handler given by 'design/name' to the document.
+        Return the new revision and the decoded JSON response.
+        Raise couchdb.http.ResourceConflict if the handler refused."""
+        design, name = name.split('/', 1)
+        response, data = yield self.send('PUT',
+                                         ['_design', design, '_update',
+                                          name, docid],
+                                         body=body)
+        rev = response.headers.get('X-Couch-Update-NewRev')
+        raise tornado.gen.Return((rev, data))
+
+    @tornado.gen.coroutine
+    def update(self, docs):
+        """Save the documents in one _bulk_docs request.
+        Return the list of per-document results; (success, id, rev or error).
+        The '_rev' of each successfully saved document is updated."""
+        data = yield self.request('POST', ['_bulk_docs'],
+                                  body=dict(docs=docs))
+        result = []
+        for doc, item in zip(docs, data):
+            if 'error' in item:
+                if item['error'] == 'conflict':
+                    error = couchdb.http.ResourceConflict(item.get('reason'))
+                else:
+                    error = couchdb.http.ServerError(item.get('reason'))
+                result.append((False, item['id'], error))
+            else:
+                doc['_rev'] = item['rev']
+                result.append((True, item['id'], item['rev']))
+        raise tornado.gen.Return(result)
+
+
+_db = None
+_logdb = None
+_pid = None
+
+def get_db():
+    """Return the shared non-blocking handle for the CouchDB database.
+    One handle is created per process."""
+    global _db, _logdb, _pid
+    if _db is None or _pid != os.getpid():
+        tornado.httpclient.AsyncHTTPClient.configure(
+            None, max_clients=settings.get('DB_POOL_SIZE', 10))
+        _db = AsyncDatabase(get_url(settings['DB_DATABASE']),
+                            timeout=settings.get('DB_TIMEOUT'))
+        _logdb = None
+        _pid = os.getpid()
+    return _db
+
+def get_request_db():
+    """Return a non-blocking handle for the CouchDB database for one
+    request handler, counting its own requests in 'adb.requests'."""
+    db = get_db()
+    return AsyncDatabase(db.url, timeout=db.timeout)
+
+def get_log_db():
+    """Return the shared non-blocking handle for the log database.
+    If no separate log database is configured, this is the main handle."""
+    global _logdb
+    db = get_db()
+    if not settings.get('LOG_DATABASE'):
+        return db
+    if _logdb is None:
+        _logdb = AsyncDatabase(get_url(settings['LOG_DATABASE']),
+                               timeout=settings.get('DB_TIMEOUT'))
+    return _logdb
+
+def get_url(name):
+    "Return the URL for the named database."
+    return "{0}/{1}".format(settings['DB_SERVER'].rstrip('/'),
+                            urllib.quote(name, safe=''))
@@ -0,0 +1,154 @@
+" Charon: Bulk create and update of entities. "
+
+import logging
+import json
+
+import tornado.web
+import tornado.gen
+
+from . import saver
+from .api import ApiRequestHandler
+from .project import ProjectSaver
+from .sample import SampleSaver
+from .libprep import LibprepSaver
+from .seqrun import SeqrunSaver, SampleRollupMixin
+
+
+# In the order of processing, so that a parent created in the same
+# request is available for its children:
+# (input key, saver class, identifier keys, saver keyword for the parent)
+LEVELS = [('projects', ProjectSaver, ('projectid',), None),
+          ('samples', SampleSaver, ('projectid', 'sampleid'), 'project'),
+          ('libpreps', LibprepSaver,
+           ('projectid', 'sampleid', 'libprepid'), 'sample'),
+          ('seqruns', SeqrunSaver,
+           ('projectid', 'sampleid', 'libprepid', 'seqrunid'), 'libprep')]
+
+
+class ApiBulk(SampleRollupMixin, ApiRequestHandler):
+    """Create or update many entities in one request.
+    The JSON input is an object with the optional keys 'projects',
+    'samples', 'libpreps' and 'seqruns', each a list of entity data
+    containing the identifiers of the entity and its parents.
+    An existing entity is updated, otherwise it is created."""
+
+    # Do not use authentication decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
+    def post(self):
+        """Validate all items, and save the valid ones in batches.
+        Return HTTP 200 and a list of results for each input key;
+        each with the 'index' of the item, its 'status' (201 created,
+        204 updated, 400 invalid, 404 no such parent, 409 conflict),
+        'unchanged' if updated with no change, and 'reason' if failed.
+        Return HTTP 400 if the input is not of the required form."""
+        try:
+            data = json.loads(self.request.body)
+            if not isinstance(data, dict):
+                raise ValueError('input must be a JSON object')
+            for key, cls, idkeys, parent in LEVELS:
+                items = data.get(key, [])
+                if not isinstance(items, list):
+                    raise ValueError("'{0}' must be a list".format(key))
+                for item in items:
+                    if not isinstance(item, dict):
+                        raise ValueError("'{0}' items must be objects".
+                                         format(key))
+        except ValueError, msg:
+            self.send_error(400, reason=str(msg))
+            return
+        result = dict()
+        for key, cls, idkeys, parent in LEVELS:
+            items = data.get(key, [])
+            if not items: continue
+            result[key] = yield self.save_items(items, cls, idkeys, parent)
+        # Update the samples of the saved seqruns, all in one go.
+        samples = set()
+        for item, status in zip(data.get('seqruns', []),
+                                result.get('seqruns', [])):
+            if status['status'] in (201, 204):
+                samples.add((item['projectid'], item['sampleid']))
+        try:
+            yield self.update_samples_async(*sorted(samples))
+        except (ValueError, IOError), msg:
+            logging.warning("bulk sample update: %s", msg)
+        self.write(result)
+
+    @tornado.gen.coroutine
+    def save_items(self, items, cls, idkeys, parent):
+        "Validate and save the items of one entity level. Return results."
+        results = [dict(index=i) for i in xrange(len(items))]
+        paths = []
+        for item, result in zip(items, results):
+            try:
+                path = tuple([item[k] for k in idkeys])
+                for value in path:
+                    if not isinstance(value, basestring):
+                        raise ValueError('identifier must be a string')
+            except KeyError, msg:
+                result['status'] = 400
+                result['reason'] = "missing identifier {0}".format(msg)
+                paths.append(None)
+            except ValueError, msg:
+                result['status'] = 400
+                result['reason'] = str(msg)
+                paths.append(None)
+            else:
+                paths.append(path)
+        # Get all entities and their parents in one database request.
+        wanted = set()
+        for path in paths:
+            if path is None: continue
+            for length in xrange(1, len(path)+1):
+                wanted.add(path[:length])
+        found = yield self.loader.load_async(list(wanted))
+        entities = []
+        seen = set()
+        for item, path, result in zip(items, paths, results):
+            if path is None: continue
+            if path in seen:
+                result['status'] = 400
+                result['reason'] = 'not unique within request'
+                continue
+            seen.add(path)
+            kwargs = dict(rqh=self)
+            if parent:
+                try:
+                    kwargs[parent] = found[path[:-1]]
+                except KeyError:
+                    result['status'] = 404
+                    result['reason'] = "no such {0} {1}".format(
+                        parent, '/'.join(path[:-1]))
+                    continue
+            try:
+                kwargs['doc'] = found[path]
+            except KeyError:
+                result['status'] = 201
+            else:
+                result['status'] = 204
+            entities.append((cls(**kwargs), item, path, result))
+        # Check uniqueness of the values for all items in one go.
+        saver.check_unique_batch([e[0] for e in entities],
+                                 [e[1] for e in entities])
+        savers = []
+        pending = []
+        for entity, item, path, result in entities:
+            try:
+                entity.store(data=item)
+            except ValueError, msg:
+                result['status'] = 400
+                result['reason'] = str(msg)
+                continue
+            savers.append(entity)
+            pending.append((path, result))
+        errors = yield saver.save_batch_async(self.adb, savers)
+        for entity, (path, result), error in zip(savers, pending, errors):
+            if error is None:
+                # Make a created entity available as parent.
+                self.loader.keep(path, entity.doc)
+                if entity.unchanged:
+                    result['unchanged'] = True
+            else:
+                logging.debug("bulk save %s: %s", path, error)
+                result['status'] = 409
+                result['reason'] = str(error)
+        raise tornado.gen.Return(results)
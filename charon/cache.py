@@ -0,0 +1,191 @@
+" Charon: Process-wide entity cache, invalidated by the CouchDB _changes feed. "
+
+import copy
+import time
+import logging
+import threading
+import collections
+
+import couchdb
+
+from . import constants
+from . import settings
+
+
+class EntityCache(object):
+    """Memory-bounded LRU cache of entity documents.
+    Items are looked up by view name and key, and evicted by document id.
+    Copies are handed out, since handlers modify the documents they get."""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict() # (viewname, key) -> doc
+        self.lookup = dict()                   # doc id -> set of item keys
+        self.revs = collections.OrderedDict()  # doc id -> latest rev seen
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, viewname, key):
+        "Return a copy of the cached document, or None if not cached."
+        itemkey = (viewname, self.hashable(key))
+        with self.lock:
+            try:
+                doc = self.items.pop(itemkey)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.items[itemkey] = doc    # Most recently used last.
+            self.hits += 1
+        return copy.deepcopy(doc)
+
+    def put(self, viewname, key, doc):
+        """Store a copy of the document.
+        Ignore it if a later revision has already been seen in the feed."""
+        if self.size <= 0: return
+        itemkey = (viewname, self.hashable(key))
+        doc = copy.deepcopy(doc)
+        with self.lock:
+            latest = self.revs.get(doc['_id'])
+            if latest and rev_number(latest) > rev_number(doc.get('_rev')):
+                return
+            self.items.pop(itemkey, None)
+            self.items[itemkey] = doc
+            self.lookup.setdefault(doc['_id'], set()).add(itemkey)
+            while len(self.items) > self.size:
+                oldkey, old = self.items.popitem(last=False)
+                self.discard(old['_id'], oldkey)
+
+    def evict(self, id, rev=None):
+        """Remove all items for the document id.
+        If the revision is given, record it as the latest seen."""
+        with self.lock:
+            if rev:
+                self.revs.pop(id, None)
+                self.revs[id] = rev
+                while len(self.revs) > self.size:
+                    self.revs.popitem(last=False)
+            for itemkey in self.lookup.pop(id, set()):
+                self.items.pop(itemkey, None)
+
+    def clear(self):
+        "Remove all items."
+        with self.lock:
+            self.items.clear()
+            self.lookup.clear()
+
+    def discard(self, id, itemkey):
+        "Remove the item key from the id lookup. Lock must be held."
+        try:
+            itemkeys = self.lookup[id]
+        except KeyError:
+            return
+        itemkeys.discard(itemkey)
+        if not itemkeys:
+            del self.lookup[id]
+
+    def hashable(self, key):
+        "Convert a list key (from JSON) into a tuple."
+        if isinstance(key, list):
+            return tuple(key)
+        return key
+
+
+class ChangesFollower(threading.Thread):
+    """Follow the CouchDB _changes feed in a background thread,
+    evicting changed documents from the entity cache."""
+
+    daemon = True
+
+    def __init__(self, db, cache, heartbeat=10000, retry_delay=5.0):
+        super(ChangesFollower, self).__init__(name='ChangesFollower')
+        self.db = db
+        self.cache = cache
+        self.heartbeat = heartbeat
+        self.retry_delay = retry_delay
+        self.since = None
+        self.connected = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                if self.since is None:
+                    self.since = self.db.info()['update_seq']
+                feed = self.db.changes(feed='continuous',
+                                       since=self.since,
+                                       heartbeat=self.heartbeat)
+                self.connected.set()
+                for change in feed:
+                    try:
+                        self.since = change['seq']
+                    except KeyError:    # The 'last_seq' line; feed ended.
+                        break
+                    try:
+                        rev = change['changes'][-1]['rev']
+                    except (KeyError, IndexError):
+                        rev = None
+                    self.cache.evict(change['id'], rev=rev)
+            except Exception, msg:
+                logging.warning("changes feed error: %s", msg)
+            # Changes may have been missed while disconnected.
+            self.connected.clear()
+            self.cache.clear()
+            time.sleep(self.retry_delay)
+
+
+_cache = None
+_follower = None
+
+def get_cache():
+    "Return the process-wide entity cache."
+    global _cache
+    if _cache is None:
+        _cache = EntityCache(size=settings.get('ENTITY_CACHE_SIZE', 10000))
+    return _cache
+
+def is_active():
+    """Is the cache valid for reading? Only if the changes feed
+    is being followed; otherwise items may be stale."""
+    return _follower is not None and _follower.connected.is_set()
+
+def start_follower(db):
+    "Start following the changes feed of the database."
+    global _follower
+    if _follower is not None and _follower.is_alive(): return
+    _follower = ChangesFollower(db, get_cache())
+    _follower.start()
+    _follower.connected.wait(10.0)
+
+def evict(id, rev=None):
+    "Evict the document from the cache, if any."
+    if _cache is not None:
+        _cache.evict(id, rev=rev)
+
+def warm(db):
+    "Load the OPEN projects and all their samples into the cache."
+    cache = get_cache()
+    count = 0
+    view = db.view('project/projectid', include_docs=True)
+    projects = [r.doc for r in view
+                if r.doc.get('status') == constants.PROJECT_STATUS['NEW']]
+    for project in projects:
+        cache.put('project/projectid', project['projectid'], project)
+        count += 1
+        startkey = (project['projectid'], '')
+        endkey = (project['projectid'], constants.HIGH_CHAR)
+        view = db.view('sample/sampleid', include_docs=True)
+        for row in view[startkey:endkey]:
+            cache.put('sample/sampleid', tuple(row.key), row.doc)
+            count += 1
+    logging.info("entity cache warmed with %s documents", count)
+    return count
+
+def rev_number(rev):
+    "Return the sequence number part of a document revision."
+    try:
+        return int(rev.split('-', 1)[0])
+    except (AttributeError, ValueError):
+        return 0
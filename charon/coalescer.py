@@ -0,0 +1,116 @@
+""" Charon: Group commit of document saves.
+Saves made by coroutine request handlers within a short time window
+are collected, and written together by one _bulk_docs request.
+Each save is resolved by its own per-document result.
+"""
+
+import os
+import logging
+
+import tornado.gen
+import tornado.ioloop
+import tornado.concurrent
+
+from . import settings
+
+
+class Coalescer(object):
+    """Collect the documents to save, and write them in one _bulk_docs
+    request when the time window has passed, or the batch is full."""
+
+    def __init__(self, adb, window=0.005, batch_size=500):
+        self.adb = adb
+        self.window = window
+        self.batch_size = batch_size
+        self.pending = []               # List of (doc, future)
+        self.timeout = None
+        self.batches = 0
+        self.docs = 0
+        self.max_batch = 0
+
+    def save(self, doc):
+        """Return a Future for the save of the document. Its result is
+        the document id and new revision; its '_rev' is also updated.
+        The Future raises couchdb.http.ResourceConflict if conflict."""
+        future = tornado.concurrent.Future()
+        self.pending.append((doc, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timeout is None:
+            self.timeout = tornado.ioloop.IOLoop.current().call_later(
+                self.window, self.flush)
+        return future
+
+    def flush(self):
+        "Write the pending documents now."
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+        pending, self.pending = self.pending, []
+        if pending:
+            self.write(pending)
+
+    @tornado.gen.coroutine
+    def write(self, pending):
+        "Write the documents, and resolve the Future of each."
+        self.batches += 1
+        self.docs += len(pending)
+        self.max_batch = max(self.max_batch, len(pending))
+        logging.debug("group commit of %s documents", len(pending))
+        try:
+            items = yield self.adb.update([doc for doc, future in pending])
+        except Exception, msg:
+            for doc, future in pending:
+                future.set_exception(msg)
+            return
+        for (doc, future), (success, id, value) in zip(pending, items):
+            if success:
+                future.set_result((id, value))
+            else:
+                future.set_exception(value)
+
+    def get_stats(self):
+        "Return a dictionary of group commit statistics."
+        return dict(batches=self.batches,
+                    docs=self.docs,
+                    max_batch=self.max_batch,
+                    pending=len(self.pending))
+
+
+_coalescers = dict()                    # Database URL -> Coalescer
+_pid = None
+
+def is_active():
+    "Are saves to be coalesced?"
+    return bool(settings.get('COALESCE_WRITES'))
+
+def get_coalescer(adb):
+    """Return the group commit coalescer for the non-blocking database
+    handle. One coalescer is created per database and process."""
+    global _pid
+    if _pid != os.getpid():
+        _coalescers.clear()
+        _pid = os.getpid()
+    try:
+        return _coalescers[adb.url]
+    except KeyError:
+        coalescer = Coalescer(adb,
+                              window=settings.get('COALESCE_WINDOW', 0.005),
+                              batch_size=settings.get('BULK_BATCH_SIZE', 500))
+        _coalescers[adb.url] = coalescer
+        return coalescer
+
+def save(adb, doc):
+    """Save the document; together with others if coalescing is active.
+    Return a Future with the document id and new revision.
+    Raise couchdb.http.ResourceConflict if revision conflict."""
+    if is_active():
+        return get_coalescer(adb).save(doc)
+    return adb.save(doc)
+
+def get_stats():
+    """Return the group commit statistics for this process,
+    keyed by database name."""
+    if _pid != os.getpid(): return dict()
+    return dict([(url.rsplit('/', 1)[-1], coalescer.get_stats())
+                 for url, coalescer in _coalescers.items()])
@@ -0,0 +1,204 @@
+" Charon: CouchDB connection manager; one pooled database handle per process. "
+
+import os
+import time
+import socket
+import logging
+import threading
+import urllib
+
+import couchdb
+import couchdb.http
+
+from . import settings
+from . import asyncdb
+
+
+class BoundedConnectionPool(couchdb.http.ConnectionPool):
+    """Keep-alive HTTP connection pool with at most 'size' connections
+    in use, and at most 'size' idle connections per host. A request
+    when all connections are in use, i.e. the pool is saturated, waits
+    for one to be released; at most the timeout, after which it fails.
+    A connection is in use from 'get' until it is either released,
+    or closed after a failed request."""
+
+    def __init__(self, timeout, size=10):
+        super(BoundedConnectionPool, self).__init__(timeout)
+        self.size = size
+        self.busy = set()
+        self.max_in_use = 0
+        self.saturated = 0
+        self.requests = 0
+        self.count_lock = threading.Condition(threading.Lock())
+
+    @property
+    def in_use(self):
+        return len(self.busy)
+
+    def get(self, url):
+        """Get a connection, waiting for one to be released if all are
+        in use. Raise socket.timeout if none is released in time."""
+        with self.count_lock:
+            if self.in_use >= self.size:
+                self.saturated += 1
+                logging.warning("CouchDB connection pool saturated: "
+                                "%s in use, pool size %s",
+                                self.in_use, self.size)
+                self.wait()
+            conn = super(BoundedConnectionPool, self).get(url)
+            if not getattr(conn, 'charon_close_hooked', False):
+                self.hook_close(conn)
+            self.requests += 1
+            self.busy.add(conn)
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        return conn
+
+    def wait(self):
+        """Wait until a connection is no longer in use; at most the timeout.
+        The count lock must be held."""
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while self.in_use >= self.size:
+            if deadline is None:
+                self.count_lock.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('CouchDB connection pool exhausted')
+            self.count_lock.wait(remaining)
+
+    def hook_close(self, conn):
+        """The connection is closed instead of released when a request
+        fails; it is then no longer in use."""
+        close = conn.close
+        def hooked_close():
+            self.discard(conn)
+            close()
+        conn.close = hooked_close
+        conn.charon_close_hooked = True
+
+    def discard(self, conn):
+        "The connection is no longer in use."
+        with self.count_lock:
+            self.busy.discard(conn)
+            self.count_lock.notify()
+
+    def release(self, url, conn):
+        self.discard(conn)
+        super(BoundedConnectionPool, self).release(url, conn)
+        # Close surplus idle connections beyond the pool size.
+        with self.lock:
+            for conns in self.conns.values():
+                while len(conns) > self.size:
+                    conns.pop(0).close()
+
+    def get_stats(self):
+        "Return a dictionary of pool statistics."
+        with self.lock:
+            idle = sum([len(c) for c in self.conns.values()])
+        return dict(size=self.size,
+                    in_use=self.in_use,
+                    idle=idle,
+                    max_in_use=self.max_in_use,
+                    saturated=self.saturated,
+                    requests=self.requests)
+
+
+def get_session(pool_size=None, timeout=None):
+    "Return a new HTTP session having a bounded keep-alive connection pool."
+    if pool_size is None:
+        pool_size = settings.get('DB_POOL_SIZE', 10)
+    if timeout is None:
+        timeout = settings.get('DB_TIMEOUT')
+    session = couchdb.http.Session(timeout=timeout,
+                                   retry_delays=settings.get('DB_RETRY_DELAYS',
+                                                             [0]))
+    session.connection_pool = BoundedConnectionPool(timeout, size=pool_size)
+    return session
+
+def close_session(session):
+    "Close the idle connections of the session, e.g. before forking."
+    pool = session.connection_pool
+    with pool.lock:
+        for conns in pool.conns.values():
+            while conns:
+                conns.pop().close()
+
+def connect(session=None, name=None):
+    """Return a new handle for the CouchDB database, using the given
+    session, or a new one. Raise KeyError if no such database."""
+    name = name or settings['DB_DATABASE']
+    url = "{0}/{1}".format(settings['DB_SERVER'].rstrip('/'),
+                           urllib.quote(name, safe=''))
+    db = couchdb.Database(url, name=name, session=session or get_session())
+    try:
+        db.info()
+    except couchdb.http.ResourceNotFound:
+        raise KeyError("CouchDB database '%s' does not exist" % name)
+    return db
+
+
+_db = None
+_pid = None
+_lock = threading.Lock()
+
+def get_db():
+    """Return the shared handle for the CouchDB database.
+    One handle, and its connection pool, is created per process,
+    so that a forked worker does not share connections with its parent."""
+    global _db, _pid
+    with _lock:
+        if _db is None or _pid != os.getpid():
+            _db = connect()
+            _pid = os.getpid()
+        return _db
+
+_logdb = None
+_logpid = None
+
+def get_log_db():
+    """Return the shared handle for the log database, sharing the
+    connection pool of the main database handle. If no separate log
+    database is configured, this is the main database handle.
+    Raise KeyError if no such database."""
+    global _logdb, _logpid
+    if not settings.get('LOG_DATABASE'):
+        return get_db()
+    db = get_db()
+    with _lock:
+        if _logdb is None or _logpid != os.getpid():
+            _logdb = connect(session=db.resource.session,
+                             name=settings['LOG_DATABASE'])
+            _logpid = os.getpid()
+        return _logdb
+
+class CountingSession(object):
+    """Proxy for an HTTP session, counting the requests made through it.
+    Used for the database handle of one request handler."""
+
+    def __init__(self, session):
+        self.session = session
+        self.requests = 0
+
+    def request(self, *args, **kwargs):
+        self.requests += 1
+        return self.session.request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+def get_request_db():
+    """Return a handle for the CouchDB database for one request handler,
+    sharing the connection pool of the process, and counting its own
+    requests in 'db.resource.session.requests'."""
+    db = get_db()
+    return couchdb.Database(db.resource.url,
+                            name=db.name,
+                            session=CountingSession(db.resource.session))
+
+def get_pool_stats():
+    "Return the connection pool statistics for this process."
+    if _db is None or _pid != os.getpid():
+        return dict()
+    return _db.resource.session.connection_pool.get_stats()
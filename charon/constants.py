@@ -47,3 +47,18 @@ LIBRARY_STATUS={'DONE':'PASSED', 'FAILED':'FAILED'}
 DELIVERY_STATUS={'NEW':'NOT DELIVERED', 'ONGOING':'IN_PROGRESS', 'DONE':'DELIVERED', 'FAILED':'FAILED'}
 SAMPLE_ANALYSIS_STATUS={'NEW':'TO_ANALYZE', 'ONGOING':'UNDER_ANALYSIS', 'DONE':'ANALYZED', 'FAILED':'FAILED'}
 SEQRUN_ANALYSIS_STATUS={'NEW':'NOT_RUNNING', 'ONGOING':'RUNNING', 'DONE':'DONE', 'FAILED':'FAILED'}
+
+# Status fields indexed by the 'status' design document, per doctype.
+STATUS_FIELDS = {SAMPLE: ['analysis_status', 'status', 'delivery_status',
+                          'qc', 'genotype_status'],
+                 SEQRUN: ['alignment_status', 'genotype_status']}
+
+# Log search indexes of the 'log' design document, in order of preference:
+# the search criteria giving the key prefix, and the view name.
+# The last item of each key is the timestamp.
+LOG_SEARCHES = [(('doc', 'field'), 'log/doc_field'),
+                (('doc',), 'log/doc_timestamp'),
+                (('field',), 'log/field'),
+                (('operator',), 'log/operator'),
+                (('doctype',), 'log/doctype'),
+                ((), 'log/timestamp')]
@@ -17,6 +17,11 @@ if __name__ == '__main__':
     print 'Project', project['projectid'], project.get('title', '[no title]')
     answer = raw_input('really delete? (y/n) > ')
     if utils.to_bool(answer):
-        utils.delete_project(db, project)
-        print 'deleted'
+        def progress(count, total):
+            sys.stdout.write("\rdeleted {0} of {1} documents".format(count,
+                                                                     total))
+            sys.stdout.flush()
+        count = utils.delete_project(db, project, progress=progress)
+        print
+        print 'deleted', count, 'documents'
 
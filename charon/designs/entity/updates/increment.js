@@ -0,0 +1,26 @@
+/* Charon
+   Update handler: add the numbers given in 'increment' of the JSON
+   request body to the fields, and set the fields given in 'set'.
+   Response: the document id and the new values of the incremented
+   fields. The new revision is in the response header X-Couch-Update-NewRev.
+*/
+function(doc, req) {
+    var headers = {'Content-Type': 'application/json'};
+    if (!doc) return [null, {code: 404, headers: headers,
+			     body: JSON.stringify({error: 'not_found',
+						   reason: 'missing'})}];
+    var data = JSON.parse(req.body);
+    var values = {};
+    for (var key in data.increment || {}) {
+	if (key.charAt(0) === '_') continue;
+	doc[key] = (Number(doc[key]) || 0) + Number(data.increment[key]);
+	values[key] = doc[key];
+    };
+    for (var key in data.set || {}) {
+	if (key.charAt(0) === '_') continue;
+	doc[key] = data.set[key];
+    };
+    return [doc, {headers: headers,
+		  body: JSON.stringify({ok: true, id: doc._id,
+					values: values})}];
+}
@@ -0,0 +1,31 @@
+/* Charon
+   Update handler: set the fields given in 'set' of the JSON request body,
+   in the current revision of the document, provided that the current
+   value of each field in 'base' is the value given there, or already
+   the new value.
+   Response: the document id, or 409 if a field was changed by other.
+   The new revision is in the response header X-Couch-Update-NewRev.
+*/
+function(doc, req) {
+    var headers = {'Content-Type': 'application/json'};
+    if (!doc) return [null, {code: 404, headers: headers,
+			     body: JSON.stringify({error: 'not_found',
+						   reason: 'missing'})}];
+    var data = JSON.parse(req.body);
+    var set = data.set || {};
+    for (var key in data.base || {}) {
+	var current = JSON.stringify(doc[key] === undefined ? null : doc[key]);
+	if (current !== JSON.stringify(data.base[key]) &&
+	    current !== JSON.stringify(set[key] === undefined ? null : set[key])) {
+	    return [null, {code: 409, headers: headers,
+			   body: JSON.stringify({error: 'conflict',
+						 reason: "field '" + key + "' changed by other"})}];
+	};
+    };
+    for (var key in set) {
+	if (key.charAt(0) === '_') continue;
+	doc[key] = set[key];
+    };
+    return [doc, {headers: headers,
+		  body: JSON.stringify({ok: true, id: doc._id})}];
+}
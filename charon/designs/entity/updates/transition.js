@@ -0,0 +1,30 @@
+/* Charon
+   Update handler: set the status 'field' given in the JSON request body
+   to the value 'to', provided that its current value is among those
+   in 'from', if given. Also set the fields given in 'set'.
+   Response: the document id, or 409 if the transition is not allowed.
+   The new revision is in the response header X-Couch-Update-NewRev.
+*/
+function(doc, req) {
+    var headers = {'Content-Type': 'application/json'};
+    if (!doc) return [null, {code: 404, headers: headers,
+			     body: JSON.stringify({error: 'not_found',
+						   reason: 'missing'})}];
+    var data = JSON.parse(req.body);
+    if (data.from) {
+	var current = doc[data.field];
+	if (current === undefined) current = null;
+	if (data.from.indexOf(current) < 0) {
+	    return [null, {code: 409, headers: headers,
+			   body: JSON.stringify({error: 'conflict',
+						 reason: 'transition not allowed from ' + current})}];
+	};
+    };
+    doc[data.field] = data.to;
+    for (var key in data.set || {}) {
+	if (key.charAt(0) === '_') continue;
+	doc[key] = data.set[key];
+    };
+    return [doc, {headers: headers,
+		  body: JSON.stringify({ok: true, id: doc._id})}];
+}
@@ -0,0 +1,22 @@
+/* Charon
+   Index project, sample, libprep and seqrun documents by their path:
+   [projectid], [projectid, sampleid], [projectid, sampleid, libprepid]
+   or [projectid, sampleid, libprepid, seqrunid].
+   Value: null.
+*/
+function(doc) {
+    switch (doc.charon_doctype) {
+    case 'project':
+	emit([doc.projectid], null);
+	break;
+    case 'sample':
+	emit([doc.projectid, doc.sampleid], null);
+	break;
+    case 'libprep':
+	emit([doc.projectid, doc.sampleid, doc.libprepid], null);
+	break;
+    case 'seqrun':
+	emit([doc.projectid, doc.sampleid, doc.libprepid, doc.seqrunid], null);
+	break;
+    };
+}
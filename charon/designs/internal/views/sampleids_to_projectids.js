@@ -0,0 +1,8 @@
+/* Charon
+   Index sample documents by sampleid.
+   Value: projectid.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'sample') return;
+    emit(doc.sampleid, doc.projectid);
+}
@@ -0,0 +1,10 @@
+/* Charon
+   Index log documents by doc, each changed field, and timestamp.
+   Value: the new value of the field.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'log') return;
+    for (var key in doc.changed) {
+	emit([doc.doc, key, doc.timestamp], doc.changed[key]);
+    };
+}
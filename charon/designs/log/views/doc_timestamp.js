@@ -0,0 +1,8 @@
+/* Charon
+   Index log documents by doc and timestamp, for paging in time order.
+   Value: null.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'log') return;
+    emit([doc.doc, doc.timestamp], null);
+}
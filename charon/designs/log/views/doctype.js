@@ -0,0 +1,8 @@
+/* Charon
+   Index log documents by the doctype of the changed document, and timestamp.
+   Value: null.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'log') return;
+    emit([doc.doctype, doc.timestamp], null);
+}
@@ -0,0 +1,10 @@
+/* Charon
+   Index log documents by each changed field, and timestamp.
+   Value: null.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'log') return;
+    for (var key in doc.changed) {
+	emit([key, doc.timestamp], null);
+    };
+}
@@ -0,0 +1,9 @@
+/* Charon
+   Index log documents by operator and timestamp.
+   Value: null.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'log') return;
+    if (!doc.operator) return;
+    emit([doc.operator, doc.timestamp], null);
+}
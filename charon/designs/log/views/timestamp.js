@@ -0,0 +1,8 @@
+/* Charon
+   Index log documents by timestamp.
+   Value: null.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'log') return;
+    emit([doc.timestamp], null);
+}
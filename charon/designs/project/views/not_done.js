@@ -1,6 +1,9 @@
-/*emits only not done projects*/
+/* Charon
+   Index the projects that are not done, i.e. not CLOSED.
+   Value: null; use include_docs or the entity cache for the project.
+*/
 function(doc) {
-    if (doc.charon_doctype === 'project' && doc.status !== 'CLOSED'){
-          emit(doc.projectid, doc);
-    }
+    if (doc.charon_doctype !== 'project') return;
+    if (doc.status === 'CLOSED') return;
+    emit(doc.projectid, null);
 }
@@ -0,0 +1,9 @@
+/* Charon
+   Index delivered sample documents by projectid.
+   Value: 1.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'sample') return;
+    if (doc.delivery_status !== 'DELIVERED') return;
+    emit(doc.projectid, 1);
+}
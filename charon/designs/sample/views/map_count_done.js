@@ -1,7 +1,9 @@
 /* Charon
-   Index sample documents by projectid.
+   Index sample documents having sequencing done (status STALE) by projectid.
    Value: 1.
 */
 function(doc) {
-    if (doc.charon_doctype === 'sample' && doc.status === "DONE") emit(doc.projectid, 1);
+    if (doc.charon_doctype !== 'sample') return;
+    if (doc.status !== 'STALE') return;
+    emit(doc.projectid, 1);
 }
@@ -1,7 +1,10 @@
-/*Returns all samples that have a 'not done' status*/
-
+/* Charon
+   Index the samples that are not done, i.e. not STALE:
+   [projectid, sampleid].
+   Value: null; use include_docs or the entity cache for the sample.
+*/
 function(doc) {
-        if (doc.charon_doctype === 'sample' && doc.status !== 'DONE'){ 
-            emit([doc.projectid, doc.sampleid], doc);
-        }
+    if (doc.charon_doctype !== 'sample') return;
+    if (doc.status === 'STALE') return;
+    emit([doc.projectid, doc.sampleid], null);
 }
@@ -0,0 +1,15 @@
+/* Charon
+   Index seqrun documents by [projectid, sampleid], for the sample values
+   derived from its seqruns. Failed seqruns do not count for coverage
+   or reads.
+   Value: [mean autosomal coverage, total reads, 1 if alignment not done].
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'seqrun') return;
+    var failed = doc.alignment_status === 'FAILED';
+    var done = failed || doc.alignment_status === 'DONE';
+    emit([doc.projectid, doc.sampleid],
+	 [failed ? 0 : Number(doc.mean_autosomal_coverage) || 0,
+	  failed ? 0 : Number(doc.total_reads) || 0,
+	  done ? 0 : 1]);
+}
@@ -0,0 +1 @@
+_sum
\ No newline at end of file
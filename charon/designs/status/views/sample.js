@@ -0,0 +1,13 @@
+/* Charon
+   Index sample documents by each of their status fields:
+   [field, value, projectid, sampleid].
+   Value: null.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'sample') return;
+    var fields = $STATUS_FIELDS; // From constants.STATUS_FIELDS.
+    for (var i=0; i<fields.length; i++) {
+	emit([fields[i], doc[fields[i]] || null, doc.projectid, doc.sampleid],
+	     null);
+    };
+}
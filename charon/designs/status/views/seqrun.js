@@ -0,0 +1,14 @@
+/* Charon
+   Index seqrun documents by each of their status fields:
+   [field, value, projectid, sampleid, libprepid, seqrunid].
+   Value: null.
+*/
+function(doc) {
+    if (doc.charon_doctype !== 'seqrun') return;
+    var fields = $STATUS_FIELDS; // From constants.STATUS_FIELDS.
+    for (var i=0; i<fields.length; i++) {
+	emit([fields[i], doc[fields[i]] || null,
+	      doc.projectid, doc.sampleid, doc.libprepid, doc.seqrunid],
+	     null);
+    };
+}
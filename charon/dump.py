@@ -8,8 +8,9 @@ from charon import utils
 from charon import constants
 
 
-def dump(db, filename):
+def dump(db, filename, logdb=None):
     """Dump contents of the database to a tar file, optionally compressed.
+    The contents of the log database, if separate, are also dumped.
     Return the number of items, and the number of attachment files dumped."""
     count_items = 0
     count_files = 0
@@ -20,9 +21,12 @@ def dump(db, filename):
     else:
         mode = 'w'
     outfile = tarfile.open(filename, mode=mode)
-    for key in db:
+    items = [(db, key) for key in db]
+    if logdb is not None and logdb is not db:
+        items.extend([(logdb, key) for key in logdb])
+    for source, key in items:
         if not constants.IUID_RX.match(key): continue
-        doc = db[key]
+        doc = source[key]
         del doc['_rev']
         info = tarfile.TarInfo(doc['_id'])
         data = json.dumps(doc)
@@ -31,7 +35,7 @@ def dump(db, filename):
         count_items += 1
         for attname in doc.get('_attachments', dict()):
             info = tarfile.TarInfo("{0}_att/{1}".format(doc['_id'], attname))
-            attfile = db.get_attachment(doc, attname)
+            attfile = source.get_attachment(doc, attname)
             data = attfile.read()
             attfile.close()
             info.size = len(data)
@@ -40,9 +44,10 @@ def dump(db, filename):
     outfile.close()
     return count_items, count_files
 
-def undump(db, filename):
+def undump(db, filename, logdb=None):
     """Reverse of dump; load all items from a tar file.
-    Items are just added to the database, ignoring existing items."""
+    Items are just added to the database, ignoring existing items.
+    Log items are added to the log database, if given."""
     count_items = 0
     count_files = 0
     attachments = dict()
@@ -62,6 +67,11 @@ def undump(db, filename):
                 rows = db.view('user/email', key=doc['email'])
                 if len(list(rows)) != 0: continue
             atts = doc.pop('_attachments', dict())
+            if logdb is not None and \
+               doc[constants.DB_DOCTYPE] == constants.LOG:
+                logdb.save(doc)
+                count_items += 1
+                continue
             db.save(doc)
             count_items += 1
             for attname, attinfo in atts.items():
@@ -83,5 +93,5 @@ if __name__ == '__main__':
         filename = sys.argv[2]
     else:
         filename = 'dump.tar.gz'
-    count_items, count_files = dump(db, filename)
+    count_items, count_files = dump(db, filename, logdb=utils.get_log_db())
     print 'dumped', count_items, 'items and', count_files, 'files to', filename
@@ -4,6 +4,7 @@ import logging
 import json
 
 import tornado.web
+import tornado.gen
 import couchdb
 
 from . import constants
@@ -14,87 +15,53 @@ from .api import ApiRequestHandler
 
 import time
 
+@tornado.gen.coroutine
 def sampleStats(handler, projectid=None):
-    data={}
+    """Return the sample statistics for the whole database, or one project,
+    without blocking. One multi-key query for the summary counts, and one
+    grouped query for the number of sequenced samples."""
+    names = dict(tot='TOTAL',
+                 ab='ABORTED',
+                 passed='ANALYZED',
+                 passed_unab='ANALYZED_UNAB',
+                 failed='FAILED',
+                 runn='UNDER_ANALYSIS',
+                 cov='TOTAL_COV')
     if projectid:
-        total=projectid+"_TOTAL"
-        aborted=projectid+"_ABORTED"
-        passed=projectid+"_ANALYZED"
-        passed_unab=projectid+"_ANALYZED_UNAB"
-        failed=projectid+"_FAILED"
-        running=projectid+"_UNDER_ANALYSIS"
-        coverage=projectid+"_TOTAL_COV"
+        names = dict([(k, projectid + '_' + v) for k, v in names.items()])
+        seqparams = dict(startkey=[projectid, ''],
+                         endkey=[projectid, constants.HIGH_CHAR])
     else:
-        total="TOTAL"
-        aborted="ABORTED"
-        passed="ANALYZED"
-        passed_unab="ANALYZED_UNAB"
-        failed="FAILED"
-        running="UNDER_ANALYSIS"
-        coverage="TOTAL_COV"
-
-    view = handler.db.view('sample/summary_count')
-    seqview = handler.db.view('sample/sequenced', group=True)
-    try:
-        data['tot'] = view[total].rows[0].value
-    except (KeyError, IndexError):
-        data['tot']=0
-    try:
-        data['ab'] = view[aborted].rows[0].value
-    except (KeyError, IndexError):
-        data['ab']=0
-    try:
-        data['passed'] = view[passed].rows[0].value
-    except (KeyError, IndexError):
-        data['passed']=0
-    try:
-        data['passed_unab'] = view[passed_unab].rows[0].value
-    except (KeyError, IndexError):
-        data['passed_unab']=0
-    try:
-        data['failed'] = view[failed].rows[0].value
-    except (KeyError, IndexError):
-        data['failed']=0
+        seqparams = dict()
+    rows, seqrows = yield [
+        handler.adb.view('sample/summary_count', group=True,
+                         keys=names.values()),
+        handler.adb.view('sample/sample_sequenced', group=True, **seqparams)]
+    values = dict([(r.key, r.value) for r in rows])
+    data = dict([(k, values.get(v) or 0) for k, v in names.items()])
     data['ana'] = data['passed'] + data['failed']
-    try:
-        data['runn'] = view[running].rows[0].value
-    except (KeyError, IndexError):
-        data['runn']=0
-    try:
-        seq=0
-        if projectid:
-            for row in seqview[[projectid, '']:[projectid, constants.HIGH_CHAR]]:
-                seq+=1
-        else:
-            for row in seqview:
-                seq+=1
-
-        data['seq'] = seq
-    except (KeyError, IndexError):
-        data['seq']=0
-    try:
-        data['cov'] = view[coverage].rows[0].value
-    except (KeyError, IndexError):
-        data['cov']=0
+    data['seq'] = len(seqrows)
     data['hge'] = int(data['cov'] / 30)
-
-    return data
+    raise tornado.gen.Return(data)
 
 
 class SummaryAPI(ApiRequestHandler):
     """Summarizes data for the whole DB, or one project"""
+    @tornado.gen.coroutine
     def get(self):
         """returns stats from the DB as JSON data  """
         project_id=self.get_argument("projectid", default=None)
-        self.write(json.dumps(sampleStats(self, project_id)))    
+        data = yield sampleStats(self, project_id)
+        self.write(json.dumps(data))    
 
 
 class Summary(RequestHandler):
 
     @tornado.web.authenticated
+    @tornado.gen.coroutine
     def get(self):
         project_id=self.get_argument("projectid", default=None)
-        data=sampleStats(self, project_id)
+        data = yield sampleStats(self, project_id)
         self.render('summary.html', data=data)
 
 
@@ -3,11 +3,15 @@
 1) Wipeout the old database.
 2) Load the design documents.
 3) Load the dump file, if any.
+The separate log database, if any, is created if it does not exist.
 """
 
 import os
 
+import couchdb
+
 from charon import constants
+from charon import settings
 from charon import utils
 from charon.load_designs import load_designs
 from charon.dump import undump
@@ -49,10 +53,24 @@ if __name__ == '__main__':
         sys.exit('too many arguments')
     utils.load_settings(filepath=filepath)
 
+    name = settings.get('LOG_DATABASE')
+    if name:
+        server = couchdb.Server(settings['DB_SERVER'])
+        if name not in server:
+            server.create(name)
+            print 'created log database', name
     db = utils.get_db()
     wipeout_database(db)
     print 'wiped out database'
-    load_designs(db)
+    logdb = utils.get_log_db()
+    if logdb is db:
+        load_designs(db)
+        logdb = None
+    else:
+        wipeout_database(logdb)
+        print 'wiped out log database'
+        load_designs(db, exclude=[constants.LOG])
+        load_designs(logdb, designs=[constants.LOG])
     print 'loaded designs'
     default = 'dump.tar.gz'
     if options.force:
@@ -62,7 +80,7 @@ if __name__ == '__main__':
         if not filename:
             filename = default
     if os.path.exists(filename):
-        count_items, count_files = undump(db, filename)
+        count_items, count_files = undump(db, filename, logdb=logdb)
         print 'undumped', count_items, 'items and', count_files, 'files from', filename
     else:
         print 'no such file to undump'
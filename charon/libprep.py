@@ -4,6 +4,7 @@ import logging
 import json
 
 import tornado.web
+import tornado.gen
 import couchdb
 
 from . import constants
@@ -17,13 +18,10 @@ from .saver import *
 class LibprepidField(IdField):
     "The unique identifier for the libprep within the sample."
 
-    def check_valid(self, saver, value):
-        "Also check uniqueness."
-        super(LibprepidField, self).check_valid(saver, value)
-        key = (saver.project['projectid'], saver.sample['sampleid'], value)
-        view = saver.db.view('libprep/libprepid')
-        if len(list(view[key])) > 0:
-            raise ValueError('not unique')
+    unique_view = 'libprep/libprepid'
+
+    def get_unique_key(self, saver, value):
+        return (saver.project['projectid'], saver.sample['sampleid'], value)
 
 
 class LibprepSaver(Saver):
@@ -64,7 +62,7 @@ class Libprep(RequestHandler):
     def get(self, projectid, sampleid, libprepid):
         libprep = self.get_libprep(projectid, sampleid, libprepid)
         seqruns = self.get_seqruns(projectid, sampleid, libprepid)
-        logs = self.get_logs(libprep['_id']) # XXX limit?
+        logs = self.get_logs(libprep['_id'])
         self.render('libprep.html',
                     libprep=libprep,
                     seqruns=seqruns,
@@ -140,44 +138,56 @@ class ApiLibprep(ApiRequestHandler):
 
     saver = LibprepSaver
 
+    @tornado.gen.coroutine
     def get(self, projectid, sampleid, libprepid):
         """Return the libprep data as JSON.
         Return HTTP 404 if no such libprep, sample or project."""
-        libprep = self.get_libprep(projectid, sampleid, libprepid)
+        libprep = yield self.fetch_libprep(projectid, sampleid, libprepid)
         if not libprep: return
         self.add_libprep_links(libprep)
         self.write(libprep)
 
+    @tornado.gen.coroutine
     def put(self, projectid, sampleid, libprepid):
         """Update the libprep with the given JSON data.
         Return HTTP 204 "No Content".
         Return HTTP 400 if the input data is invalid.
         Return HTTP 409 if there is a document revision conflict."""
         try:
-            libprep = self.get_libprep(projectid, sampleid, libprepid)
+            # Resolved together in one database request.
+            libprep, sample, project = yield [
+                self.loader.fetch(projectid, sampleid, libprepid),
+                self.loader.fetch(projectid, sampleid),
+                self.loader.fetch(projectid)]
             data = json.loads(self.request.body)
         except Exception, msg:
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(doc=libprep, rqh=self) as saver:
-                    saver.store(data=data)
+                saver = self.saver(doc=libprep, rqh=self, sample=sample)
+                saver.store(data=data)
+                yield saver.save_async()
             except ValueError, msg:
                 self.send_error(400, reason=str(msg))
             except IOError, msg:
                 self.send_error(409, reason=str(msg))
             else:
-                self.set_status(204)
+                self.set_updated_status(saver)
     def delete(self, projectid, sampleid, libprepid):
         """NOTE: This is for unit test purposes only!
         Delete the libprepand all of its dependent entities.
-        Returns HTTP 204 "No Content"."""
+        Returns HTTP 204 "No Content".
+        Returns HTTP 503 if the log entries could not be written first."""
         libprep= self.get_libprep(projectid, sampleid, libprepid)
         if not libprep: return
-        utils.delete_libprep(self.db, libprep)
+        try:
+            count = utils.delete_libprep(self.db, libprep)
+        except IOError, msg:
+            self.send_error(503, reason=str(msg))
+            return
         logging.debug("deleted libprep {0}, {1}, {2}",
                       projectid, sampleid, libprepid)
-        self.set_status(204)
+        self.set_deleted_status(count)
 
 
 class ApiLibprepCreate(ApiRequestHandler):
@@ -222,9 +232,10 @@ class ApiLibprepCreate(ApiRequestHandler):
 class ApiProjectLibpreps(ApiRequestHandler):
     "Access to all libpreps for a project."
 
+    @tornado.gen.coroutine
     def get(self, projectid):
         "Return a list of all libpreps for the given project."
-        libpreps = self.get_libpreps(projectid)
+        libpreps = yield self.fetch_libpreps(projectid)
         for libprep in libpreps:
             self.add_libprep_links(libprep)
         self.write(dict(libpreps=libpreps))
@@ -233,9 +244,10 @@ class ApiProjectLibpreps(ApiRequestHandler):
 class ApiSampleLibpreps(ApiRequestHandler):
     "Access to all libpreps for a sample."
 
+    @tornado.gen.coroutine
     def get(self, projectid, sampleid):
         "Return a list of all libpreps for the given sample and project."
-        libpreps = self.get_libpreps(projectid, sampleid)
+        libpreps = yield self.fetch_libpreps(projectid, sampleid)
         for libprep in libpreps:
             self.add_libprep_links(libprep)
         self.write(dict(libpreps=libpreps))
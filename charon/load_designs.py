@@ -1,52 +1,332 @@
-" Charon: Load all CouchDB database design documents. "
+""" Charon: Load all CouchDB database design documents.
+Either directly, replacing the design documents in place, or staged:
+1) Save the changed design documents under staging ids.
+2) Build the indexes of the staged design documents.
+3) Swap the staged design documents into the live ids. The indexes
+   are keyed by the view code, so the live ones use the built indexes.
+"""
 
 import os
+import json
+import time
+import socket
 import logging
+import threading
 
 import couchdb
 
+from charon import settings
+from charon import constants
 
-def load_designs(db, root='designs'):
+# Suffix of the design document name for its staged version.
+STAGED = '_staged'
+
+
+def load_designs(db, root='designs', designs=None, exclude=[]):
+    """Load the design documents into the database; those named,
+    if given, else all except those excluded."""
     for design in os.listdir(root):
-        views = dict()
-        path = os.path.join(root, design)
-        if not os.path.isdir(path): continue
-        path = os.path.join(root, design, 'views')
-        for filename in os.listdir(path):
-            name, ext = os.path.splitext(filename)
-            if ext != '.js': continue
-            with open(os.path.join(path, filename)) as codefile:
-                code = codefile.read()
-            if name.startswith('map_'):
-                name = name[len('map_'):]
-                key = 'map'
-            elif name.startswith('reduce_'):
-                name = name[len('reduce_'):]
-                key = 'reduce'
-            else:
-                key = 'map'
-            views.setdefault(name, dict())[key] = code
+        if designs is not None and design not in designs: continue
+        if design in exclude: continue
+        if not os.path.isdir(os.path.join(root, design)): continue
+        views, updates = read_design(root, design)
         id = "_design/%s" % design
         try:
             doc = db[id]
         except couchdb.http.ResourceNotFound:
             logging.debug("loading %s", id)
-            db.save(dict(_id=id, views=views))
+            doc = dict(_id=id, views=views)
+            if updates:
+                doc['updates'] = updates
+            db.save(doc)
         else:
-            if doc['views'] != views:
+            if doc['views'] != views or doc.get('updates', {}) != updates:
                 doc['views'] = views
+                if updates:
+                    doc['updates'] = updates
+                else:
+                    doc.pop('updates', None)
                 logging.debug("updating %s", id)
                 db.save(doc)
             else:
                 logging.debug("no change %s", id)
 
 
+def get_changed(db, root='designs', designs=None, exclude=[]):
+    """Return the list of (name, views, updates) for the design documents
+    in the files which differ from those in the database."""
+    result = []
+    for design in sorted(os.listdir(root)):
+        if designs is not None and design not in designs: continue
+        if design in exclude: continue
+        if not os.path.isdir(os.path.join(root, design)): continue
+        views, updates = read_design(root, design)
+        doc = db.get("_design/%s" % design) or dict()
+        if doc.get('views') != views or doc.get('updates', {}) != updates:
+            result.append((design, views, updates))
+    return result
+
+def stage_designs(db, root='designs', designs=None, exclude=[]):
+    """Save the design documents which differ from those in the database
+    under the staging ids '_design/<name>_staged'. The live design
+    documents are not changed. Return the names of those staged."""
+    result = []
+    for design, views, updates in get_changed(db, root, designs, exclude):
+        id = "_design/%s%s" % (design, STAGED)
+        doc = db.get(id) or dict(_id=id)
+        doc['views'] = views
+        if updates:
+            doc['updates'] = updates
+        else:
+            doc.pop('updates', None)
+        logging.debug("staging %s", id)
+        db.save(doc)
+        result.append(design)
+    return result
+
+def get_staged(db):
+    "Return the names of the staged design documents."
+    rows = db.view('_all_docs', startkey='_design/', endkey='_design0')
+    return [r.id[len('_design/'):-len(STAGED)] for r in rows
+            if r.id.endswith(STAGED)]
+
+def build_staged(db, progress=None, interval=5.0):
+    """Build the indexes of the staged design documents, one at a time,
+    by querying a view of each in a background thread. The function
+    'progress', if given, is called with the design name and the percent
+    done every 'interval' seconds. Return when all indexes are built."""
+    for design in get_staged(db):
+        id = "_design/%s%s" % (design, STAGED)
+        views = db[id].get('views')
+        if not views: continue
+        thread = threading.Thread(target=query_design,
+                                  args=(db, design + STAGED, views))
+        thread.daemon = True
+        thread.start()
+        while thread.is_alive():
+            thread.join(interval)
+            if progress:
+                try:
+                    percent = get_indexing(get_active_tasks(db), id)
+                except IOError, msg:
+                    logging.debug("no active tasks: %s", msg)
+                    percent = None
+                progress(design, percent or 0)
+        if progress:
+            progress(design, 100)
+
+def query_design(db, design, views):
+    """Query a view of the design document, waiting until its index
+    has been built. A timeout of the request is not an error;
+    the index is still being built."""
+    name = sorted(views)[0]
+    if 'reduce' in views[name]:
+        params = dict(limit=1, reduce=False)
+    else:
+        params = dict(limit=1)
+    while True:
+        try:
+            list(db.view("%s/%s" % (design, name), **params))
+            return
+        except socket.error:            # Includes timeout.
+            logging.debug("waiting for index %s", design)
+
+def swap_staged(db):
+    """Save the staged design documents into the live ids, and delete the
+    staged ones. Raise ValueError if any staged index is not yet built,
+    or is being updated. Return the names of those swapped."""
+    designs = get_staged(db)
+    tasks = get_active_tasks(db)
+    for design in designs:
+        id = "_design/%s%s" % (design, STAGED)
+        if not is_built(db, id) or get_indexing(tasks, id) is not None:
+            raise ValueError("index of %s not yet built" % design)
+    for design in designs:
+        staged = db["_design/%s%s" % (design, STAGED)]
+        id = "_design/%s" % design
+        doc = db.get(id) or dict(_id=id)
+        doc['views'] = staged['views']
+        if staged.get('updates'):
+            doc['updates'] = staged['updates']
+        else:
+            doc.pop('updates', None)
+        logging.debug("swapping in %s", id)
+        db.save(doc)
+        db.delete(staged)
+    if designs:
+        db.cleanup()                    # Remove the old index files.
+    return designs
+
+def get_active_tasks(db):
+    """Return the list of active tasks of the CouchDB server, read by one
+    request using the connection of the database handle.
+    Raise IOError if not available; the CouchDB user must be allowed
+    to read them, i.e. be a server admin in CouchDB 1.x."""
+    server = couchdb.Server(settings['DB_SERVER'],
+                            session=db.resource.session)
+    try:
+        return server.tasks()
+    except Exception, msg:
+        raise IOError("no active tasks: %s" % msg)
+
+def get_indexing(tasks, id):
+    """Return the percent done of the index build for the design document,
+    given the active tasks, or None if it is not being built."""
+    done = [t.get('progress', 0) for t in tasks
+            if t.get('type') == 'indexer' and t.get('design_document') == id]
+    if not done: return None
+    return sum(done) / len(done)
+
+def is_built(db, id):
+    """Has the index of the design document been built? It need not be
+    up to date; CouchDB updates an index only when it is queried."""
+    try:
+        seq = get_seq(db.info()['update_seq'])
+        status, headers, info = db.resource(id, '_info').get_json()
+        indexed = get_seq(info['view_index']['update_seq'])
+    except Exception, msg:
+        logging.debug("no index info for %s: %s", id, msg)
+        return False
+    return indexed > 0 or seq == 0
+
+def get_seq(seq):
+    """Return the number of an update sequence; an integer in CouchDB 1.x,
+    a string starting with the number in CouchDB 2.x."""
+    if isinstance(seq, (int, long)): return seq
+    return int(str(seq).split('-', 1)[0])
+
+# Whether a deployed design document is the same as in the design files,
+# keyed by (database name, root, design name), with the revision compared.
+_current = dict()
+# The views and updates read from the design files, keyed by (root, design).
+_files = dict()
+
+def get_deployed(db):
+    """Return a lookup of the revisions of the design documents in the
+    database by name, using one request."""
+    rows = db.view('_all_docs', startkey='_design/', endkey='_design0')
+    return dict([(r.id[len('_design/'):], r.value['rev']) for r in rows])
+
+def is_current(db, root, design, rev):
+    """Is the design document at the given revision the same as in the
+    design files? The files are read once per process, and the design
+    document only when its revision has changed since the last call."""
+    key = (db.name, root, design)
+    try:
+        if _current[key][0] == rev: return _current[key][1]
+    except KeyError:
+        pass
+    try:
+        views, updates = _files[(root, design)]
+    except KeyError:
+        views, updates = _files[(root, design)] = read_design(root, design)
+    doc = db.get("_design/%s" % design) or dict()
+    current = doc.get('views') == views and doc.get('updates', {}) == updates
+    _current[key] = (rev, current)
+    return current
+
+def get_status(db, tasks, root='designs', designs=None, exclude=[]):
+    """Return the status of the design documents in the database, given
+    the active tasks: a lookup by name of whether the live design document
+    is 'current', i.e. same as in the files, whether it is 'staged', its
+    'indexing' percent done, or None if the index is not being built,
+    and whether it is 'ready', i.e. current and not being indexed.
+    The state of the index is otherwise not considered; CouchDB updates
+    an index only when it is queried, so one never queried is not built.
+    Uses one request, and one more per design document changed since
+    the last call."""
+    deployed = get_deployed(db)
+    result = dict()
+    for design in os.listdir(root):
+        if designs is not None and design not in designs: continue
+        if design in exclude: continue
+        if not os.path.isdir(os.path.join(root, design)): continue
+        id = "_design/%s" % design
+        rev = deployed.get(design)
+        current = rev is not None and is_current(db, root, design, rev)
+        indexing = get_indexing(tasks, id)
+        result[design] = dict(current=current,
+                              staged=design + STAGED in deployed,
+                              indexing=indexing,
+                              ready=current and indexing is None)
+    return result
+
+def read_design(root, design):
+    """Read the view and update handler code for the design document
+    from its directory. Return the views and the updates.
+    In the views of the 'status' design, '$STATUS_FIELDS' is replaced
+    by the status fields for the doctype given by the view name,
+    so that the fields are defined in one place only."""
+    views = dict()
+    path = os.path.join(root, design, 'views')
+    for filename in os.listdir(path):
+        name, ext = os.path.splitext(filename)
+        if ext != '.js': continue
+        with open(os.path.join(path, filename)) as codefile:
+            code = codefile.read()
+        if design == 'status':
+            code = code.replace('$STATUS_FIELDS',
+                                json.dumps(constants.STATUS_FIELDS[name]))
+        if name.startswith('map_'):
+            name = name[len('map_'):]
+            key = 'map'
+        elif name.startswith('reduce_'):
+            name = name[len('reduce_'):]
+            key = 'reduce'
+        else:
+            key = 'map'
+        views.setdefault(name, dict())[key] = code
+    updates = dict()
+    path = os.path.join(root, design, 'updates')
+    if os.path.isdir(path):
+        for filename in os.listdir(path):
+            name, ext = os.path.splitext(filename)
+            if ext != '.js': continue
+            with open(os.path.join(path, filename)) as codefile:
+                updates[name] = codefile.read()
+    return views, updates
+
+
 if __name__ == '__main__':
     import sys
+    import optparse
     from charon import utils
+    parser = optparse.OptionParser(usage='usage: %prog [options] [settings]')
+    parser.add_option('--stage', action='store_true', dest='stage',
+                      default=False,
+                      help='save changed design documents under staging ids')
+    parser.add_option('--build', action='store_true', dest='build',
+                      default=False,
+                      help='build the indexes of the staged design documents')
+    parser.add_option('--swap', action='store_true', dest='swap',
+                      default=False,
+                      help='swap the staged design documents into live ids')
+    parser.add_option('--deploy', action='store_true', dest='deploy',
+                      default=False,
+                      help='stage, build and swap')
+    (options, args) = parser.parse_args()
     try:
-        utils.load_settings(filepath=sys.argv[1])
+        utils.load_settings(filepath=args[0])
     except IndexError:
         utils.load_settings()
     db = utils.get_db()
-    load_designs(db)
+    logdb = utils.get_log_db()
+    if logdb is db:
+        targets = [(db, dict())]
+    else:
+        targets = [(db, dict(exclude=[constants.LOG])),
+                   (logdb, dict(designs=[constants.LOG]))]
+    staged = options.stage or options.build or options.swap or options.deploy
+    def progress(design, percent):
+        print "building index %s: %s%%" % (design, percent)
+        sys.stdout.flush()
+    for target, kwargs in targets:
+        if not staged:
+            load_designs(target, **kwargs)
+            continue
+        if options.stage or options.deploy:
+            print 'staged', ', '.join(stage_designs(target, **kwargs)) or 'none'
+        if options.build or options.deploy:
+            build_staged(target, progress=progress)
+        if options.swap or options.deploy:
+            print 'swapped', ', '.join(swap_staged(target)) or 'none'
@@ -0,0 +1,150 @@
+""" Charon: Request-scoped batching loader of entities.
+Lookups of projects, samples, libpreps and seqruns are queued and then
+resolved together by one multi-key query of the 'entity/path' view,
+instead of one view query per entity.
+"""
+
+import logging
+
+import tornado.web
+import tornado.gen
+import tornado.ioloop
+import tornado.concurrent
+
+from . import cache as entitycache
+
+
+# The view and request cache used for each length of entity path.
+VIEWNAMES = {1: 'project/projectid',
+             2: 'sample/sampleid',
+             3: 'libprep/libprepid',
+             4: 'seqrun/seqrunid'}
+CACHES = {1: '_projects',
+          2: '_samples',
+          3: '_libpreps',
+          4: '_seqruns'}
+
+
+class Loader(object):
+    """Batching loader for a request handler.
+    An entity is identified by its path: (projectid, sampleid, ...).
+    Loaded entities are put into the request caches of the handler,
+    and into the process-wide entity cache."""
+
+    def __init__(self, rqh):
+        self.rqh = rqh
+        self.queued = []
+        self.futures = dict()
+        self.scheduled = False
+        self.loaded = []                # Keep the weakly cached docs alive.
+
+    def queue(self, *path):
+        "Queue the lookup of the entity at the given path."
+        path = tuple(path)
+        assert len(path) in VIEWNAMES
+        if path not in self.queued:
+            self.queued.append(path)
+
+    def load(self):
+        """Resolve all queued lookups, with at most one database request.
+        Return a lookup of the found entities keyed by path."""
+        paths, self.queued = self.queued, []
+        result, missing = self.lookup(paths)
+        if missing:
+            view = self.rqh.db.view('entity/path', include_docs=True,
+                                    keys=[list(p) for p in missing])
+            result.update(self.store(view))
+        return result
+
+    @tornado.gen.coroutine
+    def load_async(self, paths):
+        "Non-blocking version of 'load' for the given paths."
+        result, missing = self.lookup(paths)
+        if missing:
+            rows = yield self.rqh.adb.view('entity/path', include_docs=True,
+                                           keys=[list(p) for p in missing])
+            result.update(self.store(rows))
+        raise tornado.gen.Return(result)
+
+    def fetch(self, *path):
+        """Return a Future for the entity at the given path. All lookups
+        made in the same IOLoop iteration are resolved together.
+        The Future raises HTTP 404 if no such entity."""
+        future = tornado.concurrent.Future()
+        self.futures.setdefault(tuple(path), []).append(future)
+        if not self.scheduled:
+            self.scheduled = True
+            tornado.ioloop.IOLoop.current().add_callback(self.dispatch)
+        return future
+
+    @tornado.gen.coroutine
+    def dispatch(self):
+        "Resolve the Futures of the lookups made since last dispatch."
+        self.scheduled = False
+        futures, self.futures = self.futures, dict()
+        try:
+            result = yield self.load_async(futures.keys())
+        except Exception, msg:
+            logging.debug("loader error: %s", msg)
+            for items in futures.values():
+                for future in items:
+                    future.set_exception(msg)
+            return
+        for path, items in futures.items():
+            for future in items:
+                try:
+                    future.set_result(result[path])
+                except KeyError:
+                    future.set_exception(tornado.web.HTTPError(
+                            404, reason="no such entity {0}".format(path)))
+
+    def lookup(self, paths):
+        """Get the entities available in the request caches or the entity
+        cache. Return a lookup of those, and the list of missing paths."""
+        result = dict()
+        missing = []
+        entities = entitycache.get_cache()
+        active = entitycache.is_active()
+        for path in paths:
+            cache = getattr(self.rqh, CACHES[len(path)])
+            key = self.cachekey(path)
+            try:
+                result[path] = cache[key]
+                continue
+            except KeyError:
+                pass
+            if active:
+                doc = entities.get(VIEWNAMES[len(path)], key)
+                if doc is not None:
+                    result[path] = self.keep(path, doc)
+                    continue
+            missing.append(path)
+        return result, missing
+
+    def store(self, rows):
+        "Store the docs of the 'entity/path' rows. Return lookup by path."
+        result = dict()
+        active = entitycache.is_active()
+        for row in rows:
+            if row.doc is None: continue   # Deleted meanwhile.
+            path = tuple(row.key)
+            result[path] = self.keep(path, row.doc)
+            if active:
+                entitycache.get_cache().put(VIEWNAMES[len(path)],
+                                            self.cachekey(path),
+                                            row.doc)
+        return result
+
+    def keep(self, path, doc):
+        "Put the doc into the request caches, and keep a reference to it."
+        cache = getattr(self.rqh, CACHES[len(path)])
+        cache[self.cachekey(path)] = doc
+        self.rqh._cache[doc['_id']] = doc
+        self.loaded.append(doc)
+        return doc
+
+    def cachekey(self, path):
+        "The request cache key for a path; the projectid alone for a project."
+        if len(path) == 1:
+            return path[0]
+        return path
@@ -0,0 +1,278 @@
+""" Charon: Write-behind writer of log entries.
+Log entries from all requests in the process are queued, and written
+to CouchDB in batches by a background thread. Each entry is first
+appended to a local spool file, from which it is recovered if CouchDB
+is unavailable, or if the process stops before the entry was written.
+"""
+
+import os
+import glob
+import json
+import time
+import Queue
+import logging
+import threading
+
+import couchdb
+
+from . import settings
+from . import utils
+
+
+class LogWriter(threading.Thread):
+    """Background thread writing queued log entries to the database
+    using one _bulk_docs request per batch. The queue is bounded; entries
+    beyond its capacity are kept only in the spool file, until written.
+    The spool file is cut to the entries not yet written when the part
+    already written exceeds 'spool_size' bytes."""
+
+    daemon = True
+
+    def __init__(self, db, spoolpath, queue_size=10000,
+                 batch_size=500, interval=1.0, retry_delay=5.0,
+                 spool_size=1000000):
+        super(LogWriter, self).__init__(name='LogWriter')
+        self.db = db
+        self.spoolpath = spoolpath
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.spool_size = spool_size
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.flushing = threading.Event()
+        # Offsets in the spool are counted from the start of the first
+        # spool file, so that they do not change when it is cut.
+        self.base = 0                   # Offset of the spool file start.
+        self.done = 0                   # All entries before are written.
+        self.overflow = None            # First entry in spool, not queue.
+        self.pending = self.read_spool(0) # Left from previous process?
+        if self.pending:
+            logging.info("recovered %s log entries from spool file %s",
+                         len(self.pending), self.spoolpath)
+        self.spool = open(self.spoolpath, 'a')
+        self.spool.seek(0, os.SEEK_END)
+        self.written = 0
+
+    def put(self, entry):
+        "Spool and queue the log entry. Never blocks on the database."
+        with self.lock:
+            start = self.base + self.spool.tell()
+            self.spool.write(json.dumps(entry) + '\n')
+            self.spool.flush()
+            try:
+                self.queue.put_nowait((entry, self.base + self.spool.tell()))
+            except Queue.Full:
+                if self.overflow is None:
+                    logging.warning('log queue full; entries spooled only')
+                    self.overflow = start
+
+    def run(self):
+        while True:
+            stopping = self.stopping.is_set()
+            self.collect()
+            if self.pending:
+                try:
+                    self.write([e for e, end in self.pending])
+                except Exception, msg:
+                    logging.warning("log writer error: %s", msg)
+                    if stopping: break
+                    time.sleep(self.retry_delay)
+                    continue
+                with self.lock:
+                    done = max([self.done] + [e for x, e in self.pending])
+                    # Entries queued after an overflow may be written before
+                    # it; those from the overflow on are not written until
+                    # recovered from the spool file, so 'done' stops there.
+                    if self.overflow is not None:
+                        done = min(done, self.overflow)
+                    self.done = done
+                self.pending = []
+            self.truncate_spool()
+            if stopping and not self.pending and self.queue.empty(): break
+        logging.info("log writer stopped; %s entries unwritten",
+                     len(self.pending) + self.queue.qsize())
+
+    def collect(self):
+        """Move queued entries to the pending list, waiting at most
+        the flush interval for the first, until a batch is full."""
+        deadline = time.time() + self.interval
+        while len(self.pending) < self.batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout <= 0 or self.stopping.is_set():
+                    item = self.queue.get_nowait()
+                elif self.flushing.is_set():
+                    item = self.queue.get(timeout=min(timeout, 0.01))
+                else:
+                    item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            self.pending.append(item)
+
+    def write(self, entries):
+        """Write the entries in batches. An entry that already exists,
+        i.e. it was written before its recovery from the spool file,
+        is not an error."""
+        for start in xrange(0, len(entries), self.batch_size):
+            batch = [dict(e) for e in entries[start:start+self.batch_size]]
+            for success, id, error in self.db.update(batch):
+                if not success and \
+                   not isinstance(error, couchdb.http.ResourceConflict):
+                    raise IOError("log entry {0}: {1}".format(id, error))
+            self.written += len(batch)
+
+    def read_spool(self, offset):
+        """Return the entries in the spool file from the given offset,
+        each with the offset of its end."""
+        entries = []
+        try:
+            with open(self.spoolpath) as infile:
+                infile.seek(offset - self.base)
+                while True:
+                    line = infile.readline()
+                    if not line: break
+                    try:
+                        entries.append((json.loads(line),
+                                        self.base + infile.tell()))
+                    except ValueError: # Incomplete last line.
+                        pass
+        except IOError:
+            pass
+        return entries
+
+    def truncate_spool(self):
+        """Cut the spool file to the entries not yet written, if the part
+        written is large, or if all entries in it have been written.
+        Entries that overflowed the queue are recovered from it, once
+        all entries queued before them have been written."""
+        with self.lock:
+            if self.overflow is not None and self.done >= self.overflow:
+                self.pending = self.read_spool(self.overflow)
+                self.overflow = None
+            cut = self.done
+            if self.overflow is not None:
+                cut = min(cut, self.overflow)
+            end = self.base + self.spool.tell()
+            if cut <= self.base: return
+            if cut < end and cut - self.base < self.spool_size: return
+            with open(self.spoolpath) as infile:
+                infile.seek(cut - self.base)
+                rest = infile.read()
+            tmppath = self.spoolpath + '.tmp'
+            with open(tmppath, 'w') as outfile:
+                outfile.write(rest)
+            os.rename(tmppath, self.spoolpath)
+            self.spool.close()
+            self.spool = open(self.spoolpath, 'a')
+            self.spool.seek(0, os.SEEK_END)
+            self.base = cut
+
+    def flush(self, timeout=None):
+        """Wait until all entries put so far have been written, without
+        waiting for the flush interval to pass. Return False if not done
+        within the timeout, or if the thread is not running, else True."""
+        with self.lock:
+            target = self.base + self.spool.tell()
+        deadline = None if timeout is None else time.time() + timeout
+        try:
+            while self.done < target:
+                if not self.is_alive(): return False
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                self.flushing.set()
+                time.sleep(0.01)
+        finally:
+            self.flushing.clear()
+        return True
+
+    def stop(self, timeout=None):
+        "Write all queued entries and stop the thread."
+        self.stopping.set()
+        self.join(timeout)
+
+    def get_stats(self):
+        "Return a dictionary of statistics."
+        return dict(running=self.is_alive(),
+                    written=self.written,
+                    queued=self.queue.qsize(),
+                    pending=len(self.pending),
+                    overflow=self.overflow is not None)
+
+
+def recover(db, spoolpath, batch_size=500):
+    """Write the entries in all spool files '<spoolpath>*', from any
+    worker, and remove the files. To be done before the workers start,
+    so that entries of workers no longer started are not lost.
+    A file that could not be written is left, to be recovered later."""
+    for filepath in sorted(glob.glob(spoolpath + '*')):
+        writer = LogWriter(db, filepath, batch_size=batch_size)
+        writer.spool.close()
+        try:
+            writer.write([e for e, end in writer.pending])
+        except Exception, msg:
+            logging.warning("could not recover spool file %s: %s",
+                            filepath, msg)
+        else:
+            os.remove(filepath)
+
+
+_writer = None
+
+def start(db, spoolpath):
+    "Start the log writer for this process."
+    global _writer
+    if _writer is not None and _writer.is_alive(): return
+    _writer = LogWriter(db, spoolpath,
+                        queue_size=settings.get('LOG_QUEUE_SIZE', 10000),
+                        batch_size=settings.get('BULK_BATCH_SIZE', 500),
+                        interval=settings.get('LOG_FLUSH_INTERVAL', 1.0))
+    _writer.start()
+
+def stop(timeout=None):
+    "Write all queued entries and stop the log writer, if running."
+    if _writer is not None and _writer.is_alive():
+        _writer.stop(timeout)
+
+def flush(timeout=None):
+    """Wait until the entries queued so far have been written, if the log
+    writer is running. Return False if not done within the timeout."""
+    if _writer is None or not _writer.is_alive(): return True
+    return _writer.flush(timeout)
+
+def get_stats():
+    "Return the log writer statistics for this process."
+    if _writer is None:
+        return dict(running=False)
+    return _writer.get_stats()
+
+def put(entry):
+    """Queue the log entry for writing, if the log writer is running.
+    Return True if so, else False."""
+    if _writer is None or not _writer.is_alive(): return False
+    _writer.put(entry)
+    return True
+
+def log(db, doc, changed={}, current_user=None):
+    """Create a log entry for the given document. It is written by the
+    log writer if running, else immediately to the log database if
+    configured, else to the given database."""
+    entry = utils.get_log_entry(doc, changed=changed,
+                                current_user=current_user)
+    if not put(entry):
+        if settings.get('LOG_DATABASE'):
+            db = utils.get_log_db()
+        db.save(entry)
+
+def write(db, entries):
+    """Queue the log entries for writing, if the log writer is running.
+    Else write them immediately by one _bulk_docs request to the log
+    database if configured, else to the given database."""
+    entries = [e for e in entries if not put(e)]
+    if not entries: return
+    if settings.get('LOG_DATABASE'):
+        db = utils.get_log_db()
+    for success, id, error in db.update(entries):
+        if not success:
+            logging.warning("log entry %s: %s", id, error)
@@ -0,0 +1,138 @@
+""" Charon: Measure the size and build time of the view indexes.
+For each design document, the index is built from scratch under
+a temporary design document, so that the indexes in use are not touched.
+Both the design documents currently in the database ('before') and those
+in the local design files ('after') are measured, to show the effect of
+changes to the views before they are loaded.
+"""
+
+import os
+import time
+import threading
+
+import couchdb
+
+from charon import utils
+from charon.load_designs import read_design, query_design
+
+
+def measure(db, name, views):
+    """Build the index for the views under a temporary design document.
+    Return the index file size in bytes, and the build time in seconds.
+    Raise IOError if the index could not be built."""
+    id = "_design/measure_{0}".format(name)
+    try:
+        del db[id]
+    except couchdb.http.ResourceNotFound:
+        pass
+    # Make the index signature unique, so that no existing index is reused.
+    # Only in the map functions; a builtin reduce such as '_sum' is a name.
+    marker = "/* measure {0} */\n".format(utils.get_iuid())
+    views = dict([(k, dict(v)) for k, v in views.items()])
+    for view in views.values():
+        view['map'] = marker + view['map']
+    db.save(dict(_id=id, views=views))
+    try:
+        # All views of a design document share one index, built together.
+        # The query is retried in a thread until the index has been built,
+        # since a build may take longer than the request timeout.
+        start = time.time()
+        errors = []
+        def build():
+            try:
+                query_design(db, "measure_{0}".format(name), views)
+            except Exception, msg:
+                errors.append(msg)
+        thread = threading.Thread(target=build)
+        thread.daemon = True
+        thread.start()
+        while thread.is_alive():
+            thread.join(1.0)
+        elapsed = time.time() - start
+        if errors:
+            raise IOError("index of {0} not built: {1}".format(name,
+                                                               errors[0]))
+        status, headers, info = db.resource(id, '_info').get_json()
+        index = info['view_index']
+        try:
+            size = index['sizes']['file']  # CouchDB 2.x
+        except KeyError:
+            size = index['disk_size']      # CouchDB 1.x
+    finally:
+        del db[id]
+        db.cleanup()
+    return size, elapsed
+
+def get_designs(db):
+    "Return the views of the design documents in the database, by name."
+    result = dict()
+    for row in db.view('_all_docs',
+                       startkey='_design/', endkey='_design0',
+                       include_docs=True):
+        name = row.id[len('_design/'):]
+        if name.startswith('measure_'): continue
+        if row.doc.get('views'):
+            result[name] = row.doc['views']
+    return result
+
+def measure_all(db, root='designs', names=None):
+    """Measure the indexes of the design documents in the database,
+    and of those in the design files. Return a list of tuples
+    (name, size before, time before, size after, time after);
+    None for a design document that does not exist.
+    Raise IOError if an index could not be built."""
+    before = get_designs(db)
+    after = dict()
+    for name in os.listdir(root):
+        if not os.path.isdir(os.path.join(root, name)): continue
+        views = read_design(root, name)[0]
+        if views:
+            after[name] = views
+    result = []
+    for name in sorted(set(before).union(after)):
+        if names and name not in names: continue
+        row = [name]
+        for designs in (before, after):
+            if name in designs:
+                row.extend(measure(db, name, designs[name]))
+            else:
+                row.extend([None, None])
+        result.append(tuple(row))
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+    import optparse
+    parser = optparse.OptionParser(usage='usage: %prog [options] [design...]')
+    parser.add_option('-s', '--settings', dest='settings', default=None,
+                      help='filepath for YAML settings file')
+    parser.add_option('-l', '--log', action='store_true', dest='log',
+                      default=False, help='measure the log database')
+    (options, args) = parser.parse_args()
+    utils.load_settings(filepath=options.settings)
+    if options.log:
+        db = utils.get_log_db()
+    else:
+        db = utils.get_db()
+    print 'database', db.name, db.info()['doc_count'], 'documents'
+    format = "{0:12} {1:>14} {2:>10} {3:>14} {4:>10}"
+    print format.format('design', 'size before', 'time', 'size after', 'time')
+    total = [0, 0.0, 0, 0.0]
+    def show(value, unit):
+        if value is None: return '-'
+        if unit == 's': return "%.2f s" % value
+        return "%.1f KB" % (value / 1024.0)
+    try:
+        rows = measure_all(db, names=args)
+    except IOError, msg:
+        sys.exit(str(msg))
+    for row in rows:
+        for i, value in enumerate(row[1:]):
+            total[i] += value or 0
+        print format.format(row[0],
+                            show(row[1], 'b'), show(row[2], 's'),
+                            show(row[3], 'b'), show(row[4], 's'))
+    print format.format('total',
+                        show(total[0], 'b'), show(total[1], 's'),
+                        show(total[2], 'b'), show(total[3], 's'))
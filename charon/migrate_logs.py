@@ -0,0 +1,80 @@
+""" Charon: Move the log documents from the main database into
+the separate log database given by the setting LOG_DATABASE.
+The log database is created, and its design document loaded, if needed.
+Log documents are copied and deleted in batches by _bulk_docs requests;
+the migration may be interrupted and run again.
+"""
+
+import couchdb
+
+from charon import constants
+from charon import utils
+from charon import settings
+from charon.load_designs import load_designs
+
+
+def migrate_logs(db, logdb, batch_size=500, progress=None):
+    """Move the log documents from the database to the log database.
+    The function 'progress', if given, is called with the number of
+    documents moved so far, after each batch.
+    Return the number of log documents moved."""
+    count = 0
+    while True:
+        # Moved documents are deleted, so the first rows are always new.
+        view = db.view('log/doc', include_docs=True, limit=batch_size)
+        docs = [r.doc for r in view]
+        if not docs: break
+        copies = []
+        for doc in docs:
+            copy = dict(doc)
+            del copy['_rev']
+            copies.append(copy)
+        for success, id, error in logdb.update(copies):
+            # Already copied by an interrupted previous run.
+            if not success and \
+               not isinstance(error, couchdb.http.ResourceConflict):
+                raise IOError("log document {0}: {1}".format(id, error))
+        deleted = [dict(_id=d['_id'], _rev=d['_rev'], _deleted=True)
+                   for d in docs]
+        for success, id, error in db.update(deleted):
+            if not success:
+                raise IOError("log document {0}: {1}".format(id, error))
+        count += len(docs)
+        if progress:
+            progress(count)
+    return count
+
+
+if __name__ == '__main__':
+    import sys
+    try:
+        utils.load_settings(filepath=sys.argv[1])
+    except IndexError:
+        utils.load_settings()
+    name = settings.get('LOG_DATABASE')
+    if not name or name == settings['DB_DATABASE']:
+        sys.exit('no separate log database in settings LOG_DATABASE')
+    server = couchdb.Server(settings['DB_SERVER'])
+    if name not in server:
+        server.create(name)
+        print 'created log database', name
+    db = utils.get_db()
+    logdb = utils.get_log_db()
+    load_designs(logdb, designs=[constants.LOG])
+    def progress(count):
+        sys.stdout.write("\rmoved {0} log documents".format(count))
+        sys.stdout.flush()
+    count = migrate_logs(db, logdb,
+                         batch_size=settings.get('BULK_BATCH_SIZE', 500),
+                         progress=progress)
+    print
+    print 'moved', count, 'log documents to', name
+    # The log index in the main database is no longer needed.
+    try:
+        del db["_design/{0}".format(constants.LOG)]
+    except couchdb.http.ResourceNotFound:
+        pass
+    else:
+        db.compact()
+        db.cleanup()
+        print 'removed log design and compaction started for', db.name
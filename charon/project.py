@@ -6,6 +6,7 @@ import csv
 import cStringIO
 
 import tornado.web
+import tornado.gen
 import couchdb
 
 import charon.constants as cst
@@ -19,25 +20,20 @@ from charon.sample import SampleSaver
 class ProjectidField(sav.IdField):
     "The unique identifier for the project, e.g. 'P1234'."
 
-    def check_valid(self, saver, value):
-        "Also check uniqueness."
-        super(ProjectidField, self).check_valid(saver, value)
-        view = saver.db.view('project/projectid')
-        if len(list(view[value])) > 0:
-            raise ValueError('not unique')
+    unique_view = 'project/projectid'
 
 
 class ProjectnameField(sav.NameField):
     """The name of the project, e.g. 'P.Kraulis_14_01'.
     Optional; must be unique if given."""
 
+    unique_view = 'project/name'
+
     def check_valid(self, saver, value):
         "Also check uniqueness."
         super(ProjectnameField, self).check_valid(saver, value)
         if saver.get(self.key) == value: return
-        view = saver.db.view('project/name')
-        if len(list(view[value])) > 0:
-            raise ValueError('not unique')
+        self.check_unique(saver, value)
 
 
 class ProjectSaver(sav.Saver):
@@ -73,27 +69,32 @@ class UploadSamplesMixin(object):
     """
 
     def upload_samples(self, project):
-        "Upload samples from file provided via HTML form field."
-        samples = []
+        """Upload samples from file provided via HTML form field.
+        All rows are checked against the existing samples, obtained
+        in one range read, before any sample is created.
+        The samples are saved in batches."""
         try: 
             data = self.request.files['csvfile'][0]
         except (KeyError, IndexError):
             raise tornado.web.HTTPError(400, reason='no CSV file uploaded')
         self.messages = ["Data from file {0}".format(data['filename'])]
         self.errors = []
-        samples_set = set()
+        existing = set()
         view = self.db.view('sample/sampleid',
                             startkey=[project['projectid'], ''],
                             endkey=[project['projectid'], cst.HIGH_CHAR])
         for row in view:
             sampleid = row.key[1]
-            if sampleid in samples_set:
+            if sampleid in existing:
                 self.errors.append("sampleid '{0}' defined multiple times?".
                                    format(sampleid))
             else:
-                samples_set.add(sampleid)
+                existing.add(sampleid)
         reader = csv.reader(cStringIO.StringIO(data['body']))
-        # First get all new sampleids, and check uniqueness
+        # First check all new sampleids, in memory.
+        samples_set = set(existing)
+        keys = set([(project['projectid'], s) for s in existing])
+        savers = []
         for pos, record in enumerate(reader):
             try:
                 sampleid = record[0].strip()
@@ -102,12 +103,17 @@ class UploadSamplesMixin(object):
                 if sampleid in samples_set:
                     raise KeyError
                 samples_set.add(sampleid)
-                samples.append(sampleid)
+                saver = SampleSaver(rqh=self, project=project)
+                saver.set_existing('sampleid', keys)
+                saver.store(data=dict(sampleid=sampleid))
+                savers.append(saver)
             except IndexError:
                 self.errors.append("line {0}: empty record".format(pos+1))
             except KeyError:
                 self.errors.append("line {0}: non-unique sampleid {1}".
                                    format(pos+1, sampleid))
+            except ValueError, msg:
+                self.errors.append("line {0}: {1}".format(pos+1, str(msg)))
             if len(self.errors) > 10:
                 self.errors.append('too many errors, giving up...')
                 break
@@ -115,14 +121,15 @@ class UploadSamplesMixin(object):
             self.messages.append('No samples added.')
         else:
             # Add samples when no previous errors
-            for pos, sampleid in enumerate(samples):
-                try:
-                    with SampleSaver(rqh=self, project=project) as saver:
-                        data = dict(sampleid=sampleid)
-                        saver.store(data=data)
-                except (IOError, ValueError), msg:
-                    self.errors.append("line {0}: {1}".format(pos+1, str(msg)))
-            self.messages.append("{0} samples added".format(len(samples)))
+            count = 0
+            results = sav.save_batch(self.db, savers)
+            for saver, error in zip(savers, results):
+                if error is None:
+                    count += 1
+                else:
+                    self.errors.append("sampleid {0}: {1}".
+                                       format(saver['sampleid'], str(error)))
+            self.messages.append("{0} samples added".format(count))
 
 
 class UpdateSamplesMixin(object):
@@ -133,7 +140,10 @@ class UpdateSamplesMixin(object):
     """
 
     def update_samples(self, project):
-        "Update samples from a file provided via HTML form field."
+        """Update samples from a file provided via HTML form field.
+        The samples of the project are obtained in one range read,
+        all rows are checked, and only if all are valid are the
+        samples saved, in batches."""
         try: 
             data = self.request.files['csvfile'][0]
         except (KeyError, IndexError):
@@ -151,8 +161,11 @@ class UpdateSamplesMixin(object):
                 if field.key == 'sampleid':
                     self.errors.append("column 'sampleid' is missing")
         rows = list(reader)
+        savers = []
         if 'sampleid' in lookup:
-            # First just check
+            samples = dict([(s['sampleid'], s)
+                            for s in self.get_samples(project['projectid'])])
+            seen = set()
             for pos, row in enumerate(rows):
                 # Check that the sample identifiers match existing samples
                 try:
@@ -162,42 +175,51 @@ class UpdateSamplesMixin(object):
                     self.errors.append("line {0}; no sampleid".format(pos+1))
                     continue
                 try:
-                    sample = self.get_sample(project['projectid'], sampleid)
-                except tornado.web.HTTPError:
+                    sample = samples[sampleid]
+                except KeyError:
                     self.errors.append("line {0}; no such sample '{1}'".
                                        format(pos+1, sampleid))
                     continue
+                if sampleid in seen:
+                    self.errors.append("line {0}; sample '{1}' given again".
+                                       format(pos+1, sampleid))
+                    continue
+                seen.add(sampleid)
                 # Collect update data for sample
                 data = dict()
                 for key, slot in lookup.iteritems():
                     if key == 'sampleid': continue
-                    value = row[slot].strip()
+                    try:
+                        value = row[slot].strip()
+                    except IndexError:
+                        continue
                     if not value: continue
                     data[key] = value
-                # Check that update of sample is valid
+                # Update the sample in memory; saved only if no errors.
                 try:
-                    with SampleSaver(rqh=self, doc=sample) as saver:
-                        saver.store(data=data, check_only=True)
+                    saver = SampleSaver(rqh=self, doc=sample, project=project)
+                    saver.store(data=data)
                 except ValueError, msg:
                     self.errors.append("row {0}; {1}".format(pos+1, str(msg)))
+                else:
+                    savers.append(saver)
         if self.errors:
             self.messages.append('No samples added.')
         else:
             # And now actually do it...
-            for row in rows:
-                sampleid = row[lookup['sampleid']].strip()
-                sample = self.get_sample(project['projectid'], sampleid)
-                # Collect update data for sample
-                data = dict()
-                for key, slot in lookup.iteritems():
-                    if key == 'sampleid': continue
-                    value = row[slot].strip()
-                    if not value: continue
-                    data[key] = value
-                # Store it 
-                with SampleSaver(rqh=self, doc=sample) as saver:
-                    saver.store(data=data)
-            self.messages.append("{0} samples updated.".format(len(rows)))
+            count = 0
+            same = 0
+            results = sav.save_batch(self.db, savers)
+            for saver, error in zip(savers, results):
+                if error is not None:
+                    self.errors.append("sample {0}: {1}".
+                                       format(saver['sampleid'], str(error)))
+                elif saver.unchanged:
+                    same += 1
+                else:
+                    count += 1
+            self.messages.append("{0} samples updated, {1} unchanged.".
+                                 format(count, same))
 
 
 class Project(RequestHandler):
@@ -211,25 +233,18 @@ class Project(RequestHandler):
         project = self.get_project(projectid)
         projectid=project['projectid']
         samples = self.get_samples(projectid)
-        view = self.db.view('libprep/count')
+        # One grouped reduce query per view, for all samples.
+        startkey = [projectid, '']
+        endkey = [projectid, cst.HIGH_CHAR]
+        libpreps = self.get_counts('libprep/count', group_level=2,
+                                   startkey=startkey, endkey=endkey)
+        seqruns = self.get_counts('seqrun/count', group_level=2,
+                                  startkey=startkey, endkey=endkey)
         for sample in samples:
-            try:
-                row = view[[projectid, sample['sampleid']]].rows[0]
-            except IndexError:
-                sample['libpreps_count'] = 0
-            else:
-                sample['libpreps_count'] = row.value
-        view = self.db.view('seqrun/count')
-        for sample in samples:
-            try:
-                startkey = [projectid, sample['sampleid']]
-                endkey = [projectid, sample['sampleid'], cst.HIGH_CHAR]
-                row = view[startkey:endkey].rows[0]
-            except IndexError:
-                sample['seqruns_count'] = 0
-            else:
-                sample['seqruns_count'] = row.value
-        logs = self.get_logs(project['_id']) # XXX limit?
+            key = (projectid, sample['sampleid'])
+            sample['libpreps_count'] = libpreps.get(key, 0)
+            sample['seqruns_count'] = seqruns.get(key, 0)
+        logs = self.get_logs(project['_id'])
         self.render('project.html',
                     project=project,
                     samples=samples,
@@ -364,10 +379,11 @@ class ApiProject(UploadSamplesMixin, ApiRequestHandler):
     saver = ProjectSaver
 
     # Do not use authentication decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def get(self, projectid):
         """Return the project data as JSON.
         Return HTTP 404 if no such project."""
-        project = self.get_project(projectid)
+        project = yield self.fetch_project(projectid)
         if not project: return
         self.add_project_links(project)
         self.write(project)
@@ -382,13 +398,14 @@ class ApiProject(UploadSamplesMixin, ApiRequestHandler):
             self.set_status(400)
 
     # Do not use authentication decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def put(self, projectid): 
         """Update the project with the given JSON data.
         Return HTTP 204 "No Content" when successful.
         Return HTTP 400 if the input data is invalid.
         Return HTTP 404 if no such project.
         Return HTTP 409 if there is a document revision update conflict."""
-        project = self.get_project(projectid)
+        project = yield self.fetch_project(projectid)
         if not project: return
         try:
             data = json.loads(self.request.body)
@@ -397,8 +414,9 @@ class ApiProject(UploadSamplesMixin, ApiRequestHandler):
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(doc=project, rqh=self) as saver:
-                    saver.store(data=data)
+                saver = self.saver(doc=project, rqh=self)
+                saver.store(data=data)
+                yield saver.save_async()
             except ValueError, msg:
                 logging.debug("ValueError: %s", msg)
                 self.send_error(400, reason=str(msg))
@@ -406,18 +424,23 @@ class ApiProject(UploadSamplesMixin, ApiRequestHandler):
                 logging.debug("IOError: %s", msg)
                 self.send_error(409, reason=str(msg))
             else:
-                self.set_status(204)
+                self.set_updated_status(saver)
 
     # Do not use authentication decorator; do not send to login page, but fail.
     def delete(self, projectid):
         """NOTE: This is for unit test purposes only!
         Delete the project and all of its dependent entities.
-        Returns HTTP 204 "No Content"."""
+        Returns HTTP 204 "No Content".
+        Returns HTTP 503 if the log entries could not be written first."""
         project = self.get_project(projectid)
         if not project: return
-        utls.delete_project(self.db, project)
+        try:
+            count = utls.delete_project(self.db, project)
+        except IOError, msg:
+            self.send_error(503, reason=str(msg))
+            return
         logging.debug("deleted project %s", projectid)
-        self.set_status(204)
+        self.set_deleted_status(count)
 
 
 class ApiProjectSamplesUpdate(UpdateSamplesMixin, ApiRequestHandler):
@@ -471,9 +494,10 @@ class ApiProjects(ApiRequestHandler):
     "Access to all projects."
 
     # Do not use authentication decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def get(self):
         "Return a list of all projects."
-        projects = self.get_projects()
+        projects = yield self.fetch_projects()
         for project in projects:
             self.add_project_links(project)
         self.write(dict(projects=projects))
@@ -483,9 +507,10 @@ class ApiProjectsNotDone(ApiRequestHandler):
     "Access to all projects that are not done."
 
     # Do not use authentication decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def get(self):
         "Return a list of all undone projects."
-        projects = self.get_not_done_projects()
+        projects = yield self.fetch_not_done_projects()
         for project in projects:
             self.add_project_links(project)
         self.write(dict(projects=projects))
@@ -5,26 +5,44 @@ import urllib
 import weakref
 
 import tornado.web
+import tornado.gen
 import couchdb
 
 import charon
 from . import settings
 from . import constants
 from . import utils
+from . import cache as entitycache
+from . import asyncdb
+from . import connection
+from .loader import Loader
 
 
 class RequestHandler(tornado.web.RequestHandler):
     "Base request handler."
 
     def prepare(self):
-        "Get the database connection. Set up caches."
-        self.db = utils.get_db()
+        """Get the database handles for this request, which count their
+        requests, and share the connections of the process. Set up caches."""
+        self.db = connection.get_request_db()
+        self.adb = asyncdb.get_request_db()
         self._cache = weakref.WeakValueDictionary()
         self._users = weakref.WeakValueDictionary()
         self._projects = weakref.WeakValueDictionary()
         self._samples = weakref.WeakValueDictionary()
         self._libpreps = weakref.WeakValueDictionary()
         self._seqruns = weakref.WeakValueDictionary()
+        self.loader = Loader(self)
+
+    def finish(self, chunk=None):
+        "Report the number of database requests made by this request."
+        try:
+            count = self.db.resource.session.requests + self.adb.requests
+        except AttributeError:          # prepare not done
+            pass
+        else:
+            self.set_header('X-Charon-DB-Requests', str(count))
+        return super(RequestHandler, self).finish(chunk)
 
     def get_template_namespace(self):
         "Set the variables accessible within the template."
@@ -104,110 +122,141 @@ class RequestHandler(tornado.web.RequestHandler):
                                       self._projects)
             
     def get_not_done_projects(self):
-        "Get projects that are not done."
-        all = [r.value for r in
-               self.db.view('project/not_done')]
-        return all
+        "Get projects that are not done, in one range read."
+        view = self.db.view('project/not_done', include_docs=True)
+        return self.cache_rows(view, self._projects)
 
     def get_not_done_samples(self, projectid=None):
-        "Get samples that are not done."
+        """Get samples that are not done, optionally only for the project,
+        in one range read."""
+        view = self.db.view('sample/not_done', include_docs=True)
         if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/not_done') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/not_done')]
-
-        return all
+            view = view[[projectid, '']:[projectid, constants.HIGH_CHAR]]
+        return self.cache_rows(view, self._samples)
 
     def get_done_samples(self, projectid=None):
-        "Get samples that are not done."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/done') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/done')]
-
-        return all
+        "Get samples that have been analyzed."
+        status = constants.SAMPLE_ANALYSIS_STATUS['DONE']
+        return self.get_samples_by_status(status, projectid)[0]
 
     def get_running_samples(self, projectid=None):
-        "Get samples that are running."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/running') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/running')]
-
-        return all
+        "Get samples that are under analysis."
+        status = constants.SAMPLE_ANALYSIS_STATUS['ONGOING']
+        return self.get_samples_by_status(status, projectid)[0]
 
     def get_failed_samples(self, projectid=None):
-        "Get samples that are failed."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/failed') if r.key[0] == projectid]
-        else:
-            all = [r.value for r in
-                   self.db.view('sample/failed')]
-
-        return all
+        "Get samples for which the analysis failed."
+        status = constants.SAMPLE_ANALYSIS_STATUS['FAILED']
+        return self.get_samples_by_status(status, projectid)[0]
 
     def get_analyzed_failed_samples(self, projectid=None):
         "Get samples that are failed or done."
-        if projectid:
-            all = [r.value for r in
-                   self.db.view('sample/analyzed_failed') if r.key[0] == projectid]
+        return self.get_done_samples(projectid) + \
+            self.get_failed_samples(projectid)
+
+    def get_samples_by_status(self, status, projectid=None,
+                              limit=None, cursor=None,
+                              field='analysis_status'):
+        """Get the samples having the given value of the status field,
+        for all projects, or for the given project only.
+        See 'get_by_status' for the limit and cursor."""
+        return self.get_by_status(constants.SAMPLE, field, status,
+                                  projectid=projectid,
+                                  limit=limit,
+                                  cursor=cursor)
+
+    def get_seqruns_by_status(self, status, projectid=None,
+                              limit=None, cursor=None,
+                              field='alignment_status'):
+        """Get the seqruns having the given value of the status field,
+        for all projects, or for the given project only.
+        See 'get_by_status' for the limit and cursor."""
+        return self.get_by_status(constants.SEQRUN, field, status,
+                                  projectid=projectid,
+                                  limit=limit,
+                                  cursor=cursor)
+
+    def get_by_status(self, doctype, field, status, projectid=None,
+                      limit=None, cursor=None):
+        """Get the entities of the doctype having the given value of the
+        status field, using the 'status' design document. Cost is
+        proportional to the number of entities returned.
+        If limit is given, return at most that many entities.
+        The cursor, if given, is the one returned for the previous page.
+        Return the list of entities, and the cursor for the next page,
+        which is None if there are no more entities.
+        Raise ValueError if the field or the cursor is invalid."""
+        viewname, params = self.get_by_status_params(doctype, field, status,
+                                                     projectid, limit, cursor)
+        rows = list(self.db.view(viewname, **params))
+        return self.get_by_status_result(rows, limit)
+
+    def get_by_status_params(self, doctype, field, status, projectid,
+                             limit, cursor):
+        """Return the view name and the query parameters for the
+        entities by status. Raise ValueError if the field or the
+        cursor is invalid."""
+        if field not in constants.STATUS_FIELDS[doctype]:
+            raise ValueError("invalid status field '{0}'".format(field))
+        params = dict(include_docs=True,
+                      startkey=[field, status, projectid or '', ''],
+                      endkey=[field,
+                              status,
+                              projectid or constants.HIGH_CHAR,
+                              constants.HIGH_CHAR])
+        if cursor:
+            params['startkey'], params['startkey_docid'] = \
+                utils.decode_cursor(cursor)
+            if params['startkey'][:2] != [field, status]:
+                raise ValueError('cursor does not match status')
+        if limit:
+            params['limit'] = limit + 1
+        return "status/{0}".format(doctype), params
+
+    def get_by_status_result(self, rows, limit):
+        """Return the list of entities in the rows, and the cursor for
+        the next page, which is None if there are no more entities."""
+        if limit and len(rows) > limit:
+            cursor = utils.encode_cursor(rows[limit].key, rows[limit].id)
+            rows = rows[:limit]
         else:
-            all = [r.value for r in
-                   self.db.view('sample/analyzed_failed')]
+            cursor = None
+        return [r.doc for r in rows], cursor
 
-        return all
     def get_projectids_from_sampleid(self, sampleid):
-        pj_ids=[]
-        view1 = self.db.view('internal/sampleids_to_projectids')
-        rows=view1[sampleid]
-        for row in rows:
-            pj_ids.append(row.value)
-            return pj_ids
+        "Get the projectids of all projects having a sample with the id."
+        view = self.db.view('internal/sampleids_to_projectids')
+        return [r.value for r in view[sampleid]]
 
     def get_projects(self):
-        "Get all projects."
-        all = [self.get_project(r.key) for r in
-               self.db.view('project/projectid')]
-        view1 = self.db.view('sample/count')
-        view2 = self.db.view('sample/count_done')
-        view3 = self.db.view('libprep/count', group_level=1)
-        view4 = self.db.view('sample/count_delivered')
+        """Get all projects, with their counts of samples and libpreps.
+        One range read for the projects, and one grouped reduce query
+        per count, regardless of the number of projects."""
+        view = self.db.view('project/projectid', include_docs=True)
+        all = self.cache_rows(view, self._projects)
+        samples = self.get_counts('sample/count', group=True)
+        done = self.get_counts('sample/count_done', group=True)
+        delivered = self.get_counts('sample/count_delivered', group=True)
+        libpreps = self.get_counts('libprep/count', group_level=1)
         for project in all:
-            try:
-                row = view1[project['projectid']].rows[0]
-            except IndexError:
-                project['sample_count'] = 0
-            else:
-                project['sample_count'] = row.value
-            try:
-                row = view2[project['projectid']].rows[0]
-            except IndexError:
-                project['sample_count_done'] = 0
-            else:
-                project['sample_count_done'] = row.value
-            try:
-                row = view4[project['projectid']].rows[0]
-            except IndexError:
-                project['sample_count_delivered'] = 0
-            else:
-                project['sample_count_delivered'] = row.value
-            startkey = [project['projectid']]
-            endkey = [project['projectid'], constants.HIGH_CHAR]
-            try:
-                row = view3[startkey:endkey].rows[0]
-            except IndexError:
-                project['libprep_count'] = 0
-            else:
-                project['libprep_count'] = row.value
+            projectid = project['projectid']
+            project['sample_count'] = samples.get(projectid, 0)
+            project['sample_count_done'] = done.get(projectid, 0)
+            project['sample_count_delivered'] = delivered.get(projectid, 0)
+            project['libprep_count'] = libpreps.get((projectid,), 0)
         return all
 
+    def get_counts(self, viewname, **params):
+        """Return a lookup of the values of a grouped reduce view query.
+        Array keys are converted to tuples."""
+        result = dict()
+        for row in self.db.view(viewname, **params):
+            if isinstance(row.key, list):
+                result[tuple(row.key)] = row.value
+            else:
+                result[row.key] = row.value
+        return result
+
     def get_sample(self, projectid, sampleid):
         """Get the sample by the projectid and sampleid.
         Raise HTTP 404 if no such sample."""
@@ -218,11 +267,11 @@ class RequestHandler(tornado.web.RequestHandler):
             return self.get_and_cache('sample/sampleid', key, self._samples)
 
     def get_samples(self, projectid=None):
-        "Get all samples for the project."
+        "Get all samples for the project, in one range read."
         startkey = (projectid or '', '')
         endkey = (projectid or constants.HIGH_CHAR, constants.HIGH_CHAR)
-        return [self.get_sample(*r.key) for r in
-                self.db.view('sample/sampleid')[startkey:endkey]]
+        view = self.db.view('sample/sampleid', include_docs=True)
+        return self.cache_rows(view[startkey:endkey], self._samples)
 
     def get_libprep(self, projectid, sampleid, libprepid):
         """Get the libprep by the projectid, sampleid and libprepid.
@@ -235,13 +284,13 @@ class RequestHandler(tornado.web.RequestHandler):
 
     def get_libpreps(self, projectid, sampleid=''):
         """Get the libpreps for the sample if sampleid given.
-        For the entire project if no sampleid."""
+        For the entire project if no sampleid. In one range read."""
         startkey = (projectid, sampleid, '')
         endkey = (projectid,
                   sampleid or constants.HIGH_CHAR,
                   constants.HIGH_CHAR)
-        return [self.get_libprep(*r.key) for r in
-                self.db.view('libprep/libprepid')[startkey:endkey]]
+        view = self.db.view('libprep/libprepid', include_docs=True)
+        return self.cache_rows(view[startkey:endkey], self._libpreps)
 
     def get_seqrun(self, projectid, sampleid, libprepid, seqrunid):
         """Get the libprep by the projectid, sampleid, libprepid and seqrunid.
@@ -255,35 +304,378 @@ class RequestHandler(tornado.web.RequestHandler):
     def get_seqruns(self, projectid='', sampleid='', libprepid=''):
         """Get the seqruns for the libprep if libprepid given.
         For the entire sample if no libprepid.
-        For the entire project if no sampleid."""
+        For the entire project if no sampleid. In one range read."""
         startkey = (projectid  or '', sampleid or '', libprepid or '', '')
         endkey = (projectid or constants.HIGH_CHAR,
                   sampleid or constants.HIGH_CHAR,
                   libprepid or constants.HIGH_CHAR,
                   constants.HIGH_CHAR)
-        return [self.get_seqrun(*r.key) for r in
-                self.db.view('seqrun/seqrunid')[startkey:endkey]]
+        view = self.db.view('seqrun/seqrunid', include_docs=True)
+        return self.cache_rows(view[startkey:endkey], self._seqruns)
+
+    def prefetch(self, *paths):
+        """Load the entities given by their paths, i.e. tuples
+        (projectid, sampleid, libprepid, seqrunid) of length 1 to 4,
+        into the request caches with at most one database request.
+        Return a lookup of the found entities keyed by path."""
+        for path in paths:
+            self.loader.queue(*path)
+        return self.loader.load()
 
     def get_and_cache(self, viewname, key, cache):
         """Get the item by the view name and the key.
-        Try to get it from the cache, else from the database.
+        Try to get it from the process-wide entity cache, if active,
+        else from the database.
         Raise HTTP 404 if no such item."""
+        entities = entitycache.get_cache()
+        active = entitycache.is_active()
+        if active:
+            item = entities.get(viewname, key)
+            if item is not None:
+                cache[key] = item
+                self._cache[item['_id']] = item
+                return item
         view = self.db.view(viewname, include_docs=True)
         rows = list(view[key])
         if len(rows) == 1:
             item = cache[key] = rows[0].doc
             self._cache[item['_id']] = item
+            if active:
+                entities.put(viewname, key, item)
             return item
         else:
             logging.debug("{0} elements for key {1} ".format(len(rows), key))
             raise tornado.web.HTTPError(404, reason='{0} elements for key {1}'.format(len(rows), key))
 
-    def get_logs(self, id):
-        "Return the log documents for the given doc id."
-        view = self.db.view('log/doc', include_docs=True)
-        return sorted([r.doc for r in view[id]],
-                      cmp=utils.cmp_timestamp,
-                      reverse=True)
+    def get_logs(self, id, limit=None):
+        """Return the log documents for the given doc id, most recent first.
+        If limit is not given, it is the setting LOG_PAGE_SIZE."""
+        return self.get_logs_page(id, limit=limit)[0]
+
+    def get_logs_page(self, id, limit=None, cursor=None):
+        """Get a page of the log documents for the given doc id, most
+        recent first, by the 'log/doc_timestamp' index. Cost is
+        proportional to the size of the page, not of the history.
+        If limit is not given, it is the setting LOG_PAGE_SIZE.
+        The cursor, if given, is the one returned for the previous page.
+        Return the list of log documents, and the cursor for the next
+        page, which is None if there are no more log documents.
+        Raise ValueError if the cursor is invalid."""
+        return self.search_logs(dict(doc=id), limit=limit, cursor=cursor)
+
+    def search_logs(self, criteria, since=None, until=None,
+                    limit=None, cursor=None):
+        """Get a page of the log documents matching the criteria, most
+        recent first, and within the time range, if given. The criteria
+        is a dictionary with any of the keys 'doc', 'field', 'operator'
+        and 'doctype'; the index used is given by constants.LOG_SEARCHES.
+        Otherwise as for 'get_logs_page'.
+        Raise ValueError if the criteria or the cursor is invalid."""
+        viewname, params = self.get_logs_params(criteria, since, until,
+                                                limit, cursor)
+        rows = list(utils.get_log_db().view(viewname, **params))
+        return self.get_logs_result(rows, params['limit'] - 1)
+
+    def get_logs_params(self, criteria, since, until, limit, cursor):
+        """Return the view name and query parameters for a page of log
+        documents. Raise ValueError if the criteria or cursor is invalid."""
+        keys = tuple(sorted([k for k, v in criteria.items() if v]))
+        for searchkeys, viewname in constants.LOG_SEARCHES:
+            if keys == tuple(sorted(searchkeys)): break
+        else:
+            raise ValueError("no log index for {0}".format(', '.join(keys)))
+        prefix = [criteria[k] for k in searchkeys]
+        if limit is None:
+            limit = settings.get('LOG_PAGE_SIZE', 100)
+        params = dict(include_docs=True,
+                      descending=True,
+                      startkey=prefix + [until or constants.HIGH_CHAR],
+                      endkey=prefix + [since or ''],
+                      limit=limit + 1)
+        if cursor:
+            params['startkey'], params['startkey_docid'] = \
+                utils.decode_cursor(cursor)
+            if params['startkey'][:len(prefix)] != prefix:
+                raise ValueError('cursor does not match search')
+        return viewname, params
+
+    def get_logs_result(self, rows, limit):
+        "Return the log documents and the cursor for the next page."
+        if len(rows) > limit:
+            cursor = utils.encode_cursor(rows[limit].key, rows[limit].id)
+            rows = rows[:limit]
+        else:
+            cursor = None
+        return [r.doc for r in rows], cursor
+
+    # Non-blocking versions of the above, for coroutine request handlers.
+
+    @tornado.gen.coroutine
+    def fetch_user(self, email):
+        """Get the user identified by the email address, without blocking.
+        Raise HTTP 404 if no such user."""
+        try:
+            raise tornado.gen.Return(self._users[email])
+        except KeyError:
+            user = yield self.fetch_and_cache('user/email', email, self._users)
+            raise tornado.gen.Return(user)
+
+    @tornado.gen.coroutine
+    def fetch_project(self, projectid):
+        """Get the project by the projectid, without blocking.
+        Raise HTTP 404 if no such project."""
+        try:
+            raise tornado.gen.Return(self._projects[projectid])
+        except KeyError:
+            try:
+                project = yield self.fetch_and_cache('project/projectid',
+                                                     projectid,
+                                                     self._projects)
+            except tornado.web.HTTPError:
+                project = yield self.fetch_and_cache('project/name',
+                                                     projectid,
+                                                     self._projects)
+            raise tornado.gen.Return(project)
+
+    @tornado.gen.coroutine
+    def fetch_projects(self):
+        "Non-blocking version of 'get_projects'."
+        rows = yield self.adb.view('project/projectid', include_docs=True)
+        all = self.cache_rows(rows, self._projects)
+        samples, done, delivered, libpreps = yield [
+            self.fetch_counts('sample/count', group=True),
+            self.fetch_counts('sample/count_done', group=True),
+            self.fetch_counts('sample/count_delivered', group=True),
+            self.fetch_counts('libprep/count', group_level=1)]
+        for project in all:
+            projectid = project['projectid']
+            project['sample_count'] = samples.get(projectid, 0)
+            project['sample_count_done'] = done.get(projectid, 0)
+            project['sample_count_delivered'] = delivered.get(projectid, 0)
+            project['libprep_count'] = libpreps.get((projectid,), 0)
+        raise tornado.gen.Return(all)
+
+    @tornado.gen.coroutine
+    def fetch_counts(self, viewname, **params):
+        "Non-blocking version of 'get_counts'."
+        result = dict()
+        rows = yield self.adb.view(viewname, **params)
+        for row in rows:
+            if isinstance(row.key, list):
+                result[tuple(row.key)] = row.value
+            else:
+                result[row.key] = row.value
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def fetch_not_done_projects(self):
+        "Non-blocking version of 'get_not_done_projects'."
+        rows = yield self.adb.view('project/not_done', include_docs=True)
+        raise tornado.gen.Return(self.cache_rows(rows, self._projects))
+
+    @tornado.gen.coroutine
+    def fetch_not_done_samples(self, projectid=None):
+        "Non-blocking version of 'get_not_done_samples'."
+        params = dict()
+        if projectid:
+            params['startkey'] = [projectid, '']
+            params['endkey'] = [projectid, constants.HIGH_CHAR]
+        rows = yield self.adb.view('sample/not_done', include_docs=True,
+                                   **params)
+        raise tornado.gen.Return(self.cache_rows(rows, self._samples))
+
+    @tornado.gen.coroutine
+    def fetch_done_samples(self, projectid=None):
+        "Non-blocking version of 'get_done_samples'."
+        status = constants.SAMPLE_ANALYSIS_STATUS['DONE']
+        result = yield self.fetch_samples_by_status(status, projectid)
+        raise tornado.gen.Return(result[0])
+
+    @tornado.gen.coroutine
+    def fetch_running_samples(self, projectid=None):
+        "Non-blocking version of 'get_running_samples'."
+        status = constants.SAMPLE_ANALYSIS_STATUS['ONGOING']
+        result = yield self.fetch_samples_by_status(status, projectid)
+        raise tornado.gen.Return(result[0])
+
+    @tornado.gen.coroutine
+    def fetch_failed_samples(self, projectid=None):
+        "Non-blocking version of 'get_failed_samples'."
+        status = constants.SAMPLE_ANALYSIS_STATUS['FAILED']
+        result = yield self.fetch_samples_by_status(status, projectid)
+        raise tornado.gen.Return(result[0])
+
+    @tornado.gen.coroutine
+    def fetch_analyzed_failed_samples(self, projectid=None):
+        "Non-blocking version of 'get_analyzed_failed_samples'."
+        done, failed = yield [self.fetch_done_samples(projectid),
+                              self.fetch_failed_samples(projectid)]
+        raise tornado.gen.Return(done + failed)
+
+    @tornado.gen.coroutine
+    def fetch_samples_by_status(self, status, projectid=None,
+                                limit=None, cursor=None,
+                                field='analysis_status'):
+        "Non-blocking version of 'get_samples_by_status'."
+        result = yield self.fetch_by_status(constants.SAMPLE, field, status,
+                                            projectid=projectid,
+                                            limit=limit,
+                                            cursor=cursor)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def fetch_seqruns_by_status(self, status, projectid=None,
+                                limit=None, cursor=None,
+                                field='alignment_status'):
+        "Non-blocking version of 'get_seqruns_by_status'."
+        result = yield self.fetch_by_status(constants.SEQRUN, field, status,
+                                            projectid=projectid,
+                                            limit=limit,
+                                            cursor=cursor)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def fetch_by_status(self, doctype, field, status, projectid=None,
+                        limit=None, cursor=None):
+        "Non-blocking version of 'get_by_status'."
+        viewname, params = self.get_by_status_params(doctype, field, status,
+                                                     projectid, limit, cursor)
+        rows = yield self.adb.view(viewname, **params)
+        raise tornado.gen.Return(self.get_by_status_result(rows, limit))
+
+    @tornado.gen.coroutine
+    def fetch_sample(self, projectid, sampleid):
+        """Get the sample by the projectid and sampleid, without blocking.
+        Raise HTTP 404 if no such sample."""
+        key = (projectid, sampleid)
+        try:
+            raise tornado.gen.Return(self._samples[key])
+        except KeyError:
+            sample = yield self.fetch_and_cache('sample/sampleid', key,
+                                                self._samples)
+            raise tornado.gen.Return(sample)
+
+    @tornado.gen.coroutine
+    def fetch_samples(self, projectid=None):
+        "Get all samples for the project, without blocking."
+        startkey = (projectid or '', '')
+        endkey = (projectid or constants.HIGH_CHAR, constants.HIGH_CHAR)
+        rows = yield self.adb.view('sample/sampleid',
+                                   include_docs=True,
+                                   startkey=startkey,
+                                   endkey=endkey)
+        raise tornado.gen.Return(self.cache_rows(rows, self._samples))
+
+    @tornado.gen.coroutine
+    def fetch_libprep(self, projectid, sampleid, libprepid):
+        """Get the libprep by the projectid, sampleid and libprepid,
+        without blocking. Raise HTTP 404 if no such libprep."""
+        key = (projectid, sampleid, libprepid)
+        try:
+            raise tornado.gen.Return(self._libpreps[key])
+        except KeyError:
+            libprep = yield self.fetch_and_cache('libprep/libprepid', key,
+                                                 self._libpreps)
+            raise tornado.gen.Return(libprep)
+
+    @tornado.gen.coroutine
+    def fetch_libpreps(self, projectid, sampleid=''):
+        """Get the libpreps for the sample if sampleid given,
+        for the entire project if no sampleid, without blocking."""
+        startkey = (projectid, sampleid, '')
+        endkey = (projectid,
+                  sampleid or constants.HIGH_CHAR,
+                  constants.HIGH_CHAR)
+        rows = yield self.adb.view('libprep/libprepid',
+                                   include_docs=True,
+                                   startkey=startkey,
+                                   endkey=endkey)
+        raise tornado.gen.Return(self.cache_rows(rows, self._libpreps))
+
+    @tornado.gen.coroutine
+    def fetch_seqrun(self, projectid, sampleid, libprepid, seqrunid):
+        """Get the seqrun by the projectid, sampleid, libprepid and seqrunid,
+        without blocking. Raise HTTP 404 if no such seqrun."""
+        key = (projectid, sampleid, libprepid, seqrunid)
+        try:
+            raise tornado.gen.Return(self._seqruns[key])
+        except KeyError:
+            seqrun = yield self.fetch_and_cache('seqrun/seqrunid', key,
+                                                self._seqruns)
+            raise tornado.gen.Return(seqrun)
+
+    @tornado.gen.coroutine
+    def fetch_seqruns(self, projectid='', sampleid='', libprepid=''):
+        """Get the seqruns for the libprep if libprepid given.
+        For the entire sample if no libprepid.
+        For the entire project if no sampleid. Without blocking."""
+        startkey = (projectid  or '', sampleid or '', libprepid or '', '')
+        endkey = (projectid or constants.HIGH_CHAR,
+                  sampleid or constants.HIGH_CHAR,
+                  libprepid or constants.HIGH_CHAR,
+                  constants.HIGH_CHAR)
+        rows = yield self.adb.view('seqrun/seqrunid',
+                                   include_docs=True,
+                                   startkey=startkey,
+                                   endkey=endkey)
+        raise tornado.gen.Return(self.cache_rows(rows, self._seqruns))
+
+    @tornado.gen.coroutine
+    def fetch_and_cache(self, viewname, key, cache):
+        """Get the item by the view name and the key, without blocking.
+        Try to get it from the process-wide entity cache, if active,
+        else from the database.
+        Raise HTTP 404 if no such item."""
+        entities = entitycache.get_cache()
+        active = entitycache.is_active()
+        if active:
+            item = entities.get(viewname, key)
+            if item is not None:
+                cache[key] = item
+                self._cache[item['_id']] = item
+                raise tornado.gen.Return(item)
+        rows = yield self.adb.view(viewname, include_docs=True, key=key)
+        if len(rows) == 1:
+            item = cache[key] = rows[0].doc
+            self._cache[item['_id']] = item
+            if active:
+                entities.put(viewname, key, item)
+            raise tornado.gen.Return(item)
+        else:
+            logging.debug("{0} elements for key {1} ".format(len(rows), key))
+            raise tornado.web.HTTPError(404, reason='{0} elements for key {1}'.format(len(rows), key))
+
+    @tornado.gen.coroutine
+    def fetch_logs_page(self, id, limit=None, cursor=None):
+        "Non-blocking version of 'get_logs_page'."
+        result = yield self.fetch_search_logs(dict(doc=id),
+                                              limit=limit, cursor=cursor)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def fetch_search_logs(self, criteria, since=None, until=None,
+                          limit=None, cursor=None):
+        "Non-blocking version of 'search_logs'."
+        viewname, params = self.get_logs_params(criteria, since, until,
+                                                limit, cursor)
+        rows = yield asyncdb.get_log_db().view(viewname, **params)
+        raise tornado.gen.Return(self.get_logs_result(rows,
+                                                      params['limit'] - 1))
+
+    def cache_rows(self, rows, cache):
+        """Put the documents of the rows from an include_docs view query
+        into the request caches, keyed by the row key.
+        Return the list of documents."""
+        result = []
+        for row in rows:
+            if isinstance(row.key, list):
+                key = tuple(row.key)
+            else:
+                key = row.key
+            item = cache[key] = row.doc
+            self._cache[item['_id']] = item
+            result.append(item)
+        return result
 
     def send_error(self, status_code=500, **kwargs):
         """ ** This is really a bug fix for Tornado!
@@ -4,6 +4,7 @@ import logging
 import json
 
 import tornado.web
+import tornado.gen
 import couchdb
 
 import charon.constants as cst
@@ -16,13 +17,10 @@ from charon.api import ApiRequestHandler
 class SampleidField(sav.IdField):
     "The unique identifier for the sample within the project."
 
-    def check_valid(self, saver, value):
-        "Also check uniqueness."
-        super(SampleidField, self).check_valid(saver, value)
-        key = (saver.project['projectid'], value)
-        view = saver.db.view('sample/sampleid')
-        if len(list(view[key])) > 0:
-            raise ValueError('not unique')
+    unique_view = 'sample/sampleid'
+
+    def get_unique_key(self, saver, value):
+        return (saver.project['projectid'], value)
 
 
 class SampleSaver(sav.Saver):
@@ -85,18 +83,14 @@ class Sample(RequestHandler):
     def get(self, projectid, sampleid):
         sample = self.get_sample(projectid, sampleid)
         libpreps = self.get_libpreps(projectid, sampleid)
-        view = self.db.view('seqrun/count')
+        # One grouped reduce query for all libpreps.
+        seqruns = self.get_counts('seqrun/count', group_level=3,
+                                  startkey=[projectid, sampleid, ''],
+                                  endkey=[projectid, sampleid, cst.HIGH_CHAR])
         for libprep in libpreps:
-            try:
-                startkey = [projectid, sampleid, libprep['libprepid']]
-                endkey = [projectid, sampleid, libprep['libprepid'],
-                          cst.HIGH_CHAR]
-                row = view[startkey:endkey].rows[0]
-            except IndexError:
-                libprep['seqruns_count'] = 0
-            else:
-                libprep['seqruns_count'] = row.value
-        logs = self.get_logs(sample['_id']) # XXX limit?
+            key = (projectid, sampleid, libprep['libprepid'])
+            libprep['seqruns_count'] = seqruns.get(key, 0)
+        logs = self.get_logs(sample['_id'])
         self.render('sample.html',
                     sample=sample,
                     libpreps=libpreps,
@@ -168,46 +162,55 @@ class ApiSample(ApiRequestHandler):
     saver = SampleSaver
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def get(self, projectid, sampleid):
         """Return the sample data as JSON.
         Return HTTP 404 if no such sample or project."""
-        sample = self.get_sample(projectid, sampleid)
+        sample = yield self.fetch_sample(projectid, sampleid)
         if not sample: return
         self.add_sample_links(sample)
         self.write(sample)
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def put(self, projectid, sampleid):
         """Update the sample with the given JSON data.
         Return HTTP 204 "No Content".
         Return HTTP 400 if the input data is invalid.
         Return HTTP 409 if there is a document revision conflict."""
-        sample = self.get_sample(projectid, sampleid)
+        project = yield self.fetch_project(projectid)
+        sample = yield self.fetch_sample(projectid, sampleid)
         try:
             data = json.loads(self.request.body)
         except Exception, msg:
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(doc=sample, rqh=self) as saver:
-                    saver.store(data=data)
+                saver = self.saver(doc=sample, rqh=self, project=project)
+                saver.store(data=data)
+                yield saver.save_async()
             except ValueError, msg:
                 self.send_error(400, reason=str(msg))
             except IOError, msg:
                 self.send_error(409, reason=str(msg))
             else:
-                self.set_status(204)
+                self.set_updated_status(saver)
     
     # Do not use authenticaton decorator; do not send to login page, but fail.
     def delete(self, projectid, sampleid):
         """NOTE: This is for unit test purposes only!
         Delete the sample and all of its dependent entities.
-        Returns HTTP 204 "No Content"."""
+        Returns HTTP 204 "No Content".
+        Returns HTTP 503 if the log entries could not be written first."""
         sample= self.get_sample(projectid, sampleid)
         if not sample: return
-        utls.delete_sample(self.db, sample)
+        try:
+            count = utls.delete_sample(self.db, sample)
+        except IOError, msg:
+            self.send_error(503, reason=str(msg))
+            return
         logging.debug("deleted sample {0}, {1}".format(projectid, sampleid))
-        self.set_status(204)
+        self.set_deleted_status(count)
 
 
 class ApiSampleCreate(ApiRequestHandler):
@@ -251,9 +254,10 @@ class ApiSamples(ApiRequestHandler):
     "Access to all samples in a project."
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def get(self, projectid):
         "Return a list of all samples."
-        samples = self.get_samples(projectid)
+        samples = yield self.fetch_samples(projectid)
         for sample in samples:
             self.add_sample_links(sample)
         self.write(dict(samples=samples))
@@ -263,9 +267,10 @@ class ApiSamplesNotDone(ApiRequestHandler):
     "Access to all samples that are not done."
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def get(self):
         "Return a list of all undone samples."
-        samples= self.get_not_done_samples()
+        samples = yield self.fetch_not_done_samples()
         for sample in samples:
             self.add_sample_links(sample)
         self.write(dict(samples=samples))
@@ -274,9 +279,10 @@ class ApiSamplesDone(ApiRequestHandler):
     "Access to all samples that are not done."
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def get(self):
         "Return a list of all done samples."
-        samples= self.get_done_samples()
+        samples = yield self.fetch_done_samples()
         for sample in samples:
             self.add_sample_links(sample)
         self.write(dict(samples=samples))
@@ -292,17 +298,48 @@ class ApiSamplesNotDonePerProject(ApiRequestHandler):
     "Access to all samples that are not done."
 
     # Do not use authenticaton decorator; do not send to login page, but fail.
+    @tornado.gen.coroutine
     def get(self, projectid):
         "Return a list of all undone samples."
-        samples= self.get_not_done_samples(projectid)
+        samples = yield self.fetch_not_done_samples(projectid)
         for sample in samples:
             self.add_sample_links(sample)
         self.write(dict(samples=samples))
 
+class ApiSamplesByStatus(ApiRequestHandler):
+    """Access to the samples having a given analysis status.
+    Optional query parameters: 'field' for another status field,
+    e.g. 'delivery_status', 'projectid' to restrict to a project,
+    'limit' for the maximum number of samples to return, and 'cursor'
+    as returned by the previous call, to get the next page."""
+
+    @tornado.gen.coroutine
+    def get(self, status):
+        """Return a list of samples and the cursor for the next page,
+        which is null if there are no more samples.
+        Return HTTP 400 if the field, limit or cursor is invalid."""
+        try:
+            limit = self.get_limit()
+            samples, cursor = yield self.fetch_samples_by_status(
+                status,
+                projectid=self.get_argument('projectid', None),
+                limit=limit,
+                cursor=self.get_argument('cursor', None),
+                field=self.get_argument('field', 'analysis_status'))
+        except ValueError, msg:
+            self.send_error(400, reason=str(msg))
+        else:
+            for sample in samples:
+                self.add_sample_links(sample)
+            self.write(dict(samples=samples, cursor=cursor))
+
 class ApiSamplesRunning(ApiRequestHandler):
     "retuns a list of samples that are currently running"
+    @tornado.gen.coroutine
     def get(self):
-        self.write(json.dumps(self.get_running_samples(self.get_argument("projectid", None))))
+        samples = yield self.fetch_running_samples(
+            self.get_argument("projectid", None))
+        self.write(json.dumps(samples))
 
 class SamplesRunning(RequestHandler):
     "displays a list of currently running samples"
@@ -314,8 +351,11 @@ class SamplesRunning(RequestHandler):
 
 class ApiSamplesFailed(ApiRequestHandler):
     "retuns a list of samples that are currently failed"
+    @tornado.gen.coroutine
     def get(self):
-        self.write(json.dumps(self.get_failed_samples(self.get_argument("projectid", None))))
+        samples = yield self.fetch_failed_samples(
+            self.get_argument("projectid", None))
+        self.write(json.dumps(samples))
 
 class SamplesFailed(RequestHandler):
     "displays a list of currently Failed samples"
@@ -327,8 +367,11 @@ class SamplesFailed(RequestHandler):
 
 class ApiSamplesDoneFailed(ApiRequestHandler):
     "retuns a list of samples that are currently failed"
+    @tornado.gen.coroutine
     def get(self):
-        self.write(json.dumps(self.get_analyzed_failed_samples(self.get_argument("projectid", None))))
+        samples = yield self.fetch_analyzed_failed_samples(
+            self.get_argument("projectid", None))
+        self.write(json.dumps(samples))
 
 class SamplesDoneFailed(RequestHandler):
     "displays a list of Done and Failed samples"
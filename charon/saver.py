@@ -1,17 +1,34 @@
 " Charon: Context handler for saving an entity. "
 
 import logging
+import collections
 
+import tornado.gen
 import couchdb
+import couchdb.client
 
 from . import constants
+from . import settings
 from . import utils
+from . import cache
+from . import logwriter
+from . import coalescer
+from . import asyncdb
 
 
+# Counts of revision conflicts when saving, per doctype and outcome:
+# 'retried' for each retry, 'merged' if saved after retry,
+# 'failed' if not saved due to overlapping changes or too many retries.
+conflicts = collections.defaultdict(collections.Counter)
+
+# Counts of saves skipped since nothing was changed, per doctype.
+unchanged = collections.Counter()
+
 class Field(object):
     "Specification of a data field for an entity."
 
     type ='text'
+    unique_view = None      # View to check uniqueness of the value, if any.
 
     def __init__(self, key, title=None, description=None,
                  mandatory=False, editable=True, default=None):
@@ -39,6 +56,7 @@ class Field(object):
         if check_only: return
         if self.default is not None and value is None:
             value = self.default
+        saver.stored[self.key] = value
         if value == saver.doc.get(self.key):
             logging.debug("Field.store: '%s' value equal", self.key)
             return
@@ -75,6 +93,36 @@ class Field(object):
         "Check that the value, if provided, is valid."
         pass
 
+    def get_unique_key(self, saver, value):
+        """Return the key in the 'unique_view' for the value, in the
+        context of the entity of the saver."""
+        return value
+
+    def find_existing(self, db, keys):
+        """Return the set of those of the keys which already exist
+        in the 'unique_view', using one multi-key view query."""
+        if not keys: return set()
+        keys = [list(k) if isinstance(k, tuple) else k for k in keys]
+        result = set()
+        for row in db.view(self.unique_view, keys=keys):
+            if isinstance(row.key, list):
+                result.add(tuple(row.key))
+            else:
+                result.add(row.key)
+        return result
+
+    def check_unique(self, saver, value):
+        """Raise ValueError if the value already exists.
+        Use the set of existing keys given to the saver, if any,
+        else query the database."""
+        key = self.get_unique_key(saver, value)
+        try:
+            existing = saver.existing[self.key]
+        except KeyError:
+            existing = self.find_existing(saver.db, [key])
+        if key in existing:
+            raise ValueError('not unique')
+
     def html_display(self, entity):
         "Return the field value as valid HTML."
         return str(entity.get(self.key) or '-')
@@ -107,6 +155,8 @@ class IdField(Field):
         logging.debug('IdField.check_valid')
         if not constants.ALLOWED_ID_CHARS.match(value):
             raise ValueError('invalid identifier value (disallowed characters)')
+        if self.unique_view:
+            self.check_unique(saver, value)
 
 
 class SelectField(Field):
@@ -257,6 +307,8 @@ class Saver(object):
     doctype = None
     fields = []
     field_keys = []
+    patchable = True            # May small changes be saved as a patch?
+    max_retries = None          # After conflict; None means from settings.
 
     def __init__(self, doc=None, rqh=None, db=None):
         self.fields_lookup = dict([(f.key, f) for f in self.fields])
@@ -270,8 +322,13 @@ class Saver(object):
             self.current_user = dict()
         else:
             raise AttributeError('neither db nor rqh given')
-        self.doc = doc or dict()
+        # A Document, unlike a dict, may be put in the weak request caches.
+        self.doc = doc or couchdb.client.Document()
+        self.base = dict(self.doc)      # The revision the changes apply to.
         self.changed = dict()
+        self.stored = dict()            # All values stored, changed or not.
+        self.unchanged = False          # Set if save skipped; no changes.
+        self.existing = dict()          # Field key -> set of existing keys
         if '_id' in self.doc:
             assert self.doctype == self.doc[constants.DB_DOCTYPE]
         else:
@@ -284,14 +341,215 @@ class Saver(object):
 
     def __exit__(self, type, value, tb):
         if type is not None: return False # No exceptions handled here
+        self.save()
+
+    def save(self):
+        """Save the entity and create a log entry for it.
+        Nothing is done if the entity exists and nothing was changed.
+        A small change of an existing entity is applied by the 'patch'
+        update handler, so that it does not conflict with changes of other
+        fields. Raise IOError if document revision update conflict, or if
+        a changed field was changed by other."""
+        refresh(self.db, [self])
+        if self.elide(): return
+        self.finalize()
+        if self.is_patch():
+            self.doc['_rev'] = update_doc(self.db, 'entity/patch',
+                                          self.doc['_id'],
+                                          self.get_patch())[0]
+        else:
+            retries = 0
+            while True:
+                try:
+                    self.db.save(self.doc)
+                    break
+                except couchdb.http.ResourceConflict:
+                    self.check_retry(retries)
+                    self.merge(self.db.get(self.doc['_id']))
+                    retries += 1
+            if retries:
+                conflicts[self.doctype]['merged'] += 1
+        cache.evict(self.doc['_id'], rev=self.doc['_rev'])
+        logwriter.log(self.db, self.doc,
+                      changed=self.changed,
+                      current_user=self.current_user)
+
+    @tornado.gen.coroutine
+    def save_async(self):
+        """Non-blocking version of 'save', for coroutine request handlers.
+        Use instead of the context handler; call after 'store'.
+        If coalescing is active, the entity and its log entry are saved
+        together with those of other requests, and no patch is used."""
+        yield refresh_async(self.rqh.adb, [self])
+        if self.elide(): return
         self.finalize()
+        adb = self.rqh.adb
         try:
-            self.db.save(self.doc)
+            if self.is_patch() and not coalescer.is_active():
+                rev, data = yield adb.update_doc('entity/patch',
+                                                 self.doc['_id'],
+                                                 self.get_patch())
+                self.doc['_rev'] = rev
+            else:
+                retries = 0
+                while True:
+                    try:
+                        yield coalescer.save(adb, self.doc)
+                        break
+                    except couchdb.http.ResourceConflict:
+                        self.check_retry(retries)
+                        try:
+                            latest = yield adb.get(self.doc['_id'])
+                        except couchdb.http.ResourceNotFound:
+                            latest = None
+                        self.merge(latest)
+                        retries += 1
+                if retries:
+                    conflicts[self.doctype]['merged'] += 1
         except couchdb.http.ResourceConflict:
             raise IOError('document revision update conflict')
-        utils.log(self.db, self.doc,
-                  changed=self.changed,
-                  current_user=self.current_user)
+        except couchdb.http.ResourceNotFound:
+            raise IOError('document has been deleted')
+        cache.evict(self.doc['_id'], rev=self.doc['_rev'])
+        entry = utils.get_log_entry(self.doc,
+                                    changed=self.changed,
+                                    current_user=self.current_user)
+        if not logwriter.put(entry):
+            yield coalescer.save(asyncdb.get_log_db(), entry)
+
+    def elide(self):
+        """Is the save to be skipped, since the entity exists and nothing
+        was changed? If so, set the 'unchanged' flag and count it.
+        Call 'refresh' first, in case the document is stale."""
+        if self.is_new() or self.changed: return False
+        self.unchanged = True
+        unchanged[self.doctype] += 1
+        logging.debug("unchanged %s; not saved", self.doc['_id'])
+        return True
+
+    def is_unverified(self):
+        """Must the document be compared with its latest revision before
+        the save is elided? Only if nothing was changed, and the document
+        may be a stale one from the entity cache."""
+        return not self.is_new() and not self.changed and cache.is_active()
+
+    def rebase(self, latest):
+        """Apply the stored values to the latest revision of the entity,
+        if the document was an earlier one. The values which differ
+        from those of the latest revision are the changes to save."""
+        if latest is None or latest['_rev'] == self.doc['_rev']: return
+        logging.debug("rebasing %s on rev %s", latest['_id'], latest['_rev'])
+        self.base = dict(latest)
+        self.doc.clear()
+        self.doc.update(latest)
+        for key, value in self.stored.iteritems():
+            if latest.get(key) != value:
+                self.doc[key] = value
+                self.changed[key] = value
+
+    def get_max_retries(self):
+        """Return the maximum number of retries of a save for this doctype,
+        after a revision conflict. Setting SAVE_RETRIES is a lookup
+        by doctype; 'default' for any other."""
+        if self.max_retries is not None: return self.max_retries
+        retries = settings.get('SAVE_RETRIES', dict())
+        return retries.get(self.doctype, retries.get('default', 0))
+
+    def check_retry(self, retries):
+        """Raise IOError if no more retries are allowed after a revision
+        conflict, or if this saver is not used for the whole change."""
+        if self.is_new() or retries >= self.get_max_retries():
+            conflicts[self.doctype]['failed'] += 1
+            raise IOError('document revision update conflict')
+        conflicts[self.doctype]['retried'] += 1
+
+    def merge(self, latest):
+        """Re-apply the changes of this saver to the latest revision
+        of the entity, and check them again.
+        Raise IOError if the latest revision has other changes to the same
+        fields, or if the changes are not valid for it."""
+        if latest is None:
+            conflicts[self.doctype]['failed'] += 1
+            raise IOError('document has been deleted')
+        for key, value in self.changed.iteritems():
+            if latest.get(key) not in (self.base.get(key), value):
+                conflicts[self.doctype]['failed'] += 1
+                raise IOError("document revision update conflict;"
+                              " field '{0}' changed by other".format(key))
+        logging.debug("merging changes into %s rev %s",
+                      latest['_id'], latest['_rev'])
+        self.base = dict(latest)
+        self.doc.clear()
+        self.doc.update(latest)
+        self.doc.update(self.changed)
+        try:
+            for key in self.changed:
+                try:
+                    field = self.fields_lookup[key]
+                except KeyError:
+                    continue
+                field.store(self, data=self.changed, check_only=True)
+        except ValueError, msg:
+            conflicts[self.doctype]['failed'] += 1
+            raise IOError("document revision update conflict; {0}".format(msg))
+        self.finalize()
+
+    def is_patch(self):
+        """Is the change to be saved as a patch using the update handler?
+        Only if the entity exists, and the change is small."""
+        if not self.patchable or self.is_new(): return False
+        return 0 < len(self.changed) <= settings.get('PATCH_MAX_FIELDS', 5)
+
+    def get_patch(self):
+        """Return the body for the 'patch' update handler: the changed
+        fields and the modified timestamp to set, and the base value
+        of each changed field, which must still be the stored value."""
+        patch = dict(self.changed)
+        patch['modified'] = self.doc['modified']
+        base = dict([(k, self.base.get(k)) for k in self.changed])
+        return dict(set=patch, base=base)
+
+    def increment(self, deltas):
+        """Add the numbers in the dictionary to the fields, using the
+        'increment' update handler; there is no conflict with other
+        changes. Save the entity, and create a log entry for it.
+        Raise IOError if the entity has been deleted."""
+        self.finalize()
+        rev, data = update_doc(self.db, 'entity/increment', self.doc['_id'],
+                               dict(increment=deltas,
+                                    set=dict(modified=self.doc['modified'])))
+        self.doc['_rev'] = rev
+        self.doc.update(data['values'])
+        self.changed.update(data['values'])
+        cache.evict(self.doc['_id'], rev=rev)
+        logwriter.log(self.db, self.doc,
+                      changed=self.changed,
+                      current_user=self.current_user)
+
+    def transition(self, key, value, allowed=None):
+        """Set the status field to the value, using the 'transition' update
+        handler, provided that its current value in the database is among
+        the allowed values, if given. Create a log entry for it.
+        Return False if the transition was not allowed, else True."""
+        self.finalize()
+        data = dict(field=key, to=value,
+                    set=dict(modified=self.doc['modified']))
+        if allowed is not None:
+            data['from'] = list(allowed)
+        try:
+            rev = update_doc(self.db, 'entity/transition', self.doc['_id'],
+                             data)[0]
+        except IOError, msg:
+            logging.debug("transition %s to %s refused: %s", key, value, msg)
+            return False
+        self.doc['_rev'] = rev
+        self.doc[key] = value
+        self.changed[key] = value
+        cache.evict(self.doc['_id'], rev=rev)
+        logwriter.log(self.db, self.doc,
+                      changed=self.changed,
+                      current_user=self.current_user)
+        return True
 
     def __setitem__(self, key, value):
         "Update the key/value pair."
@@ -310,6 +568,7 @@ class Saver(object):
                 pass
             else:
                 value = converter(value)
+            self.stored[key] = value
             try:
                 if self.doc[key] == value: return
             except KeyError:
@@ -322,6 +581,11 @@ class Saver(object):
     def __getitem__(self, key):
         return self.doc[key]
 
+    def set_existing(self, key, existing):
+        """Set the keys already existing for the unique field,
+        to be used instead of a database query when checking it."""
+        self.existing[key] = existing
+
     def initialize(self):
         "Perform actions when creating the entity."
         self.doc['created'] = utils.timestamp()
@@ -334,9 +598,17 @@ class Saver(object):
         """Given the fields, store the data items.
         If data is None, then obtain the value from HTML form parameter.
         If 'check_only' is True, then just do validity checking, no update.
+        The values of unique fields are added to the sets of existing keys
+        given to the saver, so that another saver sharing them in the same
+        batch cannot use the same value.
         """
         for field in self.fields:
             field.store(self, data=data, check_only=check_only)
+        if check_only: return
+        for key, existing in self.existing.iteritems():
+            value = self.doc.get(key)
+            if value is None: continue
+            existing.add(self.fields_lookup[key].get_unique_key(self, value))
 
     def finalize(self):
         "Perform any final modifications before saving the entity."
@@ -347,3 +619,126 @@ class Saver(object):
             return self[key]
         except KeyError:
             return default
+
+
+def update_doc(db, name, id, data):
+    """Apply the update handler given by 'design/name' to the document
+    with the given id, sending the data as JSON.
+    Return the new revision and the decoded JSON response.
+    Raise IOError if the handler refused, or no such document."""
+    design, name = name.split('/', 1)
+    resource = db.resource('_design', design, '_update', name, id)
+    try:
+        status, headers, body = resource.put_json(body=data)
+    except couchdb.http.ResourceConflict, msg:
+        raise IOError("document update refused: {0}".format(msg))
+    except couchdb.http.ResourceNotFound:
+        raise IOError('document has been deleted')
+    return headers.get('X-Couch-Update-NewRev'), body
+
+def check_unique_batch(savers, data):
+    """For each unique field of the savers, find which of the values
+    in the data items already exist, using one query for all items,
+    and set the result in each saver. The set is shared by the savers,
+    and a value is added to it when a saver stores it, so that
+    duplicates within the batch are also found."""
+    if not savers: return
+    for field in savers[0].fields:
+        if not field.unique_view: continue
+        keys = []
+        for saver, item in zip(savers, data):
+            value = field.get(saver, data=item)
+            if value is None: continue
+            keys.append(field.get_unique_key(saver, value))
+        existing = field.find_existing(savers[0].db, keys)
+        for saver in savers:
+            saver.set_existing(field.key, existing)
+
+def save_batch(db, savers, batch_size=None):
+    """Save the entities of the savers using one _bulk_docs request per
+    batch, instead of one request per entity, and then the log entries
+    of those saved. Return the list of results for the savers:
+    None if saved, else IOError. An unchanged entity is not saved;
+    its saver gets the 'unchanged' flag."""
+    result = []
+    refresh(db, savers)
+    changed = [s for s in savers if not s.elide()]
+    for batch in get_batches(changed, batch_size):
+        errors = get_batch_result(db.update([s.doc for s in batch]))
+        result.extend(errors)
+        logwriter.write(db, get_log_entries(batch, errors))
+    return get_saver_results(savers, result)
+
+@tornado.gen.coroutine
+def save_batch_async(adb, savers, batch_size=None):
+    "Non-blocking version of 'save_batch'."
+    result = []
+    yield refresh_async(adb, savers)
+    changed = [s for s in savers if not s.elide()]
+    for batch in get_batches(changed, batch_size):
+        items = yield adb.update([s.doc for s in batch])
+        errors = get_batch_result(items)
+        result.extend(errors)
+        entries = [e for e in get_log_entries(batch, errors)
+                   if not logwriter.put(e)]
+        if entries:
+            yield asyncdb.get_log_db().update(entries)
+    raise tornado.gen.Return(get_saver_results(savers, result))
+
+def refresh(db, savers):
+    """Rebase the savers with nothing changed, whose documents may be
+    stale, on the latest revisions of their entities, obtained by one
+    request."""
+    savers = [s for s in savers if s.is_unverified()]
+    if not savers: return
+    view = db.view('_all_docs', include_docs=True,
+                   keys=[s.doc['_id'] for s in savers])
+    for saver, row in zip(savers, view):
+        saver.rebase(row.doc)
+
+@tornado.gen.coroutine
+def refresh_async(adb, savers):
+    "Non-blocking version of 'refresh'."
+    savers = [s for s in savers if s.is_unverified()]
+    if not savers: return
+    docs = yield adb.get_docs([s.doc['_id'] for s in savers])
+    for saver, doc in zip(savers, docs):
+        saver.rebase(doc)
+
+def get_saver_results(savers, results):
+    """Return the results for all savers, given those for the savers
+    that were not unchanged."""
+    results = iter(results)
+    return [None if s.unchanged else results.next() for s in savers]
+
+def get_batches(savers, batch_size=None):
+    """Generate the batches of savers for _bulk_docs requests,
+    with their entities finalized."""
+    if batch_size is None:
+        batch_size = settings.get('BULK_BATCH_SIZE', 500)
+    for start in xrange(0, len(savers), batch_size):
+        batch = savers[start:start+batch_size]
+        for saver in batch:
+            saver.finalize()
+        yield batch
+
+def get_batch_result(items):
+    """Return the results for the entities of a batch, given the items
+    of the _bulk_docs response."""
+    result = []
+    for success, id, value in items:
+        if success:
+            cache.evict(id, rev=value)
+            result.append(None)
+        elif isinstance(value, couchdb.http.ResourceConflict):
+            result.append(IOError('document revision update conflict'))
+        else:
+            result.append(IOError(str(value)))
+    return result
+
+def get_log_entries(savers, errors):
+    "Return the log entries for the entities that were saved."
+    return [utils.get_log_entry(saver.doc,
+                                changed=saver.changed,
+                                current_user=saver.current_user)
+            for saver, error in zip(savers, errors) if error is None]
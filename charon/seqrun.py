@@ -4,6 +4,7 @@ import logging
 import json
 
 import tornado.web
+import tornado.gen
 import couchdb
 
 from . import constants
@@ -18,16 +19,19 @@ from .sample import SampleSaver
 class SeqrunidField(IdField):
     "The unique identifier for the seqrun within the project."
 
+    unique_view = 'seqrun/seqrunid'
+
     def check_valid(self, saver, value):
         "Also check uniqueness."
         if not constants.RID_RX.match(value):
             raise ValueError('invalid identifier value (disallowed characters)')
-        key = (saver.project['projectid'], saver.sample['sampleid'], saver.libprep['libprepid'], value)
-        view = saver.db.view('seqrun/seqrunid')
-        if len(list(view[key])) > 0:
-            raise ValueError('not unique')
-
+        self.check_unique(saver, value)
 
+    def get_unique_key(self, saver, value):
+        return (saver.project['projectid'],
+                saver.sample['sampleid'],
+                saver.libprep['libprepid'],
+                value)
 
 
 class SeqrunSaver(Saver):
@@ -53,6 +57,15 @@ class SeqrunSaver(Saver):
 
     def __init__(self, doc=None, rqh=None, db=None, libprep=None):
         super(SeqrunSaver, self).__init__(doc=doc, rqh=rqh, db=db)
+        if libprep:
+            source = libprep
+        else:
+            source = self.doc
+        # Get the project, sample and libprep in one go.
+        rqh.prefetch((source['projectid'],),
+                     (source['projectid'], source['sampleid']),
+                     (source['projectid'], source['sampleid'],
+                      source['libprepid']))
         if self.is_new():
             assert libprep
             assert 'libprepid' not in self.doc
@@ -77,6 +90,82 @@ class SeqrunSaver(Saver):
                                                self.doc['libprepid'])
 
 
+class SampleRollupMixin(object):
+    """Mixin providing the updates of the sample values derived from
+    its seqruns, to be done when a seqrun has been created or changed.
+    The sums are obtained from the 'seqrun/rollup' reduce view; one
+    indexed read for any number of samples, regardless of the number
+    of seqruns."""
+
+    def get_sample_rollups(self, *samples):
+        """Return a lookup of (coverage, reads, number of seqruns with
+        alignment not done) keyed by (projectid, sampleid)."""
+        result = dict()
+        if not samples: return result
+        view = self.db.view('seqrun/rollup', group=True,
+                            keys=[list(s) for s in samples])
+        for row in view:
+            result[tuple(row.key)] = tuple(row.value)
+        return result
+
+    @tornado.gen.coroutine
+    def fetch_sample_rollups(self, *samples):
+        "Get the lookup of 'get_sample_rollups', without blocking."
+        result = dict()
+        if not samples: raise tornado.gen.Return(result)
+        rows = yield self.adb.view('seqrun/rollup', group=True,
+                                   keys=[list(s) for s in samples])
+        for row in rows:
+            result[tuple(row.key)] = tuple(row.value)
+        raise tornado.gen.Return(result)
+
+    def get_sample_data(self, sample, rollup):
+        """Return the values to store in the sample, given its rollup.
+        The total autosomal coverage and the total sequenced reads are
+        the sums over its seqruns, failed ones excluded. The analysis
+        status is set to ANALYZED if the alignment of all its seqruns
+        is done or failed, and the total autosomal coverage reaches
+        the target coverage of the sample."""
+        coverage, reads, running = rollup
+        data = dict(total_autosomal_coverage=coverage,
+                    total_sequenced_reads=reads)
+        if not running and \
+           coverage >= (sample.get('target_coverage') or 0):
+            data['analysis_status'] = constants.SAMPLE_ANALYSIS_STATUS['DONE']
+        return data
+
+    def get_sample_savers(self, samples, rollups):
+        "Return the savers of the samples with the derived values stored."
+        result = []
+        for sample in samples:
+            rollup = rollups.get((sample['projectid'], sample['sampleid']),
+                                 (0, 0, 0))
+            saver = SampleSaver(doc=sample, rqh=self)
+            saver.store(data=self.get_sample_data(sample, rollup))
+            result.append(saver)
+        return result
+
+    def update_samples(self, *samples):
+        """Store the values derived from the seqruns in each sample,
+        given as (projectid, sampleid), by one _bulk_docs request.
+        Raise ValueError or IOError if a sample could not be saved."""
+        rollups = self.get_sample_rollups(*samples)
+        savers = self.get_sample_savers([self.get_sample(*s) for s in samples],
+                                        rollups)
+        for error in save_batch(self.db, savers):
+            if error is not None: raise error
+
+    @tornado.gen.coroutine
+    def update_samples_async(self, *samples):
+        "Non-blocking version of 'update_samples'."
+        rollups = yield self.fetch_sample_rollups(*samples)
+        docs = yield [self.fetch_sample(*s) for s in samples]
+        savers = self.get_sample_savers(docs, rollups)
+        errors = yield save_batch_async(self.adb, savers)
+        for error in errors:
+            if error is not None: raise error
+
+
 class Seqrun(RequestHandler):
     "Display the seqrun data."
 
@@ -84,11 +173,15 @@ class Seqrun(RequestHandler):
 
     @tornado.web.authenticated
     def get(self, projectid, sampleid, libprepid, seqrunid):
+        self.prefetch((projectid,),
+                      (projectid, sampleid),
+                      (projectid, sampleid, libprepid),
+                      (projectid, sampleid, libprepid, seqrunid))
         project = self.get_project(projectid)
         sample = self.get_sample(projectid, sampleid)
         libprep = self.get_libprep(projectid, sampleid, libprepid)
         seqrun = self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
-        logs = self.get_logs(seqrun['_id']) # XXX limit?
+        logs = self.get_logs(seqrun['_id'])
         self.render('seqrun.html',
                     project=project,
                     sample=sample,
@@ -98,7 +191,7 @@ class Seqrun(RequestHandler):
                     logs=logs)
 
 
-class SeqrunCreate(RequestHandler):
+class SeqrunCreate(SampleRollupMixin, RequestHandler):
     "Create a seqrun within a libprep."
 
     saver = SeqrunSaver
@@ -124,6 +217,10 @@ class SeqrunCreate(RequestHandler):
                         fields=self.saver.fields,
                         error=str(msg))
         else:
+            try:
+                self.update_samples((projectid, sampleid))
+            except (ValueError, IOError), msg:
+                logging.warning("seqrun sample update: %s", msg)
             url = self.reverse_url('seqrun',
                                    projectid,
                                    sampleid,
@@ -132,7 +229,7 @@ class SeqrunCreate(RequestHandler):
             self.redirect(url)
 
 
-class SeqrunEdit(RequestHandler):
+class SeqrunEdit(SampleRollupMixin, RequestHandler):
     "Edit an existing seqrun."
 
     saver = SeqrunSaver
@@ -157,120 +254,82 @@ class SeqrunEdit(RequestHandler):
                         fields=self.saver.fields,
                         error=str(msg))
         else:
+            try:
+                if not saver.unchanged:
+                    self.update_samples((projectid, sampleid))
+            except (ValueError, IOError), msg:
+                logging.warning("seqrun sample update: %s", msg)
             url = self.reverse_url('seqrun', projectid, sampleid, libprepid, seqrunid)
             self.redirect(url)
 
 
-class ApiSeqrun(ApiRequestHandler):
+class ApiSeqrun(SampleRollupMixin, ApiRequestHandler):
     "Access a seqrun in a libprep."
 
     saver = SeqrunSaver
 
+    @tornado.gen.coroutine
     def get(self, projectid, sampleid, libprepid, seqrunid):
         """Return the seqrun data.
         Return HTTP 404 if no such seqrun, libprep, sample or project."""
-        seqrun = self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
+        seqrun = yield self.loader.fetch(projectid, sampleid,
+                                         libprepid, seqrunid)
         if not seqrun: return
         self.add_seqrun_links(seqrun)
         self.write(seqrun)
 
+    @tornado.gen.coroutine
     def put(self, projectid, sampleid, libprepid, seqrunid):
         """Update the seqrun data.
         Return HTTP 204 "No Content".
         Return HTTP 404 if no such seqrun, libprep, sample or project.
-        Return HTTP 400 if any problem with a value."""
-        seqrun = self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
+        Return HTTP 400 if any problem with a value.
+        Return HTTP 409 if there is a document revision conflict."""
         try:
+            seqrun = yield self.loader.fetch(projectid, sampleid,
+                                             libprepid, seqrunid)
             data = json.loads(self.request.body)
+        except tornado.web.HTTPError:
+            raise
         except Exception, msg:
             self.send_error(400, reason=str(msg))
         else:
             try:
-                with self.saver(doc=seqrun, rqh=self) as saver:
-                    saver.store(data=data)
+                saver = self.saver(doc=seqrun, rqh=self)
+                saver.store(data=data)
+                yield saver.save_async()
             except ValueError, msg:
                 self.send_error(400, reason=str(msg))
             except IOError, msg:
                 self.send_error(409, reason=str(msg))
             else:
-                self.set_status(204)
-                self.update_sample_analysis_status(projectid,sampleid)
+                # The seqrun is saved; a failed sample update is no error.
+                try:
+                    if not saver.unchanged:
+                        yield self.update_samples_async((projectid,
+                                                         sampleid))
+                except (ValueError, IOError), msg:
+                    logging.warning("seqrun sample update: %s", msg)
+                self.set_updated_status(saver)
 
     def delete(self, projectid, sampleid, libprepid, seqrunid):
         """NOTE: This is for unit test purposes only!
         Delete the libprepand all of its dependent entities.
-        Returns HTTP 204 "No Content"."""
+        Returns HTTP 204 "No Content".
+        Returns HTTP 503 if the log entries could not be written first."""
         seqrun= self.get_seqrun(projectid, sampleid, libprepid, seqrunid)
         if not seqrun: return
-        utils.delete_seqrun(self.db, seqrun)
-        logging.debug("deleted seqrun {0}, {1}, {2}",
-                      projectid, sampleid, libprepid, seqrunid)
-        self.set_status(204)
-                
-    def update_sample_analysis_status(self,projectid,sampleid):
-        """This will update the sample_amalysis_status according to the current state of the data"""
-        update=True
-        seqruns = self.get_seqruns(projectid, sampleid)
-        for seqrun in seqruns:
-            if seqrun.get('alignment_status') not in ['DONE', 'FAILED']:
-                update=False
-                break
-        doc= self.get_sample(projectid, sampleid)
-        if doc.get('total_autosomal_coverage')< doc.get('target_coverage'):
-            update=False
-
-        if update:
-            doc['analysis_status']='ANALYZED'
-            try:
-                with SampleSaver(doc=doc, rqh=self) as saver:
-                    saver.store(data=doc)#failing to provide data will end up in an empty record.
-            except ValueError, msg:
-                self.send_error(400, reason=str("failed to update sample "+msg))
-            except IOError, msg:
-                self.send_error(409, reason=str(msg))
-            else:
-                self.set_status(204)
-
-
-
-    def update_sample_cov(self, projectid, sampleid):
-        """this calculates the total of each mean autosomalcoverage and updates sample level.
-        This should be done every time a seqrun is updated/created
-        This also updated total_sequenced_reads"""
         try:
-            seqruns = self.get_seqruns(projectid, sampleid)
-            totalcov=0
-            totalreads=0
-            for seqrun in seqruns:
-                if seqrun['alignment_status'] != constants.SEQRUN_ANALYSIS_STATUS['FAILED']:
-                    if seqrun.get('mean_autosomal_coverage'):
-                        totalcov+=float(seqrun['mean_autosomal_coverage'])
-                    if seqrun.get('total_reads'):
-                        totalreads+=float(seqrun['total_reads'])
-            
-            doc= self.get_sample(projectid, sampleid)
-
-            doc['total_autosomal_coverage']=totalcov
-            doc['total_sequenced_reads']=totalreads
-            logging.info(doc)
-        except Exception, msg:
-            self.send_error(400, reason=str("Failed to update total_autosomal_coverage and total_sequenced_reads. Check that the reads field and the mean_autosomal_coverage field are not set to None"+msg))
+            count = utils.delete_seqrun(self.db, seqrun)
         except IOError, msg:
-            self.send_error(409, reason=str(msg))
-        else:
-            try:
-                with SampleSaver(doc=doc, rqh=self) as saver:
-                    saver.store(data=doc)#failing to provide data will end up in an empty record.
-            except ValueError, msg:
-                self.send_error(400, reason=str("failed to update sample "+msg))
-            except IOError, msg:
-                self.send_error(409, reason=str(msg))
-            else:
-                self.set_status(204)
-
+            self.send_error(503, reason=str(msg))
+            return
+        logging.debug("deleted seqrun {0}, {1}, {2}",
+                      projectid, sampleid, libprepid, seqrunid)
+        self.set_deleted_status(count)
 
 
-class ApiSeqrunCreate(ApiRequestHandler):
+class ApiSeqrunCreate(SampleRollupMixin, ApiRequestHandler):
     "Create a seqrun within a libprep."
 
     saver = SeqrunSaver
@@ -301,77 +360,24 @@ class ApiSeqrunCreate(ApiRequestHandler):
                                        sampleid,
                                        libprepid,
                                        seqrun['seqrunid'])
-                self.update_sample_analysis_status(projectid, sampleid)
+                # The seqrun is saved; a failed sample update is no error.
+                try:
+                    self.update_samples((projectid, sampleid))
+                except (ValueError, IOError), msg:
+                    logging.warning("seqrun sample update: %s", msg)
                 self.set_header('Location', url)
                 self.set_status(201)
                 self.add_seqrun_links(seqrun)
                 self.write(seqrun)
 
-    def update_sample_analysis_status(self,projectid,sampleid):
-        """This will update the sample_amalysis_status according to the current state of the data"""
-        update=True
-        seqruns = self.get_seqruns(projectid, sampleid)
-        for seqrun in seqruns:
-            if seqrun.get('alignment_status') not in ['DONE', 'FAILED']:
-                update=False
-                break
-        doc= self.get_sample(projectid, sampleid)
-        if doc.get('total_autosomal_coverage')< doc.get('target_coverage'):
-            update=False
-
-        if update:
-            doc['analysis_status']='ANALYZED'
-            try:
-                with SampleSaver(doc=doc, rqh=self) as saver:
-                    saver.store(data=doc)#failing to provide data will end up in an empty record.
-            except ValueError, msg:
-                self.send_error(400, reason=str("failed to update sample "+msg))
-            except IOError, msg:
-                self.send_error(409, reason=str(msg))
-                
-    def update_sample_cov(self, projectid, sampleid):
-        """this calculates the total of each mean autosomal coverage and updates sample leve.
-        This should be done every time a seqrun is updated/created"""
-        logging.debug('Updating total_sequenced_reads and total_autosomal_coverage of sample {0}'.format(sampleid))    
-        try:
-            seqruns = self.get_seqruns(projectid, sampleid)
-            totalcov=0
-            totalreads=0
-            for seqrun in seqruns:
-                if seqrun['alignment_status'] != constants.SEQRUN_ANALYSIS_STATUS['FAILED']:
-                    if seqrun['mean_autosomal_coverage']:
-                        totalcov+=float(seqrun['mean_autosomal_coverage'])
-                    if seqrun['total_reads']:
-                        totalreads+=float(seqrun['total_reads'])
-            
-            doc= self.get_sample(projectid, sampleid)
-
-            doc['total_autosomal_coverage']=totalcov
-            doc['total_sequenced_reads']=totalreads
-        except Exception, msg:
-            self.send_error(400, reason=str(msg))
-        except IOError, msg:
-            self.send_error(409, reason=str(msg))
-        else:
-            try:
-                with SampleSaver(doc=doc, rqh=self) as saver:
-                    saver.store(data=doc)#failing to provide data will end up in an empty record.
-            except ValueError, msg:
-                self.send_error(400, reason=str("Failed to update total_autosomal_coverage and total_sequenced_reads. Check that the reads field and the mean_autosomal_coverage field are not set to None"+msg))
-            except IOError, msg:
-                self.send_error(409, reason=str(msg))
-            else:
-                self.set_status(201)
-
-
-
 
 class ApiProjectSeqruns(ApiRequestHandler):
     "Access to all seqruns for a project."
 
+    @tornado.gen.coroutine
     def get(self, projectid):
         "Return list of all seqruns for the given project."
-        seqruns = self.get_seqruns(projectid)
+        seqruns = yield self.fetch_seqruns(projectid)
         for seqrun in seqruns:
             self.add_seqrun_links(seqrun)
         self.write(dict(seqruns=seqruns))
@@ -380,9 +386,10 @@ class ApiProjectSeqruns(ApiRequestHandler):
 class ApiSampleSeqruns(ApiRequestHandler):
     "Access to all seqruns for a sample."
 
+    @tornado.gen.coroutine
     def get(self, projectid, sampleid):
         "Return list of all seqruns for the given sample and project."
-        seqruns = self.get_seqruns(projectid, sampleid)
+        seqruns = yield self.fetch_seqruns(projectid, sampleid)
         for seqrun in seqruns:
             self.add_seqrun_links(seqrun)
         self.write(dict(seqruns=seqruns))
@@ -391,22 +398,48 @@ class ApiSampleSeqruns(ApiRequestHandler):
 class ApiLibprepSeqruns(ApiRequestHandler):
     "Access to all seqruns for a libprep."
 
+    @tornado.gen.coroutine
     def get(self, projectid, sampleid, libprepid):
         "Return list of all seqruns for the given libprep, sample and project."
-        seqruns = self.get_seqruns(projectid, sampleid, libprepid)
+        seqruns = yield self.fetch_seqruns(projectid, sampleid, libprepid)
         for seqrun in seqruns:
             self.add_seqrun_links(seqrun)
         self.write(dict(seqruns=seqruns))
 
 class ApiSeqrunsDone(ApiRequestHandler):
-    "Accesses all seqruns either failed or analyzed"
+    "Accesses all seqruns having alignment done."
 
+    @tornado.gen.coroutine
     def get(self):
-        seqruns=self.get_seqruns()
-        filtered_seqr=[]
-        for s in seqruns:
-            if s.get('alignment_status') in constants.EXTENDED_STATUS[2:3]:
-                filtered_seqr.append(s)
-
-        self.write(json.dumps(filtered_seqr))
+        status = constants.SEQRUN_ANALYSIS_STATUS['DONE']
+        seqruns = (yield self.fetch_seqruns_by_status(status))[0]
+        self.write(json.dumps(seqruns))
+
+
+class ApiSeqrunsByStatus(ApiRequestHandler):
+    """Access to the seqruns having a given alignment status.
+    Optional query parameters: 'field' for another status field,
+    i.e. 'genotype_status', 'projectid' to restrict to a project,
+    'limit' for the maximum number of seqruns to return, and 'cursor'
+    as returned by the previous call, to get the next page."""
+
+    @tornado.gen.coroutine
+    def get(self, status):
+        """Return a list of seqruns and the cursor for the next page,
+        which is null if there are no more seqruns.
+        Return HTTP 400 if the field, limit or cursor is invalid."""
+        try:
+            limit = self.get_limit()
+            seqruns, cursor = yield self.fetch_seqruns_by_status(
+                status,
+                projectid=self.get_argument('projectid', None),
+                limit=limit,
+                cursor=self.get_argument('cursor', None),
+                field=self.get_argument('field', 'alignment_status'))
+        except ValueError, msg:
+            self.send_error(400, reason=str(msg))
+        else:
+            for seqrun in seqruns:
+                self.add_seqrun_links(seqrun)
+            self.write(dict(seqruns=seqruns, cursor=cursor))
 
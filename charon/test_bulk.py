@@ -0,0 +1,101 @@
+""" Charon: nosetests /api/v1/bulk 
+Requires env vars CHARON_API_TOKEN and CHARON_BASE_URL.
+"""
+
+import os
+import json
+import requests
+import nose
+
+def url(*segments):
+    "Synthesize absolute URL from path segments."
+    return "{0}api/v1/{1}".format(BASE_URL,'/'.join([str(s) for s in segments]))
+
+API_TOKEN = os.getenv('CHARON_API_TOKEN')
+if not API_TOKEN: raise ValueError('no API token')
+BASE_URL = os.getenv('CHARON_BASE_URL')
+if not BASE_URL: raise ValueError('no base URL')
+
+PROJECTID = 'P0'
+
+api_token = {'X-Charon-API-token': API_TOKEN}
+session = requests.Session()
+
+
+def my_teardown():
+    "Delete the project and all its dependents."
+    session.delete(url('project', PROJECTID), headers=api_token)
+
+@nose.with_setup(None, my_teardown)
+def test_bulk_create_update():
+    "Create a project with samples, libpreps and seqruns, then update."
+    sampleids = ["S{0}".format(i) for i in xrange(10)]
+    data = dict(projects=[dict(projectid=PROJECTID)],
+                samples=[dict(projectid=PROJECTID, sampleid=s)
+                         for s in sampleids],
+                libpreps=[dict(projectid=PROJECTID, sampleid=s, libprepid='A')
+                          for s in sampleids],
+                seqruns=[dict(projectid=PROJECTID, sampleid=s, libprepid='A',
+                              seqrunid='1337_A', mean_autosomal_coverage=1.0)
+                         for s in sampleids])
+    response = session.post(url('bulk'),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    result = response.json()
+    for key in ['projects', 'samples', 'libpreps', 'seqruns']:
+        assert [r['status'] for r in result[key]] == [201] * len(data[key])
+    response = session.get(url('samples', PROJECTID), headers=api_token)
+    assert len(response.json()['samples']) == len(sampleids)
+    # Update, with one invalid and one duplicate item.
+    data = dict(samples=[dict(projectid=PROJECTID, sampleid='S0', qc='DONE'),
+                         dict(projectid=PROJECTID, sampleid='S1', qc='x'),
+                         dict(projectid=PROJECTID, sampleid='S0'),
+                         dict(projectid='P_no_such', sampleid='S0')])
+    response = session.post(url('bulk'),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    statuses = [r['status'] for r in response.json()['samples']]
+    assert statuses == [204, 400, 400, 404], statuses
+    response = session.get(url('sample', PROJECTID, 'S0'), headers=api_token)
+    assert response.json()['qc'] == 'DONE'
+
+def delete_projects():
+    "Delete the projects of the test of unique names."
+    for projectid in [PROJECTID, 'P1']:
+        session.delete(url('project', projectid), headers=api_token)
+
+@nose.with_setup(None, delete_projects)
+def test_bulk_create_parent_and_child():
+    "A project and its sample are created in the same request."
+    data = dict(projects=[dict(projectid=PROJECTID)],
+                samples=[dict(projectid=PROJECTID, sampleid='S0')])
+    response = session.post(url('bulk'),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    result = response.json()
+    assert result['projects'][0]['status'] == 201, result
+    assert result['samples'][0]['status'] == 201, result
+    response = session.get(url('sample', PROJECTID, 'S0'), headers=api_token)
+    assert response.status_code == 200, response
+
+def test_bulk_invalid():
+    "Input of the wrong form is rejected."
+    response = session.post(url('bulk'),
+                            data=json.dumps(dict(samples='S1')),
+                            headers=api_token)
+    assert response.status_code == 400, response
+
+@nose.with_setup(None, delete_projects)
+def test_bulk_unique_within_request():
+    "A unique value may not occur twice in the same request."
+    data = dict(projects=[dict(projectid=PROJECTID, name='P.Bulk_14_01'),
+                          dict(projectid='P1', name='P.Bulk_14_01')])
+    response = session.post(url('bulk'),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 200, response
+    statuses = [r['status'] for r in response.json()['projects']]
+    assert statuses == [201, 400], statuses
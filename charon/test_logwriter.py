@@ -0,0 +1,54 @@
+""" Charon: nosetests charon.logwriter
+Uses no database; the log writer writes to an object in memory.
+"""
+
+import os
+import time
+import tempfile
+import threading
+
+from charon import logwriter
+
+
+class SlowDb(object):
+    "Stands in for the log database. The first write waits for the gate."
+
+    def __init__(self):
+        self.docs = dict()
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+
+    def update(self, batch):
+        self.entered.set()
+        self.gate.wait(10)
+        time.sleep(0.2)
+        for doc in batch:
+            self.docs[doc['_id']] = doc
+        return [(True, doc['_id'], '1') for doc in batch]
+
+
+def test_flush_after_overflow():
+    "An entry spooled only is written before a flush after it returns."
+    spoolpath = tempfile.mktemp(prefix='charon_spool')
+    db = SlowDb()
+    writer = logwriter.LogWriter(db, spoolpath, queue_size=2,
+                                 batch_size=10, interval=0.5)
+    writer.start()
+    try:
+        writer.put(dict(_id='e0'))
+        assert db.entered.wait(5)
+        for id in ['e1', 'e2', 'e3']: # The queue is full at 'e3'.
+            writer.put(dict(_id=id))
+        assert writer.overflow is not None
+        db.gate.set()
+        deadline = time.time() + 5
+        while not writer.queue.empty():
+            assert time.time() < deadline
+            time.sleep(0.01)
+        writer.put(dict(_id='e4')) # Queued, after the overflow.
+        assert writer.flush(10)
+        assert sorted(db.docs) == ['e0', 'e1', 'e2', 'e3', 'e4'], db.docs
+    finally:
+        writer.stop(10)
+        if os.path.exists(spoolpath):
+            os.remove(spoolpath)
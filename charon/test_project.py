@@ -4,6 +4,7 @@ Requires env vars CHARON_API_TOKEN and CHARON_BASE_URL.
 
 import os
 import json
+import time
 import requests
 
 def url(*segments):
@@ -59,6 +60,41 @@ def test_projects_list():
             break
     assert project, 'project must exist in list'
 
+def test_projects_list_db_requests():
+    "The number of database requests for the projects list is constant."
+    def count():
+        response = session.get(url('projects'), headers=api_token)
+        assert response.status_code == 200, response
+        return int(response.headers['X-Charon-DB-Requests'])
+    count()                     # Warm up caches for user lookup.
+    before = count()
+    projectids = ["{0}_{1}".format(PROJECTID, i) for i in range(3)]
+    for projectid in projectids:
+        data = dict(projectid=projectid)
+        response = session.post(url('project'),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    try:
+        after = count()
+    finally:
+        for projectid in projectids:
+            session.delete(url('project', projectid), headers=api_token)
+    assert after == before, 'number of requests must not depend on projects'
+    # One for the API token; the projects, and four grouped counts.
+    # The user is in the entity cache after the first call.
+    assert after == 6, after
+
+def test_project_summary():
+    "Get the sample summary for a project."
+    response = session.get(url('summary'),
+                           params=dict(projectid=PROJECTID),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    data = response.json()
+    for key in ['tot', 'ab', 'passed', 'failed', 'ana', 'runn', 'seq', 'cov']:
+        assert key in data, key
+
 def test_project_modify():
     "Modify the fields of a project."
     response = session.get(url('project', PROJECTID), headers=api_token)
@@ -86,10 +122,11 @@ def test_project_modify_undef_field():
                            data=json.dumps(data),
                            headers=api_token)
     assert response.status_code == 204, response
+    assert response.headers.get('X-Charon-Unchanged') == 'true'
     response = session.get(url('project', PROJECTID), headers=api_token)
     assert response.status_code == 200, response
     newdata = response.json()
-    assert newdata['_rev'] != olddata['_rev'], 'new document revision'
+    assert newdata['_rev'] == olddata['_rev'], 'no new document revision'
     assert newdata.get('stuff') is None, 'undef must not have been updated'
 
 def test_project_modify_status_field():
@@ -119,3 +156,102 @@ def test_project_delete():
     response = session.delete(url('project', PROJECTID), headers=api_token)
     assert response.status_code == 204, response
     assert len(response.content) == 0, 'no content in response'
+
+def test_project_delete_cascade():
+    "Delete a project, its samples and libpreps, and their log entries."
+    data = dict(projectid=PROJECTID)
+    response = session.post(url('project'),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 201, response
+    for sampleid in ['S1', 'S2']:
+        data = dict(sampleid=sampleid)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+        data = dict(libprepid='A')
+        response = session.post(url('libprep', PROJECTID, sampleid),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    response = session.delete(url('project', PROJECTID), headers=api_token)
+    assert response.status_code == 204, response
+    # Five entities, and at least one log entry for each.
+    assert int(response.headers['X-Charon-Deleted']) >= 10
+    response = session.get(url('sample', PROJECTID, 'S1'), headers=api_token)
+    assert response.status_code == 404, response
+    response = session.get(url('libprep', PROJECTID, 'S2', 'A'),
+                           headers=api_token)
+    assert response.status_code == 404, response
+
+def test_project_logs_paging():
+    "Get the log entries of a project, most recent first, page by page."
+    data = dict(projectid=PROJECTID)
+    response = session.post(url('project'),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 201, response
+    project = response.json()
+    for name in ['P.Logs_1', 'P.Logs_2', 'P.Logs_3']:
+        response = session.put(url('project', PROJECTID),
+                               data=json.dumps(dict(name=name)),
+                               headers=api_token)
+        assert response.status_code == 204, response
+    time.sleep(2.0)             # Allow for the write-behind of log entries.
+    response = session.get(url('logs', project['_id']),
+                           params=dict(limit=3),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    data = response.json()
+    assert len(data['logs']) == 3
+    assert data['logs'][0]['changed'].get('name') == 'P.Logs_3'
+    timestamps = [l['timestamp'] for l in data['logs']]
+    assert timestamps == sorted(timestamps, reverse=True)
+    assert data['cursor'] is not None
+    response = session.get(url('logs', project['_id']),
+                           params=dict(limit=3, cursor=data['cursor']),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    data = response.json()
+    assert len(data['logs']) == 1, 'the log entry for the creation'
+    assert data['cursor'] is None
+    response = session.get(url('logs', project['_id']),
+                           params=dict(limit=0),
+                           headers=api_token)
+    assert response.status_code == 400, response
+    response = session.delete(url('project', PROJECTID), headers=api_token)
+    assert response.status_code == 204, response
+
+def test_project_log_search():
+    "Search the log entries by changed field and by doctype."
+    data = dict(projectid=PROJECTID)
+    response = session.post(url('project'),
+                            data=json.dumps(data),
+                            headers=api_token)
+    assert response.status_code == 201, response
+    project = response.json()
+    response = session.put(url('project', PROJECTID),
+                           data=json.dumps(dict(status='CLOSED')),
+                           headers=api_token)
+    assert response.status_code == 204, response
+    time.sleep(2.0)             # Allow for the write-behind of log entries.
+    response = session.get(url('logsearch'),
+                           params=dict(doc=project['_id'], field='status'),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    logs = response.json()['logs']
+    assert logs[0]['changed']['status'] == 'CLOSED'
+    response = session.get(url('logsearch'),
+                           params=dict(doctype='project',
+                                       since=project['created']),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    ids = [l['doc'] for l in response.json()['logs']]
+    assert project['_id'] in ids
+    response = session.get(url('logsearch'),
+                           params=dict(operator='x', doctype='project'),
+                           headers=api_token)
+    assert response.status_code == 400, response
+    response = session.delete(url('project', PROJECTID), headers=api_token)
+    assert response.status_code == 204, response
@@ -107,3 +107,69 @@ def test_sample_create_collision():
                             data=json.dumps(data),
                             headers=api_token)
     assert response.status_code == 400, response
+
+@nose.with_setup(my_setup, my_teardown)
+def test_samples_query_db_requests():
+    "The number of database requests for a samples query is constant."
+    query = dict(projectid=PROJECTID, sampleField='sampleid',
+                 operator='is', value='x', type='unicode')
+    counts = []
+    for sampleid in ['S1', 'S2', 'S3']:
+        data = dict(sampleid=sampleid)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+        response = session.post(url('customquery'),
+                                data=json.dumps(query),
+                                headers=api_token)
+        assert response.status_code == 200, response
+        counts.append(int(response.headers['X-Charon-DB-Requests']))
+    assert counts[1] == counts[2], 'must not depend on number of samples'
+
+@nose.with_setup(my_setup, my_teardown)
+def test_samples_not_done_db_requests():
+    "The samples not done are listed by one database request."
+    for sampleid in ['S1', 'S2', 'S3']:
+        data = dict(sampleid=sampleid)
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    response = session.get(url('samplesnotdone', PROJECTID),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    assert len(response.json()['samples']) == 3, response.json()
+    # One for the API token, and one for the samples.
+    assert int(response.headers['X-Charon-DB-Requests']) == 2
+
+@nose.with_setup(my_setup, my_teardown)
+def test_samples_by_status_paging():
+    "Get the samples having a status for a project, page by page."
+    for sampleid in ['S1', 'S2', 'S3']:
+        data = dict(sampleid=sampleid, analysis_status='ANALYZED')
+        response = session.post(url('sample', PROJECTID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response
+    params = dict(projectid=PROJECTID, limit=2)
+    response = session.get(url('samplesbystatus', 'ANALYZED'),
+                           params=params,
+                           headers=api_token)
+    assert response.status_code == 200, response
+    data = response.json()
+    assert [s['sampleid'] for s in data['samples']] == ['S1', 'S2']
+    assert data['cursor']
+    params['cursor'] = data['cursor']
+    response = session.get(url('samplesbystatus', 'ANALYZED'),
+                           params=params,
+                           headers=api_token)
+    assert response.status_code == 200, response
+    data = response.json()
+    assert [s['sampleid'] for s in data['samples']] == ['S3']
+    assert data['cursor'] is None
+    params['cursor'] = 'garbage'
+    response = session.get(url('samplesbystatus', 'ANALYZED'),
+                           params=params,
+                           headers=api_token)
+    assert response.status_code == 400, response
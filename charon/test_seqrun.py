@@ -4,6 +4,8 @@ Requires env vars CHARON_API_TOKEN and CHARON_BASE_URL.
 
 import os
 import json
+import base64
+import multiprocessing.pool
 import requests
 import nose
 
@@ -91,6 +93,111 @@ def test_create_seqrun():
                             headers=api_token)
     assert response.status_code == 400, response.reason
 
+@nose.with_setup(my_setup, my_teardown)
+def test_seqruns_list_db_requests():
+    "The number of database requests for a seqruns list is constant."
+    counts = []
+    for seqrunid in ['1337_A', '1337_B', '1337_C']:
+        data = dict(seqrunid=seqrunid, mean_autosomal_coverage=0.0)
+        response = session.post(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response.reason
+        response = session.get(url('seqruns', PROJECTID), headers=api_token)
+        assert response.status_code == 200, response
+        counts.append(int(response.headers['X-Charon-DB-Requests']))
+    assert len(response.json()['seqruns']) == 3
+    assert counts[1] == counts[2], 'must not depend on number of seqruns'
+
+@nose.with_setup(my_setup, my_teardown)
+def test_seqruns_by_status():
+    "Seqruns are listed by alignment status, for the project only."
+    for seqrunid, status in [('1337_A', 'DONE'), ('1337_B', 'RUNNING')]:
+        data = dict(seqrunid=seqrunid,
+                    alignment_status=status,
+                    mean_autosomal_coverage=0.0)
+        response = session.post(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response.reason
+    response = session.get(url('seqrunsbystatus', 'DONE'),
+                           params=dict(projectid=PROJECTID),
+                           headers=api_token)
+    assert response.status_code == 200, response
+    data = response.json()
+    assert [s['seqrunid'] for s in data['seqruns']] == ['1337_A']
+    assert data['cursor'] is None
+    response = session.get(url('seqrunsbystatus', 'DONE'),
+                           params=dict(field='qc'),
+                           headers=api_token)
+    assert response.status_code == 400, response
+    cursor = base64.urlsafe_b64encode(json.dumps([1, 'x']))
+    response = session.get(url('seqrunsbystatus', 'DONE'),
+                           params=dict(cursor=cursor),
+                           headers=api_token)
+    assert response.status_code == 400, response
+
+@nose.with_setup(my_setup, my_teardown)
+def test_concurrent_seqrun_updates():
+    "Concurrent updates of different seqruns are all saved."
+    seqrunids = ["1337_{0}".format(i) for i in xrange(10)]
+    for seqrunid in seqrunids:
+        data = dict(seqrunid=seqrunid, mean_autosomal_coverage=0.0)
+        response = session.post(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response.reason
+    def update(seqrunid):
+        data = dict(alignment_status='RUNNING', mean_autosomal_coverage=1.0)
+        return requests.put(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID,
+                                seqrunid),
+                            data=json.dumps(data),
+                            headers=api_token)
+    pool = multiprocessing.pool.ThreadPool(len(seqrunids))
+    responses = pool.map(update, seqrunids)
+    pool.close()
+    for response in responses:
+        assert response.status_code == 204, response.reason
+    for seqrunid in seqrunids:
+        response = session.get(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID,
+                                   seqrunid),
+                               headers=api_token)
+        assert response.status_code == 200, response
+        assert response.json()['alignment_status'] == 'RUNNING'
+
+@nose.with_setup(my_setup, my_teardown)
+def test_sample_analyzed_by_seqrun_coverage():
+    """The sample totals are the sums over its seqruns, and the sample
+    is analyzed when its total autosomal coverage reaches the target."""
+    data = dict(target_coverage=10.0)
+    response = session.put(url('sample', PROJECTID, SAMPLEID),
+                           data=json.dumps(data),
+                           headers=api_token)
+    assert response.status_code == 204, response.reason
+    for seqrunid in ['1337_A', '1337_B']:
+        data = dict(seqrunid=seqrunid, alignment_status='DONE',
+                    mean_autosomal_coverage=4.0)
+        response = session.post(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID),
+                                data=json.dumps(data),
+                                headers=api_token)
+        assert response.status_code == 201, response.reason
+    response = session.get(url('sample', PROJECTID, SAMPLEID),
+                           headers=api_token)
+    data = response.json()
+    assert data['total_autosomal_coverage'] == 8.0, data
+    assert data.get('analysis_status') != 'ANALYZED'
+    data = dict(mean_autosomal_coverage=6.0)
+    response = session.put(url('seqrun', PROJECTID, SAMPLEID, LIBPREPID,
+                               '1337_B'),
+                           data=json.dumps(data),
+                           headers=api_token)
+    assert response.status_code == 204, response.reason
+    response = session.get(url('sample', PROJECTID, SAMPLEID),
+                           headers=api_token)
+    data = response.json()
+    assert data['total_autosomal_coverage'] == 10.0, data
+    assert data['analysis_status'] == 'ANALYZED'
+
 @nose.with_setup(my_setup, my_teardown)
 def test_delete_seqrun():
 
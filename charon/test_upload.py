@@ -60,3 +60,35 @@ def test_upload_project_new_samples():
                             files=files,
                             headers=api_token)
     assert response.status_code == 400, response
+
+UPDATE_SAMPLES = """sampleid,qc,target_coverage
+S1,DONE,40.0
+S2,,20.0
+"""
+
+@nose.with_setup(my_setup, my_teardown)
+def test_update_project_samples():
+    "Update samples from a CSV file; all or none."
+    files = dict(csvfile=('new_samples.csv', NEW_SAMPLES))
+    response = session.post(url('project', PROJECTID),
+                            files=files,
+                            headers=api_token)
+    assert response.status_code == 200, response
+    files = dict(csvfile=('update_samples.csv', UPDATE_SAMPLES))
+    response = session.post(url('samplesupdate', PROJECTID),
+                            files=files,
+                            headers=api_token)
+    assert response.status_code == 200, response
+    response = session.get(url('sample', PROJECTID, 'S1'), headers=api_token)
+    assert response.json()['qc'] == 'DONE'
+    response = session.get(url('sample', PROJECTID, 'S2'), headers=api_token)
+    assert response.json()['target_coverage'] == 20.0
+    # An invalid value in one row; no sample is updated.
+    files = dict(csvfile=('update_samples.csv',
+                          "sampleid,qc\nS1,NOT_RUNNING\nS2,x\n"))
+    response = session.post(url('samplesupdate', PROJECTID),
+                            files=files,
+                            headers=api_token)
+    assert response.status_code == 400, response
+    response = session.get(url('sample', PROJECTID, 'S1'), headers=api_token)
+    assert response.json()['qc'] == 'DONE'
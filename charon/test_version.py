@@ -29,3 +29,23 @@ def test_version_no_header():
     "No access without header carrying API token."
     response = session.get(url('version'))
     assert response.status_code == 401
+
+def test_ready():
+    "Readiness is available without header carrying API token."
+    response = session.get(url('ready'))
+    assert response.status_code in (200, 503), response
+    data = response.json()
+    assert data['ready'] == (response.status_code == 200)
+    assert 'sample' in data['designs']
+    if data['ready']:
+        assert data['designs']['sample']['current']
+        assert data['designs']['sample']['indexing'] is None
+    assert 'pool' not in data
+
+def test_ready_stats():
+    "Statistics are given with the readiness only with the API token."
+    response = session.get(url('ready'), headers=api_token)
+    assert response.status_code in (200, 503), response
+    data = response.json()
+    assert 'pool' in data
+    assert 'logwriter' in data
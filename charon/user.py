@@ -18,6 +18,9 @@ from .saver import Saver
 class UserSaver(Saver):
 
     doctype = constants.USER
+    # Changes are made to the doc directly, so they cannot be merged.
+    patchable = False
+    max_retries = 0
 
 
 class Login(RequestHandler):
@@ -1,6 +1,8 @@
 " Charon: Various utility functions. "
 
 import os
+import json
+import base64
 import socket
 import logging
 import urlparse
@@ -16,6 +18,8 @@ import requests
 import charon
 from . import constants
 from . import settings
+from . import connection
+from . import cache
 
 def load_settings(filepath=None):
     """Load and return the settings from the given settings file,
@@ -92,13 +96,25 @@ def load_settings(filepath=None):
             raise ValueError('could not determine port from BASE_URL')
     return settings
 
+def set_worker_logging(worker):
+    "Tag all log records from this process with the worker number."
+    format = "worker {0}: {1}".format(worker,
+                                      settings.get('LOGGING_FORMAT',
+                                                   logging.BASIC_FORMAT))
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(format))
+
 def get_db():
-    "Return the handle for the CouchDB database."
-    try:
-        return couchdb.Server(settings['DB_SERVER'])[settings['DB_DATABASE']]
-    except couchdb.http.ResourceNotFound:
-        raise KeyError("CouchDB database '%s' does not exist" %
-                       settings['DB_DATABASE'])
+    """Return the handle for the CouchDB database.
+    The handle and its connection pool are shared within the process.
+    Raise KeyError if no such database."""
+    return connection.get_db()
+
+def get_log_db():
+    """Return the handle for the CouchDB log database; the handle for the
+    main database if no separate log database is configured.
+    Raise KeyError if no such database."""
+    return connection.get_log_db()
 
 def get_versions():
     "Get version numbers for software components as list of tuples."
@@ -132,8 +148,8 @@ def to_bool(value):
     value = value.lower()
     return value in ['true', 'yes'] or value[0] in ['t', 'y']
 
-def log(db, doc, changed={}, current_user=None):
-    "Create a log entry for the given document."
+def get_log_entry(doc, changed={}, current_user=None):
+    "Return a new log entry document for the given document."
     entry = {'_id':get_iuid(),
                 'doc':doc['_id'],
                 'doctype':doc[constants.DB_DOCTYPE],
@@ -145,58 +161,106 @@ def log(db, doc, changed={}, current_user=None):
             entry['operator'] = current_user['email']
     except KeyError:
         pass
-    db.save(entry)
+    return entry
+
+def encode_cursor(key, docid):
+    """Return an opaque cursor string for the view key and document id
+    of the first row of the next page of a view query."""
+    return base64.urlsafe_b64encode(json.dumps([key, docid]))
+
+def decode_cursor(cursor):
+    """Return the view key and document id encoded in the cursor.
+    Raise ValueError if the cursor is invalid."""
+    try:
+        key, docid = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor')
+    if not isinstance(key, list) or not isinstance(docid, basestring):
+        raise ValueError('invalid cursor')
+    return key, docid
 
 def cmp_timestamp(i, j):
     "Compare the two documents by their 'timestamp' values."
     return cmp(i['timestamp'], j['timestamp'])
 
-def delete_project(db, project):
+# The identifier keys giving the path of an entity, by doctype.
+PATH_KEYS = {constants.PROJECT: ('projectid',),
+             constants.SAMPLE: ('projectid', 'sampleid'),
+             constants.LIBPREP: ('projectid', 'sampleid', 'libprepid'),
+             constants.SEQRUN: ('projectid', 'sampleid', 'libprepid',
+                                'seqrunid')}
+
+def delete_project(db, project, progress=None):
     "Delete the project and all its dependent entities."
-    startkey = (project['projectid'], '')
-    endkey = (project['projectid'], constants.HIGH_CHAR)
-    view = db.view('sample/sampleid', include_docs=True)
-    samples = [r.doc for r in view[startkey:endkey]]
-    for sample in samples:
-        delete_sample(db, sample)
-    delete_logs(db, project['_id'])
-    del db[project['_id']]
-
-def delete_sample(db, sample):
+    return delete_entity(db, project, progress=progress)
+
+def delete_sample(db, sample, progress=None):
     "Delete the sample and all its dependent entities."
-    delete_logs(db, sample['_id'])
-    startkey = (sample['projectid'], sample['sampleid'], '')
-    endkey = (sample['projectid'], sample['sampleid'], constants.HIGH_CHAR)
-    view = db.view('libprep/libprepid', include_docs=True)
-    libpreps = [r.doc for r in view[startkey:endkey]]
-    for libprep in libpreps:
-        delete_libprep(db, libprep)
-    del db[sample['_id']]
-
-def delete_libprep(db, libprep):
+    return delete_entity(db, sample, progress=progress)
+
+def delete_libprep(db, libprep, progress=None):
     "Delete the libprep and all its dependent entities."
-    delete_logs(db, libprep['_id'])
-    startkey = (libprep['projectid'], libprep['sampleid'],
-                libprep['libprepid'], '')
-    endkey = (libprep['projectid'], libprep['sampleid'],
-              libprep['libprepid'], constants.HIGH_CHAR)
-    view = db.view('seqrun/seqrunid', include_docs=True)
-    seqruns = [r.doc for r in view[startkey:endkey]]
-    for seqrun in seqruns:
-        delete_seqrun(db, seqrun)
-    logging.debug("deleting libprep %s", startkey)
-    del db[libprep['_id']]
-
-def delete_seqrun(db, seqrun):
-    "Delete the seqrun and all its dependent entities."
-    delete_logs(db, seqrun['_id'])
-    del db[seqrun['_id']]
-
-def delete_logs(db, id):
-    "Delete the log documents for the given doc id."
-    ids = [r.id for r in db.view('log/doc')[id]]
-    for id in ids:
-        del db[id]
+    return delete_entity(db, libprep, progress=progress)
+
+def delete_seqrun(db, seqrun, progress=None):
+    "Delete the seqrun and its log documents."
+    return delete_entity(db, seqrun, progress=progress)
+
+def delete_entity(db, doc, progress=None, batch_size=None):
+    """Delete the entity, all its dependent entities, and the log
+    documents for all of them. The documents are collected by one range
+    read of the 'entity/path' view, and deleted by _bulk_docs requests.
+    The function 'progress', if given, is called with the number of
+    documents deleted so far and the total, after each batch.
+    The log entries queued by the log writer are written first, so that
+    none of them are saved after the deletion.
+    Return the number of documents deleted.
+    Raise IOError if the queued log entries were not written in time;
+    nothing is deleted then."""
+    from . import logwriter             # Imports this module.
+    if not logwriter.flush(timeout=settings.get('LOG_FLUSH_TIMEOUT', 5.0)):
+        raise IOError('log entries not written; try again later')
+    if batch_size is None:
+        batch_size = settings.get('BULK_BATCH_SIZE', 500)
+    path = [doc[k] for k in PATH_KEYS[doc[constants.DB_DOCTYPE]]]
+    view = db.view('entity/path',
+                   startkey=path,
+                   endkey=path + [constants.HIGH_CHAR])
+    ids = [r.id for r in view]
+    if doc['_id'] not in ids:           # Not yet indexed; created just now?
+        ids.append(doc['_id'])
+    logdb = db
+    if settings.get('LOG_DATABASE'):
+        logdb = get_log_db()
+    logids = []
+    for start in xrange(0, len(ids), batch_size):
+        view = logdb.view('log/doc', keys=ids[start:start+batch_size])
+        logids.extend([r.id for r in view])
+    # Delete the log documents first, so that none are left orphaned.
+    targets = [(logdb, id) for id in logids] + [(db, id) for id in ids]
+    dbs = [db] if logdb is db else [logdb, db]
+    total = len(targets)
+    count = 0
+    for start in xrange(0, total, batch_size):
+        batch = targets[start:start+batch_size]
+        for target in dbs:
+            keys = [id for d, id in batch if d is target]
+            if not keys: continue
+            view = target.view('_all_docs', keys=keys)
+            docs = [dict(_id=r.id, _rev=r.value['rev'], _deleted=True)
+                    for r in view
+                    if r.value and not r.value.get('deleted')]
+            for success, id, value in target.update(docs):
+                if success:
+                    count += 1
+                    cache.evict(id)
+                else:
+                    logging.warning("could not delete %s: %s", id, value)
+        if progress:
+            progress(count, total)
+    logging.debug("deleted %s documents for %s %s",
+                  count, doc[constants.DB_DOCTYPE], '/'.join(path))
+    return count
 
 class QueueHandler(logging.Handler):
     """
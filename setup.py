@@ -16,7 +16,7 @@ setup(name='charon',
       package_dir={'charon': 'charon'},
       include_package_data=True,
       install_requires=['tornado>=3.2',
-                        'couchdb>=0.8',
+                        'couchdb>=1.0',
                         'pyyaml>=3.10',
                         'requests>=2.2'],
      )